@@ -1,4 +1,5 @@
 import { Stagehand } from "@browserbasehq/stagehand";
+import { createClient } from "@/app/utils/supabase/server";
 import {
   sendTitleToBackend,
   sendTextContentToBackend,
@@ -41,6 +42,13 @@ export async function POST(req) {
     console.log(`Timestamp: ${timestamp}`);
     console.log(`Current mode: ${mode}`);
 
+    // gemini calls made for a signed in user count against their budget on the backend
+    const supabase = await createClient();
+    const {
+      data: { user },
+    } = await supabase.auth.getUser();
+    const userId = user?.id;
+
     // Check if website exists in database
     const checkData = await checkWebsiteInDB(url);
 
@@ -63,7 +71,7 @@ export async function POST(req) {
       );
     }
 
-    const titleResult = await sendTitleToBackend(url, title, timestamp, mode);
+    const titleResult = await sendTitleToBackend(url, title, timestamp, mode, userId);
 
     if (!titleResult) {
       // title was already determined to be irrelevant -> short-circuit evaluation
@@ -152,7 +160,12 @@ export async function POST(req) {
     const textContent = await agent.execute(agentQuery);
     console.log("Agent execution result:", textContent);
 
-    const textContentResult = await sendTextContentToBackend(textContent);
+    const textContentResult = await sendTextContentToBackend(textContent, {
+      url,
+      title,
+      mode,
+      userId,
+    });
 
     const finalAllowed = titleResult && textContentResult;
 
@@ -170,23 +183,7 @@ export async function POST(req) {
       timestamp,
     };
 
-    // Start adding to DB asynchronously
-    addWebsiteToDB(url, title, timestamp, finalAllowed, mode)
-      .then((dbResponse) => {
-        if (!dbResponse.success) {
-          console.log(
-            "Error occurred while adding to DB:",
-            dbResponse.errorMessage
-          );
-        } else {
-          console.log("Successfully added website to DB asynchronously");
-        }
-      })
-      .catch((err) => {
-        console.error("Failed to add website to DB:", err);
-      });
-
-    // Return the response immediately without waiting for DB operation
+    // The backend stores the content verdicts for every mode against this url, no separate DB write needed
     return new Response(JSON.stringify(responseData), {
       status: 200,
       headers: { "Content-Type": "application/json" },
@@ -1,5 +1,6 @@
 import { createClient } from "@/app/utils/supabase/server";
 import { NextResponse } from "next/server";
+import { refreshUserModeInBackend } from "@/app/api/utils/backendApi";
 
 // GET endpoint to retrieve the user's current mode settings
 export async function GET() {
@@ -131,6 +132,9 @@ export async function POST(request) {
       );
     }
 
+    // the backend caches modes, have it pick up this write and push it to the extension
+    await refreshUserModeInBackend(user.id);
+
     return NextResponse.json({
       success: true,
       mode,
@@ -5,9 +5,10 @@
 const BACKEND_BASE_URL = "http://127.0.0.1:8000";
 
 /**
- * Sends webpage title information to the backend for analysis
+ * Sends webpage title information to the backend for analysis.
+ * Gemini calls it causes count against userId's budget when one is given.
  */
-export async function sendTitleToBackend(url, title, timestamp, mode) {
+export async function sendTitleToBackend(url, title, timestamp, mode, userId) {
   try {
     console.log("Sending title data to Python backend...");
     const backendResponse = await fetch(`${BACKEND_BASE_URL}/received-link`, {
@@ -20,6 +21,7 @@ export async function sendTitleToBackend(url, title, timestamp, mode) {
         title,
         timestamp,
         mode,
+        user_id: userId,
       }),
     });
 
@@ -41,9 +43,10 @@ export async function sendTitleToBackend(url, title, timestamp, mode) {
 }
 
 /**
- * Sends extracted text content to the backend for further analysis
+ * Sends extracted text content to the backend for further analysis.
+ * The backend judges it for every mode and stores the verdicts against the url.
  */
-export async function sendTextContentToBackend(textContent) {
+export async function sendTextContentToBackend(textContent, { url, title, mode, userId } = {}) {
   try {
     // Extract the message text if textContent is an object with a message property
     let contentToSend = textContent;
@@ -71,7 +74,12 @@ export async function sendTextContentToBackend(textContent) {
         headers: {
           "Content-Type": "application/json",
         },
+        // metadata first so it survives if the backend cuts off an oversized body
         body: JSON.stringify({
+          url,
+          title,
+          mode,
+          user_id: userId,
           text_content: contentToSend,
         }),
       }
@@ -191,3 +199,29 @@ export async function checkWebsiteInDB(url) {
     return { exists: false, error: dbError.message };
   }
 }
+
+/**
+ * Tells the backend that the user's mode was saved behind its back, so it re-reads it
+ * and pushes it to the extension's mode event stream instead of serving a stale cached mode.
+ */
+export async function refreshUserModeInBackend(userId) {
+  try {
+    const backendResponse = await fetch(
+      `${BACKEND_BASE_URL}/user-mode/${encodeURIComponent(userId)}/refresh`,
+      { method: "POST" }
+    );
+
+    if (!backendResponse.ok) {
+      console.warn(`Python backend returned status ${backendResponse.status}`);
+      return false;
+    }
+    const data = await backendResponse.json();
+    return data?.success === true;
+  } catch (backendError) {
+    console.warn(
+      "Failed to refresh user mode in Python backend:",
+      backendError.message
+    );
+    return false;
+  }
+}
@@ -253,7 +253,7 @@ export default function Home() {
   const handleUserInput = async () => {
     try {
       const response = await fetch(
-        "http://127.0.0.1:8001/receive-spoken-request",
+        "http://127.0.0.1:8000/receive-spoken-request",
         {
           method: "POST",
           headers: { "Content-Type": "application/json" },
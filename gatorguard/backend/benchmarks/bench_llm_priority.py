@@ -0,0 +1,104 @@
+"""
+Tab checks during a burst of song generation, against a Gemini fake with a per-second quota.
+
+    python benchmarks/bench_llm_priority.py
+    python benchmarks/bench_llm_priority.py --backend /path/to/other/checkout/gatorguard/backend
+
+Song streams (each one a gemini call) are fired --song-concurrency at a time while page text checks
+run alongside at --text-concurrency. Calls over --gemini-quota per second get a 429 from the fake.
+Reports the text checks' latency and how many of them had to fall back to the mode's policy, the
+song streams that failed, and the 429s gemini sent. Run from the backend directory.
+"""
+import argparse
+import asyncio
+import re
+import statistics
+import time
+
+import httpx
+
+from fake_services import FakeConfig
+from load_test_request_paths import BACKEND_DIR, generate_songs, received_text_content, start_app, start_fakes
+
+
+def fallbacks(metrics_text):
+    return sum(float(value) for value in re.findall(r'^gatorguard_verdict_fallbacks_total\{.*\} (\S+)$',
+                                                    metrics_text, re.MULTILINE))
+
+
+async def run(base_url, fakes_url, args):
+    limits = httpx.Limits(max_connections=200, max_keepalive_connections=200)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        await client.post(fakes_url + '/__reset')
+        fallbacks_before = fallbacks((await client.get('/metrics')).text)
+        text_latencies = []
+        song_errors = 0
+
+        async def songs():
+            semaphore = asyncio.Semaphore(args.song_concurrency)
+
+            async def one(i):
+                nonlocal song_errors
+                _, _, body = generate_songs(i, args)
+                async with semaphore:
+                    response = await client.post('/generate-songs/stream', json=body)
+                    song_errors += response.status_code != 200 or '"error"' in response.text
+
+            await asyncio.gather(*(one(i) for i in range(args.songs)))
+
+        async def texts():
+            semaphore = asyncio.Semaphore(args.text_concurrency)
+
+            async def one(i):
+                _, path, body = received_text_content(i, args)
+                async with semaphore:
+                    start = time.perf_counter()
+                    await client.post(path, json=body)
+                    text_latencies.append((time.perf_counter() - start) * 1000)
+
+            # let the song burst fill the queue first
+            await asyncio.sleep(0.5)
+            await asyncio.gather(*(one(i) for i in range(args.texts)))
+
+        await asyncio.gather(songs(), texts())
+        text_fallbacks = fallbacks((await client.get('/metrics')).text) - fallbacks_before
+        stats = (await client.get(fakes_url + '/__stats')).json()
+
+    text_latencies.sort()
+    p99 = text_latencies[min(len(text_latencies) - 1, int(len(text_latencies) * 0.99))]
+    print(f"text checks  p50 {statistics.median(text_latencies):8.1f} ms   p99 {p99:8.1f} ms   "
+          f"fell back {text_fallbacks:.0f}/{args.texts}")
+    print(f"song streams failed {song_errors}/{args.songs}")
+    print(f"gemini calls {stats['calls'].get('gemini generate_content', 0)}   "
+          f"429s {stats['calls'].get('gemini over quota', 0)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', default=BACKEND_DIR, help='backend directory of the checkout to benchmark')
+    parser.add_argument('--songs', type=int, default=200)
+    parser.add_argument('--song-concurrency', type=int, default=50)
+    parser.add_argument('--texts', type=int, default=100)
+    parser.add_argument('--text-concurrency', type=int, default=5)
+    parser.add_argument('--gemini-quota', type=float, default=10, help='gemini calls per second before 429s')
+    parser.add_argument('--gemini-latency-ms', type=float, default=300)
+    args = parser.parse_args()
+    args.distinct_pages = args.texts
+
+    fakes, fakes_url = start_fakes(FakeConfig(latency={'gemini': args.gemini_latency_ms / 1000},
+                                              gemini_quota=args.gemini_quota))
+    # stay a little under the quota, the scheduler paces to this
+    process, base_url = start_app(args.backend, fakes_url, 50,
+                                  {'LLM_RATE_PER_MINUTE': str(args.gemini_quota * 60 * 0.95), 'LLM_BURST': '1'})
+    try:
+        print(f"{args.backend}: {args.songs} song streams ({args.song_concurrency} concurrent), {args.texts} text "
+              f"checks ({args.text_concurrency} concurrent), gemini quota {args.gemini_quota:g}/s")
+        asyncio.run(run(base_url, fakes_url, args))
+    finally:
+        process.terminate()
+        process.wait()
+        fakes.terminate()
+
+
+if __name__ == '__main__':
+    main()
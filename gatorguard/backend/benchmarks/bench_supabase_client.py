@@ -0,0 +1,101 @@
+"""
+Compares the old create_client-per-request pattern against the shared pooled client.
+
+    python benchmarks/bench_supabase_client.py            # against SUPABASE_URL from .env
+    python benchmarks/bench_supabase_client.py --stub     # against a local keep-alive stub, no network
+
+Run from the backend directory.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# a syntactically valid (unsigned) jwt so supabase-py accepts it when running against the stub
+STUB_KEY = 'eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.c3R1Yg'
+
+
+class StubPostgrestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer the response so headers and body leave in one segment (avoids nagle stalls)
+    wbufsize = -1
+
+    def do_GET(self):
+        body = json.dumps([{"url": "https://example.com", "title": "Example", "study_allowed": True,
+                            "work_allowed": True, "leisure_allowed": False}]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubPostgrestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{name:<28} mean {statistics.mean(samples):8.2f} ms   p50 {statistics.median(samples):8.2f} ms   p99 {p99:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--url', default='https://example.com')
+    parser.add_argument('--stub', action='store_true', help='run against a local PostgREST stub')
+    args = parser.parse_args()
+
+    server = None
+    if args.stub:
+        server, stub_url = start_stub()
+        os.environ['SUPABASE_URL'] = stub_url
+        os.environ['SUPABASE_KEY'] = STUB_KEY
+
+    import supabase_client
+    from supabase import create_client
+
+    if args.stub:
+        supabase_client.SUPABASE_URL = os.environ['SUPABASE_URL']
+        supabase_client.SUPABASE_KEY = os.environ['SUPABASE_KEY']
+
+    per_request = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        client = create_client(supabase_url=supabase_client.SUPABASE_URL, supabase_key=supabase_client.SUPABASE_KEY)
+        supabase_client.get_website(client, args.url)
+        per_request.append((time.perf_counter() - start) * 1000)
+        client.postgrest.session.close()
+
+    shared = supabase_client.init_supabase_client()
+    supabase_client.get_website(shared, args.url)  # warm the pool
+    pooled = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        supabase_client.get_website(supabase_client.get_supabase_client(), args.url)
+        pooled.append((time.perf_counter() - start) * 1000)
+    supabase_client.close_supabase_client()
+
+    print(f"{args.requests} website lookups against {supabase_client.SUPABASE_URL}")
+    report("create_client per request", per_request)
+    report("shared pooled client", pooled)
+    print(f"per-request overhead removed: {statistics.mean(per_request) - statistics.mean(pooled):.2f} ms")
+
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+End-to-end latency of a spoken "switch to study mode" request, with the voice assistant mounted in the
+main app (in-process mode switch) and as the standalone service posting to /received-mode/.
+
+    python benchmarks/bench_voice_mode_switch.py
+    python benchmarks/bench_voice_mode_switch.py --requests 500 --latency-ms 20 --gemini-latency-ms 0
+
+Gemini and the database are the fakes from fake_services.py, answering after --gemini-latency-ms and
+--latency-ms. Run from the backend directory.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fake_services import FakeConfig, fake_env
+from load_test_request_paths import BACKEND_DIR, FAKE_SERVICES, free_port, start_fakes
+
+
+def start(target, port, env):
+    process = subprocess.Popen(
+        [sys.executable, FAKE_SERVICES, target, str(port)],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.post(base_url + '/receive-spoken-request', json={"request": "", "user_id": "warmup"}, timeout=5)
+            return process, base_url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'{target} did not start')
+
+
+async def measure(base_url, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        async def one(i):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post('/receive-spoken-request',
+                                             json={"request": "Switch to study school mode", "user_id": f"user-{i % 50}"})
+                latencies.append((time.perf_counter() - start) * 1000)
+                errors += 'message' not in response.json()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return requests / elapsed, statistics.median(latencies), p99, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=20, help='added to every PostgREST response')
+    parser.add_argument('--gemini-latency-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    fakes, fakes_url = start_fakes(FakeConfig(latency={'db': args.latency_ms / 1000,
+                                                       'gemini': args.gemini_latency_ms / 1000}))
+
+    main_port = free_port()
+    env = dict(
+        os.environ,
+        **fake_env(fakes_url),
+        LOCAL_CLASSIFIER_ENABLED='false',
+        WEBSITE_RULES_LOAD_DB='false',
+        PLAYLIST_POOL_WARM_ON_START='false',
+        TRACK_CACHE_PATH=os.path.join(tempfile.mkdtemp(), 'track_cache.sqlite3'),
+        VOICE_MODE_SERVICE_URL=f'http://127.0.0.1:{main_port}',
+        LOG_LEVEL='CRITICAL',
+        LLM_RATE_PER_MINUTE='0',
+    )
+    processes = []
+    try:
+        main_app, main_url = start('main:app', main_port, env)
+        processes.append(main_app)
+        voice_app, voice_url = start('voice_assistant:app', free_port(), env)
+        processes.append(voice_app)
+
+        print(f"{args.requests} requests, {args.concurrency} concurrent, {args.latency_ms:.0f} ms database latency, "
+              f"{args.gemini_latency_ms:.0f} ms gemini latency")
+        for name, base_url in (('in-process', main_url), ('standalone', voice_url)):
+            throughput, p50, p99, errors = asyncio.run(measure(base_url, args.requests, args.concurrency))
+            print(f"{name:<12} {throughput:8.1f} req/s   p50 {p50:8.1f} ms   p99 {p99:8.1f} ms   errors {errors}")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        fakes.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+"""
+Local stand-ins for everything the backend talks to, for benchmarks and load tests.
+
+One threaded HTTP server emulates
+  - PostgREST (/rest/v1/...): in-memory `websites`, `user_mode` and `user_profiles` tables with eq/in/is
+    filters, insert (409 / 23505 on a duplicate url), upsert (merge or ignore duplicates) and update,
+  - Gemini (/gemini/generate): answers website, page text, song and voice prompts the way the real model
+    is asked to (json verdicts, a json song list, "study school"),
+  - Spotify (/spotify/api/token, /spotify/v1/search): client-credentials tokens and one track per search,
+each with its own latency and error rate, and counts every call it receives (GET /__stats, POST /__reset).
+
+The Gemini SDK only speaks grpc asynchronously, so the app is not pointed at this server by
+configuration: `serve_app` starts the backend with GenerativeModel.generate_content_async and the
+Spotify urls patched to go here instead. Nothing in the app itself knows about the fakes.
+
+Run from the backend directory; see load_test_request_paths.py for the scenarios.
+"""
+import asyncio
+import fnmatch
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_supabase_client import STUB_KEY  # noqa: E402
+
+MODES = ['study', 'work', 'leisure']
+CONTENT_KEYS = MODES + ['study_school', 'study_interview']
+SONG_CATALOGUE = [(f'Track {n}', f'Artist {n % 37}') for n in range(300)]
+TABLE_KEYS = {'websites': 'url', 'user_mode': 'id', 'user_profiles': 'id'}
+
+
+class FakeConfig:
+    """
+    Latency (seconds) and error rate (0..1) per service: db, gemini, spotify. gemini_quota is the
+    calls per second gemini accepts (bursts up to one second's worth), the rest get a 429; 0 for none.
+    """
+
+    def __init__(self, latency=None, error_rate=None, seed_websites=1000, seed_users=1000, gemini_quota=0):
+        self.latency = {'db': 0.02, 'gemini': 0.3, 'spotify': 0.05, **(latency or {})}
+        self.error_rate = {'db': 0.0, 'gemini': 0.0, 'spotify': 0.0, **(error_rate or {})}
+        self.gemini_quota = gemini_quota
+        self.seed_websites = seed_websites
+        self.seed_users = seed_users
+
+
+class FakeState:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.tables = {name: {} for name in TABLE_KEYS}
+        self.quota_tokens = float(config.gemini_quota)
+        self.quota_updated = time.monotonic()
+        for i in range(config.seed_websites):
+            url = f'https://known.example/{i}'
+            self.tables['websites'][url] = {'url': url, 'title': f'Known {i}', 'timestamp': None,
+                                            'study_allowed': i % 2 == 0, 'work_allowed': i % 3 == 0,
+                                            'leisure_allowed': True}
+        for i in range(config.seed_users):
+            self.tables['user_profiles'][f'user-{i}'] = {'id': f'user-{i}'}
+            self.tables['user_mode'][f'user-{i}'] = {'id': f'user-{i}', 'mode_select': 'study',
+                                                     'study_submode_select': None}
+
+    def record(self, service, operation) -> bool:
+        """Count the call and sleep for the service's latency; True when this call should fail."""
+        failed = random.random() < self.config.error_rate[service]
+        with self.lock:
+            self.calls[f'{service} {operation}'] += 1
+            if failed:
+                self.errors[f'{service} {operation}'] += 1
+        time.sleep(self.config.latency[service])
+        return failed
+
+    def within_gemini_quota(self) -> bool:
+        if not self.config.gemini_quota:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.quota_tokens = min(self.config.gemini_quota,
+                                    self.quota_tokens + (now - self.quota_updated) * self.config.gemini_quota)
+            self.quota_updated = now
+            if self.quota_tokens < 1:
+                self.calls['gemini over quota'] += 1
+                return False
+            self.quota_tokens -= 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'errors': dict(self.errors)}
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.errors.clear()
+
+
+def _parse_filter(value):
+    # "eq.x", "in.(a,b)", "is.null", "like.a%", "not.<filter>" -> predicate on a column value
+    operator, _, operand = value.partition('.')
+    if operator == 'not':
+        check = _parse_filter(operand)
+        return lambda column: not check(column)
+    if operator == 'like':
+        return lambda column: fnmatch.fnmatchcase(str(column), operand.replace('%', '*'))
+    if operator == 'eq':
+        if operand in ('true', 'false'):
+            return lambda column: str(column).lower() == operand
+        return lambda column: str(column) == operand
+    if operator == 'in':
+        members = {member.strip('"') for member in operand[1:-1].split(',')}
+        return lambda column: str(column) in members
+    if operator == 'is':
+        return lambda column: column is None if operand == 'null' else str(column).lower() == operand
+    return lambda column: True
+
+
+def _select(rows, columns):
+    if not columns or columns == '*':
+        return [dict(row) for row in rows]
+    names = columns.split(',')
+    return [{name: row.get(name) for name in names} for row in rows]
+
+
+def gemini_answer(prompt: str) -> str:
+    if 'Here is a request:' in prompt:
+        match = re.search(r'[Ss]witch to (.+?) mode', prompt.split('Here is a request:', 1)[1])
+        return match.group(1) if match else 'Invalid request'
+    if 'Recommend' in prompt:
+        songs = random.sample(SONG_CATALOGUE, 5)
+        if 'JSON array' in prompt:
+            return json.dumps([{'title': title, 'artist': artist} for title, artist in songs])
+        return '\n'.join(f'{title} - {artist}' for title, artist in songs)
+    # verdicts are a pure function of the prompt so repeated pages agree with themselves
+    digest = hashlib.sha256(prompt.encode()).digest()
+    keys = CONTENT_KEYS if 'study_school' in prompt else MODES
+    return json.dumps({key: bool(digest[i] & 1) for i, key in enumerate(keys)})
+
+
+def make_handler(state: FakeState):
+    class FakeServiceHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        wbufsize = -1
+
+        def _respond(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length)
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                return json.loads(raw or b'null')
+            return {key: values[0] for key, values in parse_qs(raw.decode()).items()}
+
+        def _route(self, method):
+            parts = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+            path = unquote(parts.path)
+            if path.startswith('/rest/v1/'):
+                return self._postgrest(method, path[len('/rest/v1/'):], query)
+            if path == '/gemini/generate':
+                return self._gemini()
+            if path.startswith('/spotify/'):
+                return self._spotify(path[len('/spotify'):], query)
+            if path == '/__stats':
+                return self._respond(200, state.stats())
+            if path == '/__reset':
+                state.reset()
+                return self._respond(200, {})
+            return self._respond(404, {'message': 'not found'})
+
+        def do_GET(self):
+            self._route('GET')
+
+        def do_POST(self):
+            self._route('POST')
+
+        def do_PATCH(self):
+            self._route('PATCH')
+
+        def _postgrest(self, method, table, query):
+            body = self._body() if method in ('POST', 'PATCH') else None
+            if state.record('db', f'{method} {table}'):
+                return self._respond(503, {'message': 'injected database error', 'code': 'XX000',
+                                           'details': None, 'hint': None})
+            if table not in TABLE_KEYS:
+                return self._respond(404, {'message': f'relation "{table}" does not exist', 'code': '42P01'})
+            key = TABLE_KEYS[table]
+            rows = state.tables[table]
+            filters = {column: _parse_filter(value) for column, value in query.items()
+                       if column not in ('select', 'limit', 'offset', 'order', 'on_conflict', 'columns')}
+            prefer = self.headers.get('Prefer', '')
+
+            with state.lock:
+                if method == 'GET':
+                    matched = [row for row in rows.values()
+                               if all(check(row.get(column)) for column, check in filters.items())]
+                    if 'order' in query:
+                        matched.sort(key=lambda row: str(row.get(query['order'].split('.')[0])))
+                    offset = int(query.get('offset', 0))
+                    limit = int(query['limit']) if 'limit' in query else None
+                    matched = matched[offset:offset + limit if limit is not None else None]
+                    return self._respond(200, _select(matched, query.get('select')))
+
+                if method == 'POST':
+                    written = []
+                    for item in body if isinstance(body, list) else [body]:
+                        existing = rows.get(item.get(key))
+                        if existing is not None and 'ignore-duplicates' in prefer:
+                            continue
+                        if existing is not None and 'merge-duplicates' not in prefer:
+                            return self._respond(409, {
+                                'message': f'duplicate key value violates unique constraint "{table}_{key}_key"',
+                                'code': '23505', 'details': None, 'hint': None})
+                        row = {**(existing or {}), **item}
+                        rows[row[key]] = row
+                        written.append(dict(row))
+                    return self._respond(201, written)
+
+                # PATCH
+                updated = []
+                for row in rows.values():
+                    if all(check(row.get(column)) for column, check in filters.items()):
+                        row.update(body)
+                        updated.append(dict(row))
+                return self._respond(200, updated)
+
+        def _gemini(self):
+            body = self._body()
+            if not state.within_gemini_quota():
+                return self._respond(429, {'error': 'quota exceeded'})
+            if state.record('gemini', 'generate_content'):
+                return self._respond(random.choice((429, 500, 503)), {'error': 'injected gemini error'})
+            return self._respond(200, {'text': gemini_answer(body.get('prompt', ''))})
+
+        def _spotify(self, path, query):
+            if path == '/api/token':
+                self._body()
+                if state.record('spotify', 'token'):
+                    return self._respond(503, {'error': 'injected spotify error'})
+                return self._respond(200, {'access_token': 'fake-token', 'token_type': 'Bearer', 'expires_in': 3600})
+            if state.record('spotify', 'search'):
+                return self._respond(random.choice((429, 500)), {'error': {'message': 'injected spotify error'}})
+            match = re.match(r'track:(.*) artist:(.*)', query.get('q', ''))
+            title, artist = match.groups() if match else (query.get('q', ''), 'Unknown')
+            track_id = hashlib.md5(f'{title}|{artist}'.encode()).hexdigest()[:22]
+            return self._respond(200, {'tracks': {'items': [{
+                'name': title, 'duration_ms': 180000, 'artists': [{'name': artist}],
+                'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+            }]}})
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeServiceHandler
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections when the app opens its whole pool at once
+    request_queue_size = 1024
+
+
+def serve_fakes(port, config: FakeConfig):
+    """Blocking; meant to be the target of its own process so its threads don't compete with the app."""
+    FakeServer(('127.0.0.1', port), make_handler(FakeState(config))).serve_forever()
+
+
+def fake_env(fakes_url):
+    """Environment for an app process that should only talk to the fakes."""
+    return {
+        'SUPABASE_URL': fakes_url,
+        'SUPABASE_KEY': STUB_KEY,
+        'FAKE_SERVICES_URL': fakes_url,
+        'GEMINI_API_KEY': 'fake',
+        'GEMINI_API_KEY_2': 'fake',
+        'GEMINI_SPEECH_API_KEY': 'fake',
+        'SPOTIFY_CLIENT_ID': 'fake',
+        'SPOTIFY_CLIENT_SECRET': 'fake',
+    }
+
+
+def patch_for_fakes(fakes_url):
+    """Send the app's Gemini and Spotify calls to the fakes. Call before the app is imported."""
+    import google.generativeai as genai
+    import httpx
+    from google.api_core import exceptions as google_exceptions
+
+    sys.path.insert(0, os.getcwd())
+    import utils.spotify_helper as spotify_helper
+
+    spotify_helper.SPOTIFY_TOKEN_URL = f'{fakes_url}/spotify/api/token'
+    spotify_helper.SPOTIFY_SEARCH_URL = f'{fakes_url}/spotify/v1/search'
+
+    client = None
+
+    class FakeResponse:
+        def __init__(self, text):
+            self.text = text
+
+    class FakeStream:
+        # generate_content_async(stream=True): the text arrives in a few chunks
+        def __init__(self, text):
+            size = max(1, len(text) // 3)
+            self.chunks = [FakeResponse(text[i:i + size]) for i in range(0, len(text), size)]
+
+        def __aiter__(self):
+            return self._iterate()
+
+        async def _iterate(self):
+            for chunk in self.chunks:
+                await asyncio.sleep(0)
+                yield chunk
+
+    async def generate_content_async(self, contents, *args, stream=False, **kwargs):
+        nonlocal client
+        if client is None:
+            client = httpx.AsyncClient(base_url=fakes_url, timeout=60,
+                                       limits=httpx.Limits(max_connections=100, max_keepalive_connections=100))
+        response = await client.post('/gemini/generate', json={'prompt': str(contents)})
+        if response.status_code != 200:
+            raise google_exceptions.from_http_status(response.status_code, 'fake gemini error')
+        text = response.json()['text']
+        return FakeStream(text) if stream else FakeResponse(text)
+
+    genai.GenerativeModel.generate_content_async = generate_content_async
+
+
+def serve_app(target, port):
+    """Entry point of the app subprocess: patch, then run uvicorn on target ('main:app')."""
+    import uvicorn
+
+    patch_for_fakes(os.environ['FAKE_SERVICES_URL'])
+    uvicorn.run(target, port=port, log_level='warning')
+
+
+if __name__ == '__main__':
+    # python benchmarks/fake_services.py APP PORT, started by the load tests
+    serve_app(sys.argv[1], int(sys.argv[2]))
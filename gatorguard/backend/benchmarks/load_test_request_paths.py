@@ -0,0 +1,239 @@
+"""
+Concurrent load test for the request paths, against the local fakes in fake_services.py.
+
+    python benchmarks/load_test_request_paths.py
+    python benchmarks/load_test_request_paths.py --scenario received-link --db-latency-ms 50 --db-error-rate 0.05
+    python benchmarks/load_test_request_paths.py --backend /path/to/other/checkout/gatorguard/backend
+
+The app under test runs in a uvicorn subprocess from --backend (default: this checkout), so the same
+load can be pointed at an older checkout (e.g. a `git worktree`) for a before/after comparison.
+PostgREST, Gemini and Spotify are all fakes with their own latency and error rate. Besides throughput
+and latency every scenario reports the calls it made to each of them, per request.
+
+Scenarios:
+  received-link          known urls (a database round trip each), every --unknown-every'th one is new and goes to gemini
+  received-text-content  page text in rotating modes, --distinct-pages different pages
+  add-website            new urls evaluated by gemini and inserted, every 5th one already exists and is updated
+  generate-songs         playlists for every mode, submode and lyric setting
+  received-mode          mode switches
+  user-mode              mode lookups
+
+Run from the backend directory.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fake_services import FakeConfig, fake_env, serve_fakes
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_services.py')
+
+PAGE_WORDS = ("lecture notes dynamic programming memoization knapsack worked examples practice questions midterm "
+              "quarterly report budget meeting agenda slides recipe travel football highlights trailer review "
+              "interview questions system design resume chapter summary homework proof theorem").split()
+SONG_MODES = [('study', None), ('study', 'school'), ('study', 'interview'), ('work', None), ('leisure', None)]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fakes(config: FakeConfig):
+    # the fakes get their own process so their threads don't compete with the load generator for the gil
+    port = free_port()
+    process = multiprocessing.Process(target=serve_fakes, args=(port, config), daemon=True)
+    process.start()
+    return process, f'http://127.0.0.1:{port}'
+
+
+def start_app(backend_dir, fakes_url, pool_size, extra_env=None):
+    port = free_port()
+    env = dict(
+        os.environ,
+        **fake_env(fakes_url),
+        SUPABASE_POOL_SIZE=str(pool_size),
+        LOCAL_CLASSIFIER_ENABLED='false',
+        WEBSITE_RULES_LOAD_DB='false',
+        PLAYLIST_POOL_WARM_ON_START='false',
+        TRACK_CACHE_PATH=os.path.join(tempfile.mkdtemp(), 'track_cache.sqlite3'),
+        LOG_LEVEL='CRITICAL',
+        # the fake gemini has no quota unless asked for one, so don't pace calls to it
+        LLM_RATE_PER_MINUTE='0',
+    )
+    env.update(extra_env or {})
+    process = subprocess.Popen(
+        [sys.executable, FAKE_SERVICES, 'main:app', str(port)],
+        cwd=backend_dir, env=env, stdout=subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(base_url + '/', timeout=1)
+            return process, base_url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('app did not start')
+
+
+def received_link(i, args):
+    if args.unknown_every and i % args.unknown_every == 0:
+        url = f'https://unknown.example/{i}'
+    else:
+        url = f'https://known.example/{i % args.seed_websites}'
+    return 'POST', '/received-link', {"url": url, "title": "Load", "mode": "study"}
+
+
+def page_text(page):
+    # different enough from every other page that the content cache's near-duplicate match doesn't join them
+    words = random.Random(page).choices(PAGE_WORDS, k=400)
+    return f"Page {page}. " + " ".join(words)
+
+
+def received_text_content(i, args):
+    page = i % args.distinct_pages
+    mode, submode = SONG_MODES[i % len(SONG_MODES)]
+    return 'POST', '/received-text-content', {
+        "url": f"https://pages.example/{page}", "title": f"Page {page}", "mode": mode, "submode": submode,
+        "text_content": page_text(page),
+    }
+
+
+def add_website(i, args):
+    if i % 5 == 0:
+        return 'POST', '/add-website-to-db/', {"url": f"https://known.example/{i % args.seed_websites}",
+                                               "title": "Known", "study_allowed": True}
+    return 'POST', '/add-website-to-db/', {"url": f"https://added.example/{i}", "title": f"Added {i}"}
+
+
+def generate_songs(i, args):
+    mode, submode = SONG_MODES[i % len(SONG_MODES)]
+    return 'POST', '/generate-songs', {"mode_select": mode, "sub_mode_select": submode,
+                                       "lyric_status": (i // len(SONG_MODES)) % 2 == 0}
+
+
+def succeeded(response):
+    # most endpoints report failure in the body with a 200
+    if response.status_code != 200:
+        return False
+    body = response.json()
+    return not (isinstance(body, dict) and (body.get("error") or body.get("success") is False))
+
+
+SCENARIOS = {
+    'received-link': received_link,
+    'received-text-content': received_text_content,
+    'add-website': add_website,
+    'generate-songs': generate_songs,
+    'received-mode': lambda i, args: ('POST', '/received-mode/', {"user_id": f"user-{i % args.seed_users}", "mode": "work"}),
+    'user-mode': lambda i, args: ('GET', f'/user-mode/user-{i % args.seed_users}', None),
+}
+
+
+async def settled_stats(client, fakes_url, timeout=30):
+    # background work started by the requests (playlist refills, verdict writes) counts too, so wait for it to stop
+    stats = (await client.get(fakes_url + '/__stats')).json()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+        previous, stats = stats, (await client.get(fakes_url + '/__stats')).json()
+        if stats == previous:
+            break
+    return stats
+
+
+async def run_scenario(base_url, fakes_url, scenario, args):
+    build = SCENARIOS[scenario]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        async def one(i):
+            nonlocal errors
+            method, path, body = build(i, args)
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    failed = not succeeded(await client.request(method, path, json=body))
+                except httpx.HTTPError as e:
+                    print(f"{scenario} request {i} failed: {e!r}")
+                    failed = True
+                latencies.append((time.perf_counter() - start) * 1000)
+                errors += failed
+
+        await client.post(fakes_url + '/__reset')
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+        stats = await settled_stats(client, fakes_url)
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{scenario:<22} {args.requests / elapsed:8.1f} req/s   p50 {statistics.median(latencies):8.1f} ms   "
+          f"p99 {p99:8.1f} ms   errors {errors}")
+    for call, count in sorted(stats['calls'].items()):
+        failed = stats['errors'].get(call, 0)
+        print(f"    {call:<30} {count:6d} calls  {count / args.requests:6.2f}/request"
+              + (f"  {failed} injected errors" if failed else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', default=BACKEND_DIR, help='backend directory of the checkout to load test')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append')
+    parser.add_argument('--db-latency-ms', '--latency-ms', type=float, default=100, help='added to every PostgREST response')
+    parser.add_argument('--db-error-rate', type=float, default=0)
+    parser.add_argument('--gemini-latency-ms', type=float, default=300)
+    parser.add_argument('--gemini-error-rate', type=float, default=0)
+    parser.add_argument('--spotify-latency-ms', type=float, default=50)
+    parser.add_argument('--spotify-error-rate', type=float, default=0)
+    parser.add_argument('--unknown-every', type=int, default=10, help='received-link: every n-th url is unknown (0: none)')
+    parser.add_argument('--distinct-pages', type=int, default=100, help='received-text-content: number of different pages')
+    parser.add_argument('--seed-websites', type=int, default=1000)
+    parser.add_argument('--seed-users', type=int, default=1000)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='extra environment for the app')
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        latency={'db': args.db_latency_ms / 1000, 'gemini': args.gemini_latency_ms / 1000,
+                 'spotify': args.spotify_latency_ms / 1000},
+        error_rate={'db': args.db_error_rate, 'gemini': args.gemini_error_rate, 'spotify': args.spotify_error_rate},
+        seed_websites=args.seed_websites,
+        seed_users=args.seed_users,
+    )
+    fakes, fakes_url = start_fakes(config)
+    process, base_url = start_app(args.backend, fakes_url, args.concurrency,
+                                  dict(setting.split('=', 1) for setting in args.env))
+    try:
+        print(f"{args.backend}: {args.requests} requests, {args.concurrency} concurrent, latency db "
+              f"{args.db_latency_ms:.0f} ms / gemini {args.gemini_latency_ms:.0f} ms / spotify "
+              f"{args.spotify_latency_ms:.0f} ms, error rate db {args.db_error_rate:g} / gemini "
+              f"{args.gemini_error_rate:g} / spotify {args.spotify_error_rate:g}")
+        for scenario in args.scenario or ['received-link', 'received-text-content', 'add-website', 'generate-songs',
+                                          'user-mode', 'received-mode']:
+            asyncio.run(run_scenario(base_url, fakes_url, scenario, args))
+    finally:
+        process.terminate()
+        process.wait()
+        fakes.terminate()
+
+
+if __name__ == '__main__':
+    main()
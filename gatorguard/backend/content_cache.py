@@ -0,0 +1,193 @@
+"""
+Verdict cache for page text sent to /received-text-content.
+
+Text is normalized and hashed (sha256) for exact repeats, and simhashed so a page that only
+changed a little (timestamps, counters, a rotated ad) still reuses the earlier verdict.
+Long text is cut down to a token budget by sampling evenly spaced chunks before it goes to Gemini.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CONTENT_CACHE_MAX_SIZE = int(os.getenv('CONTENT_CACHE_MAX_SIZE', '4096'))
+CONTENT_CACHE_TTL_SECONDS = float(os.getenv('CONTENT_CACHE_TTL_SECONDS', '3600'))
+# max hamming distance between simhashes for two pages to count as the same content
+CONTENT_SIMHASH_DISTANCE = int(os.getenv('CONTENT_SIMHASH_DISTANCE', '3'))
+TEXT_CONTENT_TOKEN_BUDGET = int(os.getenv('TEXT_CONTENT_TOKEN_BUDGET', '2000'))
+
+SIMHASH_BITS = 64
+# with distance <= 3 two hashes always share one of 4 bands exactly (pigeonhole), so bands index candidates
+SIMHASH_BANDS = 4
+BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+SHINGLE_SIZE = 3
+# rough words-per-token ratio for english text, good enough for a budget
+WORDS_PER_TOKEN = 0.75
+BUDGET_CHUNK_WORDS = 100
+# simhash only looks at the start of very long pages, it is the slowest step on a cache hit
+MAX_SIMHASH_WORDS = 5000
+
+WHITESPACE_RE = re.compile(r'\s+')
+WORD_RE = re.compile(r'\w+')
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize('NFKC', text).lower()
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+
+def content_hash(normalized: str) -> str:
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def _feature_hash(feature: str) -> int:
+    # two crc32s make a stable 64-bit hash without pulling in a hashing library
+    data = feature.encode()
+    return (zlib.crc32(data) << 32) | zlib.crc32(data, 0x9E3779B9)
+
+
+def simhash(normalized: str) -> int:
+    words = WORD_RE.findall(normalized)[:MAX_SIMHASH_WORDS]
+    if len(words) < SHINGLE_SIZE:
+        shingles = [' '.join(words)] if words else []
+    else:
+        shingles = [' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+
+    # a bit is set when most shingle hashes have it set; transposing the bit strings with zip
+    # keeps the per-bit counting in C, several times faster than shifting ints in a python loop
+    bit_strings = [format(_feature_hash(shingle), f'0{SIMHASH_BITS}b') for shingle in shingles]
+    half = len(bit_strings) / 2
+    value = 0
+    for position, column in enumerate(zip(*bit_strings)):
+        if column.count('1') > half:
+            value |= 1 << (SIMHASH_BITS - 1 - position)
+    return value
+
+
+def fit_to_budget(text: str, token_budget: int = TEXT_CONTENT_TOKEN_BUDGET) -> str:
+    """Return text unchanged if it fits, otherwise evenly spaced chunks (always keeping the start) that do."""
+    words = text.split()
+    max_words = int(token_budget * WORDS_PER_TOKEN)
+    if len(words) <= max_words:
+        return text
+
+    chunks = [words[i:i + BUDGET_CHUNK_WORDS] for i in range(0, len(words), BUDGET_CHUNK_WORDS)]
+    keep = max(1, max_words // BUDGET_CHUNK_WORDS)
+    step = len(chunks) / keep
+    sampled = [chunks[int(i * step)] for i in range(keep)]
+    return ' [...] '.join(' '.join(chunk) for chunk in sampled)
+
+
+def fingerprint(text: str) -> Tuple[str, int]:
+    """(sha256, simhash) of the normalized text."""
+    normalized = normalize_text(text)
+    return content_hash(normalized), simhash(normalized)
+
+
+def extract_truncated_json_string(body: bytes, key: str, partial: bool = True) -> Optional[str]:
+    """
+    Pull a string field out of a JSON body we stopped reading part way through. The value is
+    either complete (cut happened after it) or cut mid-string, in which case we keep what arrived
+    unless partial is False.
+    """
+    text = body.decode('utf-8', errors='ignore')
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), text)
+    if not match:
+        return None
+    try:
+        value, _ = json.decoder.scanstring(text, match.end())
+        return value
+    except ValueError:
+        if not partial:
+            return None
+    raw = text[match.end():]
+    # drop a dangling escape sequence (at most \uXXXX) left by the cut
+    for trim in range(0, 7):
+        try:
+            return json.loads('"' + raw[:len(raw) - trim] + '"')
+        except ValueError:
+            continue
+    return None
+
+
+def _bands(value: int) -> List[Tuple[int, int]]:
+    mask = (1 << BAND_BITS) - 1
+    return [(band, value >> (band * BAND_BITS) & mask) for band in range(SIMHASH_BANDS)]
+
+
+class ContentVerdictCache:
+    """LRU + TTL cache of verdicts keyed by content hash, with a simhash band index for near-duplicates."""
+
+    def __init__(self, max_size: int = CONTENT_CACHE_MAX_SIZE, ttl: float = CONTENT_CACHE_TTL_SECONDS,
+                 max_distance: int = CONTENT_SIMHASH_DISTANCE):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        # hash -> (simhash, verdict, expires_at)
+        self._entries: 'OrderedDict[str, Tuple[int, Any, float]]' = OrderedDict()
+        self._bands: Dict[Tuple[int, int], Set[str]] = {}
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def get(self, text_hash: str, text_simhash: int) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(text_hash)
+            if entry is not None and entry[2] > now:
+                self._entries.move_to_end(text_hash)
+                self.exact_hits += 1
+                return entry[1]
+
+            candidates = set()
+            for band in _bands(text_simhash):
+                candidates.update(self._bands.get(band, ()))
+            for candidate in candidates:
+                candidate_simhash, verdict, expires_at = self._entries[candidate]
+                if expires_at > now and bin(candidate_simhash ^ text_simhash).count('1') <= self.max_distance:
+                    self._entries.move_to_end(candidate)
+                    self.near_hits += 1
+                    return verdict
+
+            self.misses += 1
+            return None
+
+    def put(self, text_hash: str, text_simhash: int, verdict: Any) -> None:
+        with self._lock:
+            if text_hash in self._entries:
+                self._remove(text_hash)
+            self._entries[text_hash] = (text_simhash, verdict, time.monotonic() + self.ttl)
+            for band in _bands(text_simhash):
+                self._bands.setdefault(band, set()).add(text_hash)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "exact_hits": self.exact_hits,
+                "near_duplicate_hits": self.near_hits,
+                "misses": self.misses,
+            }
+
+    def _remove(self, text_hash: str) -> None:
+        text_simhash, _, _ = self._entries.pop(text_hash)
+        for band in _bands(text_simhash):
+            members = self._bands.get(band)
+            if members is not None:
+                members.discard(text_hash)
+                if not members:
+                    del self._bands[band]
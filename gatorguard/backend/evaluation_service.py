@@ -0,0 +1,284 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Optional, Set, Tuple
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+from supabase_client import WebsiteRecord, add_website_to_db_async, fill_website_permission_async, get_async_supabase_client
+from verdict_cache import MODES
+from metrics import stage_timer
+from resilience import CircuitOpenError, Dependency, DependencyError
+from llm_scheduler import BudgetExceeded, Priority, llm_scheduler
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '8'))
+# covers waiting for a free slot as well as the gemini call itself
+GEMINI_EVAL_TIMEOUT_SECONDS = float(os.getenv('GEMINI_EVAL_TIMEOUT_SECONDS', '10'))
+
+
+STUDY_SUBMODES = ['school', 'interview']
+# page content is judged for every mode and every study submode at once
+CONTENT_VERDICT_KEYS = MODES + [f'study_{submode}' for submode in STUDY_SUBMODES]
+
+
+def verdicts_schema(keys):
+    return {
+        'type': 'object',
+        'properties': {key: {'type': 'boolean'} for key in keys},
+        'required': list(keys),
+    }
+
+
+# where an evaluation's verdicts came from
+SOURCE_LOCAL, SOURCE_GEMINI = 'local', 'gemini'
+
+Verdicts = Optional[Dict[str, bool]]
+
+
+MODE_VERDICTS_SCHEMA = verdicts_schema(MODES)
+CONTENT_VERDICTS_SCHEMA = verdicts_schema(CONTENT_VERDICT_KEYS)
+
+MODE_VERDICTS_CONFIG = genai.GenerationConfig(
+    response_mime_type='application/json', response_schema=MODE_VERDICTS_SCHEMA, temperature=0)
+CONTENT_VERDICTS_CONFIG = genai.GenerationConfig(
+    response_mime_type='application/json', response_schema=CONTENT_VERDICTS_SCHEMA, temperature=0)
+
+
+def verdict_key(mode: str, submode: Optional[str] = None) -> str:
+    if mode == 'study' and submode in STUDY_SUBMODES:
+        return f'study_{submode}'
+    return mode
+
+
+def parse_mode_verdicts(response_text: str, keys=MODES) -> Optional[Dict[str, bool]]:
+    # strict: a json object with exactly one boolean per key, anything else is treated as no answer
+    try:
+        verdicts = json.loads(response_text)
+    except ValueError:
+        return None
+    if not isinstance(verdicts, dict) or set(verdicts) != set(keys):
+        return None
+    if not all(isinstance(verdicts[key], bool) for key in keys):
+        return None
+    return verdicts
+
+
+async def evaluate_website_for_all_modes(url, title, priority=Priority.INTERACTIVE):
+    try:
+        if not os.getenv('GEMINI_API_KEY'):
+            logger.error("Missing Gemini API key")
+            return None
+
+        query = f'''
+            A browser user just visited a website with this url: {url} and this title: {title or url}.
+            For each browsing mode (study, work and leisure), decide whether this website is appropriate for that environment.
+            Ignore whether or not it is allowed for mature audiences, simply judge whether the website is related to study,
+            work or leisure material. Answer with a JSON object mapping each mode to true or false.
+        '''
+
+        with stage_timer('gemini', 'evaluate_website'):
+            response = await llm_scheduler.generate('GEMINI_API_KEY', query, priority,
+                                                    generation_config=MODE_VERDICTS_CONFIG)
+        verdicts = parse_mode_verdicts(response.text)
+        if verdicts is None:
+            logger.warning("Unparseable Gemini evaluation", extra={"url": url, "response": response.text})
+
+        return verdicts
+    except Exception:
+        logger.exception("Error evaluating website for all modes", extra={"url": url})
+        return None
+
+
+async def evaluate_text_for_all_modes(text):
+    try:
+        if not os.getenv('GEMINI_API_KEY'):
+            logger.error("Missing Gemini API key")
+            return None
+
+        query = f'''
+            A browser user just visited a website with this content: {text}.
+            Decide whether this website is appropriate for each of these browsing modes:
+            study (studying in general), study_school (studying for school classes), study_interview (preparing for
+            job interviews), work and leisure. Ignore whether or not it is allowed for mature audiences, simply judge
+            whether the content is related to each mode. Answer with a JSON object mapping each mode to true or false.
+        '''
+
+        with stage_timer('gemini', 'evaluate_text'):
+            response = await llm_scheduler.generate('GEMINI_API_KEY', query, Priority.INTERACTIVE,
+                                                    generation_config=CONTENT_VERDICTS_CONFIG)
+        verdicts = parse_mode_verdicts(response.text, CONTENT_VERDICT_KEYS)
+        if verdicts is None:
+            logger.warning("Unparseable Gemini content evaluation", extra={"response": response.text})
+
+        return verdicts
+    except Exception:
+        logger.exception("Error evaluating text content")
+        return None
+
+
+class EvaluationService:
+    """
+    Async front door to Gemini website evaluation. Every mode is classified in one call, concurrent
+    requests for the same url share one in-flight call, the number of calls in flight is capped
+    and every call has a deadline. Calls are skipped while gemini's circuit breaker is open.
+    """
+
+    def __init__(self, verdict_cache=None, local_classifier=None, website_writer=None,
+                 max_concurrency: int = GEMINI_MAX_CONCURRENCY, timeout: float = GEMINI_EVAL_TIMEOUT_SECONDS):
+        self.verdict_cache = verdict_cache
+        self.local_classifier = local_classifier
+        self.website_writer = website_writer
+        self.timeout = timeout
+        self.gemini = Dependency('gemini', timeout)
+        # audits wait behind every request, their timeouts must not open the breaker users depend on
+        self.gemini_audits = Dependency('gemini_audit', timeout)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        # in-flight urls that at least one caller asked to have stored
+        self._persist_urls: Set[str] = set()
+        # background checks of local answers, kept referenced until they finish; they share the gemini
+        # slots with requests, so only a few may hold one
+        self._audits: Set[asyncio.Task] = set()
+        self.max_audits = max(1, max_concurrency // 4)
+
+    async def evaluate(self, url: str, title: Optional[str], persist: bool = True,
+                       user_id: Optional[str] = None) -> Tuple[Verdicts, Optional[str]]:
+        """
+        (verdicts for every mode, SOURCE_LOCAL or SOURCE_GEMINI), or (None, None) if gemini failed or timed out.
+        Local answers are guesses and are never stored. A new gemini call counts against user_id's budget,
+        raises BudgetExceeded once it is used up.
+        """
+        probabilities = {}
+        if self.local_classifier is not None:
+            # obvious sites are answered on the cpu. they are cheap enough to recompute, and a stored guess
+            # would come back as training data and as an exact rule, so the caller must not store them either
+            local, probabilities = self.local_classifier.classify(url, title)
+            if local is not None:
+                if len(self._audits) < self.max_audits and self.local_classifier.should_audit():
+                    audit = asyncio.ensure_future(self._audit(url, title, local))
+                    self._audits.add(audit)
+                    audit.add_done_callback(self._audits.discard)
+                return local, SOURCE_LOCAL
+
+        task = self._in_flight.get(url)
+        if task is None:
+            # charged to the caller that starts the call, so one user's budget never fails another's request
+            if not llm_scheduler.spend(user_id):
+                raise BudgetExceeded(f'Gemini budget used up for user {user_id}')
+            task = asyncio.ensure_future(self._evaluate(url, title, probabilities))
+            self._in_flight[url] = task
+            task.add_done_callback(lambda _: self._done(url))
+        if persist:
+            # stored once by the shared call if any of its callers wants it stored
+            self._persist_urls.add(url)
+        # shield so one caller disconnecting does not cancel the call everyone else is waiting on
+        verdicts = await asyncio.shield(task)
+        return verdicts, SOURCE_GEMINI if verdicts is not None else None
+
+    async def evaluate_text(self, text_hash: str, text: str, user_id: Optional[str] = None) -> Optional[Dict[str, bool]]:
+        """
+        Verdicts for every mode and study submode of a page's text, coalesced on its content hash.
+        A new gemini call counts against user_id's budget, raises BudgetExceeded once it is used up.
+        """
+        key = f'text:{text_hash}'
+        task = self._in_flight.get(key)
+        if task is None:
+            if not llm_scheduler.spend(user_id):
+                raise BudgetExceeded(f'Gemini budget used up for user {user_id}')
+            task = asyncio.ensure_future(self._evaluate_text(text))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def _done(self, url) -> None:
+        self._in_flight.pop(url, None)
+        self._persist_urls.discard(url)
+
+    async def _evaluate(self, url, title, probabilities) -> Verdicts:
+        try:
+            verdicts = await self.gemini.call(self._call_gemini, url, title)
+        except asyncio.TimeoutError:
+            logger.warning("Gemini evaluation timed out after %ss", self.timeout, extra={"url": url})
+            return None
+        except CircuitOpenError:
+            logger.debug("Gemini circuit open, not evaluating", extra={"url": url})
+            return None
+        except DependencyError:
+            return None
+        finally:
+            persist = url in self._persist_urls
+
+        if verdicts is not None and probabilities:
+            self.local_classifier.record_outcome(probabilities, verdicts)
+
+        # don't store a verdict we never got
+        if verdicts is not None and persist:
+            await self._persist(url, title, verdicts)
+        return verdicts
+
+    async def _audit(self, url, title, local) -> None:
+        # queued behind everything a user is waiting on, a failed check is simply not counted
+        try:
+            verdicts = await self.gemini_audits.call(self._call_gemini, url, title, Priority.BACKGROUND)
+        except Exception:
+            return
+        self.local_classifier.record_audit(local, verdicts)
+
+    async def _evaluate_text(self, text) -> Optional[Dict[str, bool]]:
+        try:
+            return await self.gemini.call(self._call_gemini_text, text)
+        except asyncio.TimeoutError:
+            logger.warning("Gemini content evaluation timed out after %ss", self.timeout)
+            return None
+        except DependencyError:
+            return None
+
+    async def _call_gemini_text(self, text):
+        async with self._semaphore:
+            verdicts = await evaluate_text_for_all_modes(text)
+        if verdicts is None:
+            # errors are logged and swallowed below us, the breaker still has to count them
+            raise DependencyError('no content verdicts from gemini')
+        return verdicts
+
+    async def _call_gemini(self, url, title, priority=Priority.INTERACTIVE):
+        async with self._semaphore:
+            verdicts = await evaluate_website_for_all_modes(url, title, priority)
+        if verdicts is None:
+            raise DependencyError('no verdicts from gemini')
+        return verdicts
+
+    async def _persist(self, url, title, verdicts):
+        record = WebsiteRecord(url=url, title=title, **{f'{mode}_allowed': verdicts[mode] for mode in MODES})
+        if self.website_writer is not None:
+            # stored with the next batch, the writer's duplicate handling fills in a row that appeared meanwhile
+            self.website_writer.insert({**record.model_dump(), 'timestamp': None})
+            if self.verdict_cache is not None:
+                self.verdict_cache.put(url, record)
+            return
+
+        try:
+            client = get_async_supabase_client()
+            result = await add_website_to_db_async(client, url, title, None,
+                                                   record.study_allowed, record.work_allowed, record.leisure_allowed)
+            if result.get("duplicate"):
+                # someone else stored the row first, only fill in modes that are still unknown
+                await asyncio.gather(*(fill_website_permission_async(client, url, mode, verdicts[mode]) for mode in MODES))
+                if self.verdict_cache is not None:
+                    self.verdict_cache.invalidate(url)
+                return
+            if not result.get("success"):
+                logger.error("Failed to persist verdicts: %s", result.get('error'), extra={"url": url})
+        except Exception:
+            logger.exception("Exception persisting verdicts", extra={"url": url})
+
+        # the full row is known now, so switching modes on this url is a cache hit
+        if self.verdict_cache is not None:
+            self.verdict_cache.put(url, record)
@@ -0,0 +1,278 @@
+"""
+Every Gemini call goes through here.
+
+Each api key gets its own client and model handles, built once, and a token bucket that paces calls
+to the key's quota. Keys are named by their environment variable; variables holding the same key
+share its bucket and queue. Calls waiting for a token are served by priority: tab checks and voice
+commands first, songs someone is waiting for next, background playlist refills last, so a burst of
+refills can't starve classification. A 429 pauses the whole key with exponential backoff and the
+call is retried. Calls made on behalf of a user count against that user's hourly budget.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from typing import Deque, Dict, List, Optional, Tuple
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+
+from metrics import Counter, Histogram, registry
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash')
+# calls per minute per api key (gemini-2.0-flash on tier 1), LLM_RATE_PER_MINUTE_<KEY ENV VAR> overrides it
+# for one key, 0 for no pacing
+LLM_RATE_PER_MINUTE = float(os.getenv('LLM_RATE_PER_MINUTE', '2000'))
+# calls a key may make back to back after being idle
+LLM_BURST = int(os.getenv('LLM_BURST', '20'))
+# gemini calls a single user can cause per hour, 0 for no limit
+LLM_USER_BUDGET_PER_HOUR = int(os.getenv('LLM_USER_BUDGET_PER_HOUR', '200'))
+LLM_USER_BUDGET_MAX_USERS = int(os.getenv('LLM_USER_BUDGET_MAX_USERS', '10000'))
+# retries after a 429, the key pauses for base * 2^attempt seconds (with jitter, capped) before each one
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv('LLM_BACKOFF_BASE_SECONDS', '1'))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv('LLM_BACKOFF_MAX_SECONDS', '30'))
+
+RATE_LIMITED = (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)
+# the google-generativeai release pinned in requirements.txt, the one bind_api_key was checked against
+GENAI_TESTED_VERSION = '0.8.4'
+
+LLM_QUEUE_WAIT = registry.register(Histogram(
+    'gatorguard_llm_queue_wait_seconds', 'Time a gemini call waited for its api key', ('key', 'priority')))
+LLM_RATE_LIMITED = registry.register(Counter(
+    'gatorguard_llm_rate_limited_total', 'Gemini calls answered with a 429', ('key',)))
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # tab checks and voice commands, someone's navigation is waiting
+    USER = 1         # songs for a cold pool, someone asked but can wait a moment
+    BACKGROUND = 2   # playlist refills
+
+
+class LLMError(Exception):
+    pass
+
+
+class MissingAPIKey(LLMError):
+    pass
+
+
+class BudgetExceeded(LLMError):
+    pass
+
+
+class UnsupportedSDK(LLMError):
+    pass
+
+
+def bind_api_key(model: genai.GenerativeModel, api_key: str) -> genai.GenerativeModel:
+    """
+    Make a model handle call gemini with api_key instead of the process wide genai.configure key.
+
+    GenerativeModel takes no client, it builds `_async_client` from the global configuration on
+    first use. We hand it a public generativelanguage client of our own before that happens, and
+    check that the attribute is still there and unset, so an sdk update that changes this fails every
+    call with UnsupportedSDK instead of silently using the wrong key.
+    """
+    if getattr(model, '_async_client', UnsupportedSDK) is not None:
+        raise UnsupportedSDK(f'google-generativeai {genai.__version__} no longer lets a model take its own '
+                             f'client, per-key quotas need {GENAI_TESTED_VERSION}')
+    model._async_client = glm.GenerativeServiceAsyncClient(client_options={'api_key': api_key})
+    return model
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available, 0 if one is."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def drain(self) -> None:
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+
+class _KeyLane:
+    """One api key: its client, its model handles, its bucket and the calls waiting on it."""
+
+    def __init__(self, key_env: str, api_key: str, rate_per_minute: float, burst: int):
+        self.key_env = key_env
+        self.api_key = api_key
+        self.models: Dict[str, genai.GenerativeModel] = {}
+        self.bucket = TokenBucket(rate_per_minute / 60, burst)
+        self.paused_until = 0.0
+        self._waiting: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.dispatched = {priority.name.lower(): 0 for priority in Priority}
+        self.rate_limited = 0
+
+    def model(self, generation_config=None) -> genai.GenerativeModel:
+        handle = repr(generation_config)
+        model = self.models.get(handle)
+        if model is None:
+            # genai.configure is process wide, so a handle gets this key's own client instead of the default one
+            model = bind_api_key(genai.GenerativeModel(GEMINI_MODEL, generation_config=generation_config), self.api_key)
+            self.models[handle] = model
+        return model
+
+    async def acquire(self, priority: Priority) -> None:
+        if self._worker is None or self._worker.done():
+            self._wake = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        queued = time.monotonic()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), queued, future))
+        self._wake.set()
+        await future
+        LLM_QUEUE_WAIT.observe(time.monotonic() - queued, key=self.key_env, priority=priority.name.lower())
+
+    def back_off(self, attempt: int) -> float:
+        self.rate_limited += 1
+        LLM_RATE_LIMITED.inc(key=self.key_env)
+        delay = min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1)
+        # calls already waiting would only hit the same 429, hold the whole key
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.bucket.drain()
+        return delay
+
+    async def _run(self):
+        while True:
+            if not self._waiting:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            delay = max(self.paused_until - time.monotonic(), self.bucket.wait_time())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            # picked when the token is there, so a tab check that came in meanwhile still goes first
+            priority, _, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue  # the caller gave up
+            self.bucket.take()
+            self.dispatched[Priority(priority).name.lower()] += 1
+            future.set_result(None)
+
+    async def stop(self):
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+
+    def stats(self) -> dict:
+        return {
+            "waiting": sum(1 for *_, future in self._waiting if not future.done()),
+            "dispatched": dict(self.dispatched),
+            "rate_limited": self.rate_limited,
+            "paused_for": max(0.0, round(self.paused_until - time.monotonic(), 3)),
+            "rate_per_minute": self.bucket.rate * 60,
+            "models": len(self.models),
+        }
+
+
+class LLMScheduler:
+    def __init__(self, user_budget: int = LLM_USER_BUDGET_PER_HOUR, max_retries: int = LLM_MAX_RETRIES):
+        self.user_budget = user_budget
+        self.max_retries = max_retries
+        # api key -> lane
+        self._lanes: Dict[str, _KeyLane] = {}
+        # user id -> times of their recent calls, least recently active users are forgotten first
+        self._spend: 'OrderedDict[str, Deque[float]]' = OrderedDict()
+        self.over_budget = 0
+
+    def _lane(self, key_env: str) -> _KeyLane:
+        api_key = os.getenv(key_env)
+        if not api_key:
+            raise MissingAPIKey(f'{key_env} is not set')
+        # the quota belongs to the key, not to the variable it was read from
+        lane = self._lanes.get(api_key)
+        if lane is None:
+            rate = float(os.getenv(f'LLM_RATE_PER_MINUTE_{key_env}', LLM_RATE_PER_MINUTE))
+            lane = self._lanes[api_key] = _KeyLane(key_env, api_key, rate, LLM_BURST)
+        return lane
+
+    def spend(self, user_id: Optional[str]) -> bool:
+        """Count a call against the user's budget. False, and nothing counted, if they have used it up."""
+        if not user_id or self.user_budget <= 0:
+            return True
+        now = time.monotonic()
+        calls = self._spend.get(user_id)
+        if calls is None:
+            calls = self._spend[user_id] = deque()
+        self._spend.move_to_end(user_id)
+        while calls and calls[0] <= now - 3600:
+            calls.popleft()
+        while len(self._spend) > LLM_USER_BUDGET_MAX_USERS:
+            self._spend.popitem(last=False)
+        if len(calls) >= self.user_budget:
+            self.over_budget += 1
+            return False
+        calls.append(now)
+        return True
+
+    async def generate(self, key_env: str, prompt, priority: Priority = Priority.INTERACTIVE,
+                       user_id: Optional[str] = None, generation_config=None, stream: bool = False):
+        """
+        generate_content_async on the key named by key_env, once the key's quota and everything more
+        urgent allow it. Raises MissingAPIKey, BudgetExceeded, or the last 429 after LLM_MAX_RETRIES.
+        """
+        lane = self._lane(key_env)
+        if not self.spend(user_id):
+            raise BudgetExceeded(f'Gemini budget of {self.user_budget} calls per hour used up')
+        model = lane.model(generation_config)
+        for attempt in range(self.max_retries + 1):
+            await lane.acquire(priority)
+            try:
+                return await model.generate_content_async(prompt, stream=stream)
+            except RATE_LIMITED:
+                if attempt == self.max_retries:
+                    raise
+                delay = lane.back_off(attempt)
+                logger.warning("Gemini rate limited, retrying in %.1fs", delay, extra={"key": key_env, "attempt": attempt + 1})
+
+    async def stop(self):
+        for lane in self._lanes.values():
+            await lane.stop()
+
+    def stats(self) -> dict:
+        return {
+            "keys": {lane.key_env: lane.stats() for lane in self._lanes.values()},
+            "users_tracked": len(self._spend),
+            "user_budget_per_hour": self.user_budget,
+            "over_budget": self.over_budget,
+        }
+
+
+if genai.__version__ != GENAI_TESTED_VERSION:
+    logger.warning("google-generativeai %s is installed, per-key clients were checked against %s",
+                   genai.__version__, GENAI_TESTED_VERSION)
+
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,247 @@
+"""
+CPU-only pre-classifier that answers obvious websites before we pay for a Gemini call.
+
+Features are hashed tokens/n-grams over the url and title; each mode gets its own logistic
+regression trained with SGD on the labelled rows of the `websites` table. It is only used on
+url + title, the input it is trained and validated on, never on page text. A verdict is only
+returned when every requested mode clears the confidence threshold, everything else is escalated
+to Gemini and used to track how often the local model would have been right. A sample of the
+local answers (LOCAL_CLASSIFIER_AUDIT_RATE) is checked against Gemini in the background, so the
+accuracy of what is actually answered locally is measured too.
+"""
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+from url_rules import canonicalize_url, registered_domain
+from verdict_cache import MODES
+
+load_dotenv()
+
+LOCAL_CLASSIFIER_ENABLED = os.getenv('LOCAL_CLASSIFIER_ENABLED', 'true').lower() == 'true'
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv('LOCAL_CLASSIFIER_THRESHOLD', '0.9'))
+# below this many labelled rows for a mode we never answer locally for it
+LOCAL_CLASSIFIER_MIN_SAMPLES = int(os.getenv('LOCAL_CLASSIFIER_MIN_SAMPLES', '50'))
+# share of local answers that are also sent to gemini to measure their accuracy, 0 to never check
+LOCAL_CLASSIFIER_AUDIT_RATE = float(os.getenv('LOCAL_CLASSIFIER_AUDIT_RATE', '0.05'))
+
+HASH_BUCKETS = 2 ** 20
+MAX_TEXT_TOKENS = 2000
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# (url, title, text, {mode: allowed})
+Sample = Tuple[str, Optional[str], Optional[str], Dict[str, Optional[bool]]]
+
+
+def _bucket(feature: str) -> int:
+    # crc32 instead of hash() so buckets are stable across processes
+    return zlib.crc32(feature.encode()) % HASH_BUCKETS
+
+
+def featurize(url: str, title: Optional[str] = None, text: Optional[str] = None) -> Dict[int, float]:
+    features = []
+    parts = urlsplit(canonicalize_url(url))
+    host = parts.hostname or ''
+    if host:
+        features.append(f'd:{registered_domain(host)}')
+        features.extend(f'h:{label}' for label in host.split('.'))
+        features.extend(f'c:{host[i:i + 3]}' for i in range(len(host) - 2))
+    features.extend(f'p:{token}' for token in TOKEN_RE.findall(parts.path.lower()))
+
+    # title and page text share the word namespace so a model trained on titles still applies to text
+    for words in (title, text):
+        if not words:
+            continue
+        tokens = TOKEN_RE.findall(words.lower())[:MAX_TEXT_TOKENS]
+        features.extend(f'w:{token}' for token in tokens)
+        features.extend(f'b:{a}_{b}' for a, b in zip(tokens, tokens[1:]))
+
+    vector: Dict[int, float] = {}
+    for feature in features:
+        index = _bucket(feature)
+        vector[index] = vector.get(index, 0.0) + 1.0
+    norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+    return {index: value / norm for index, value in vector.items()}
+
+
+def _sigmoid(z: float) -> float:
+    if z < -30:
+        return 0.0
+    if z > 30:
+        return 1.0
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+class _LogisticModel:
+    __slots__ = ('weights', 'bias')
+
+    def __init__(self):
+        self.weights: Dict[int, float] = {}
+        self.bias = 0.0
+
+    def predict(self, x: Dict[int, float]) -> float:
+        weights = self.weights
+        return _sigmoid(self.bias + sum(weights.get(i, 0.0) * v for i, v in x.items()))
+
+    def fit(self, data: List[Tuple[Dict[int, float], bool]], epochs: int, learning_rate: float, l2: float, rng):
+        for _ in range(epochs):
+            rng.shuffle(data)
+            for x, y in data:
+                gradient = self.predict(x) - (1.0 if y else 0.0)
+                for i, v in x.items():
+                    w = self.weights.get(i, 0.0)
+                    self.weights[i] = w - learning_rate * (gradient * v + l2 * w)
+                self.bias -= learning_rate * gradient
+
+
+class LocalClassifier:
+    """Per-mode hashed n-gram logistic regression, plus hit rate / accuracy / latency counters."""
+
+    def __init__(self, threshold: float = LOCAL_CLASSIFIER_THRESHOLD, min_samples: int = LOCAL_CLASSIFIER_MIN_SAMPLES,
+                 enabled: bool = LOCAL_CLASSIFIER_ENABLED, audit_rate: float = LOCAL_CLASSIFIER_AUDIT_RATE):
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.enabled = enabled
+        self.audit_rate = audit_rate
+        self._rng = random.Random()
+        self._models: Dict[str, _LogisticModel] = {}
+        self._lock = threading.Lock()
+        self._training: dict = {}
+        self._calls = 0
+        self._answered = 0
+        self._latency_ns = 0
+        self._shadow_total = {mode: 0 for mode in MODES}
+        self._shadow_correct = {mode: 0 for mode in MODES}
+        self._audit_total = {mode: 0 for mode in MODES}
+        self._audit_correct = {mode: 0 for mode in MODES}
+
+    def train(self, samples: Iterable[Sample], epochs: int = 5, learning_rate: float = 0.5,
+              l2: float = 1e-6, holdout: float = 0.2, seed: int = 0) -> dict:
+        rng = random.Random(seed)
+        samples = list(samples)
+        vectors = [featurize(url, title, text) for url, title, text, _ in samples]
+        models: Dict[str, _LogisticModel] = {}
+        report = {"samples": len(samples), "modes": {}}
+
+        for mode in MODES:
+            data = [(x, flags[mode]) for x, (_, _, _, flags) in zip(vectors, samples) if flags.get(mode) is not None]
+            if len(data) < self.min_samples:
+                report["modes"][mode] = {"trained": False, "samples": len(data)}
+                continue
+            rng.shuffle(data)
+            split = int(len(data) * (1 - holdout))
+            model = _LogisticModel()
+            model.fit(data[:split], epochs, learning_rate, l2, rng)
+            held_out = data[split:]
+            correct = sum((model.predict(x) >= 0.5) == y for x, y in held_out)
+            confident = [(model.predict(x), y) for x, y in held_out]
+            confident = [(p, y) for p, y in confident if self._is_confident(p)]
+            models[mode] = model
+            report["modes"][mode] = {
+                "trained": True,
+                "samples": len(data),
+                "holdout_accuracy": round(correct / len(held_out), 4) if held_out else None,
+                # what the threshold buys us: how often we would answer and how often we'd be right
+                "holdout_coverage": round(len(confident) / len(held_out), 4) if held_out else None,
+                "holdout_confident_accuracy": round(sum((p >= 0.5) == y for p, y in confident) / len(confident), 4)
+                if confident else None,
+            }
+
+        with self._lock:
+            self._models = models
+            self._training = report
+        return report
+
+    def train_from_db(self, supabase, page_size: int = 1000) -> dict:
+        samples: List[Sample] = []
+        while True:
+            response = supabase.from_('websites').select('url,title,study_allowed,work_allowed,leisure_allowed') \
+                .order('url').range(len(samples), len(samples) + page_size - 1).execute()
+            for row in response.data:
+                samples.append((row['url'], row.get('title'), None,
+                                {mode: row.get(f'{mode}_allowed') for mode in MODES}))
+            if len(response.data) < page_size:
+                break
+        return self.train(samples)
+
+    def predict(self, url: str, title: Optional[str] = None, text: Optional[str] = None) -> Dict[str, float]:
+        """Probability that the website is allowed, for every mode that has a trained model."""
+        models = self._models
+        if not models:
+            return {}
+        x = featurize(url, title, text)
+        return {mode: model.predict(x) for mode, model in models.items()}
+
+    def classify(self, url: str, title: Optional[str] = None, text: Optional[str] = None,
+                 modes: Iterable[str] = MODES) -> Tuple[Optional[Dict[str, bool]], Dict[str, float]]:
+        """
+        Returns (verdicts, probabilities). verdicts is None unless every requested mode is confident,
+        the probabilities are handed back to record_outcome once Gemini has answered.
+        """
+        if not self.enabled:
+            return None, {}
+        start = time.perf_counter_ns()
+        probabilities = self.predict(url, title, text)
+        modes = list(modes)
+        verdicts = None
+        if all(mode in probabilities and self._is_confident(probabilities[mode]) for mode in modes):
+            verdicts = {mode: probabilities[mode] >= 0.5 for mode in modes}
+        with self._lock:
+            self._calls += 1
+            self._answered += verdicts is not None
+            self._latency_ns += time.perf_counter_ns() - start
+        return verdicts, probabilities
+
+    def record_outcome(self, probabilities: Dict[str, float], verdicts: Dict[str, bool]) -> None:
+        # shadow accuracy on escalated cases: would the local model have agreed with gemini?
+        with self._lock:
+            for mode, probability in probabilities.items():
+                if mode in verdicts:
+                    self._shadow_total[mode] += 1
+                    self._shadow_correct[mode] += (probability >= 0.5) == verdicts[mode]
+
+    def should_audit(self) -> bool:
+        """Whether a local answer should also be checked against gemini."""
+        return self.audit_rate > 0 and self._rng.random() < self.audit_rate
+
+    def record_audit(self, local: Dict[str, bool], verdicts: Dict[str, bool]) -> None:
+        # accuracy of answers we actually gave: how often gemini agreed with a local verdict
+        with self._lock:
+            for mode, allowed in local.items():
+                if mode in verdicts:
+                    self._audit_total[mode] += 1
+                    self._audit_correct[mode] += allowed == verdicts[mode]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "threshold": self.threshold,
+                "trained_modes": sorted(self._models),
+                "training": self._training,
+                "calls": self._calls,
+                "answered_locally": self._answered,
+                "hit_rate": round(self._answered / self._calls, 4) if self._calls else None,
+                "avg_latency_us": round(self._latency_ns / self._calls / 1000, 2) if self._calls else None,
+                "escalated_accuracy": {
+                    mode: round(self._shadow_correct[mode] / self._shadow_total[mode], 4)
+                    if self._shadow_total[mode] else None for mode in MODES
+                },
+                "audit_rate": self.audit_rate,
+                "audited": dict(self._audit_total),
+                "local_accuracy": {
+                    mode: round(self._audit_correct[mode] / self._audit_total[mode], 4)
+                    if self._audit_total[mode] else None for mode in MODES
+                },
+            }
+
+    def _is_confident(self, probability: float) -> bool:
+        return probability >= self.threshold or probability <= 1 - self.threshold
@@ -1,20 +1,71 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Dict
+import asyncio
 import datetime
+import json
 import uvicorn  
-from supabase import create_client
-from supabase_client import check_if_exists, retrieve_permission, add_website_to_db, SUPABASE_KEY, SUPABASE_URL, add_user_mode,update_user_mode, check_if_user_exists
-import google.generativeai as genai
+from contextlib import asynccontextmanager
+from supabase_client import WebsiteRecord, get_website_async, get_websites_async, fill_website_permission_async, get_supabase_client, init_supabase_client, close_supabase_client, get_async_supabase_client, init_async_supabase_client, close_async_supabase_client, check_supabase_health
 from dotenv import load_dotenv
-from song_output import router
+from song_output import router, playlist_pool, warm_pool_keys, track_cache
+from utils.spotify_helper import spotify_async_client
+from verdict_cache import MODES, VerdictCache
+from evaluation_service import SOURCE_LOCAL, EvaluationService, verdict_key
+from url_rules import RuleIndex, canonicalize_url
+from local_classifier import LocalClassifier
+from content_cache import ContentVerdictCache, extract_truncated_json_string, fingerprint, fit_to_budget
+from user_mode_service import ModeData, user_mode_cache, load_user_mode, user_exists, set_user_mode, refresh_user_mode
+from voice_assistant import router as voice_router
+import threading
+from starlette.concurrency import run_in_threadpool
 import os
+import logging
+from log_config import setup_logging, stop_logging
+from metrics import MetricsMiddleware, registry
+from llm_scheduler import BudgetExceeded, llm_scheduler
+from website_writer import WebsiteWriter
+from resilience import VERDICT_WAIT_SECONDS, DependencyError, db_dependency, dependency_stats, fallback_verdict
 
 load_dotenv()
-app = FastAPI()
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# fill every mode's playlist pool at startup (about 40 gemini calls) instead of on its first /generate-songs call
+PLAYLIST_POOL_WARM_ON_START = os.getenv('PLAYLIST_POOL_WARM_ON_START', 'false').lower() == 'true'
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled supabase client for the whole app instead of one per request
+    client = init_supabase_client()
+    # request handlers use the async client, the sync one is left to startup and background jobs
+    init_async_supabase_client()
+    health = check_supabase_health(client)
+    if not health["healthy"]:
+        logger.warning("Supabase health check failed on startup: %s", health['error'])
+    load_website_rules(client)
+    if local_classifier.enabled:
+        # training scans the whole websites table, don't hold up startup for it
+        threading.Thread(target=train_local_classifier, args=(client,), daemon=True).start()
+    playlist_pool.start(warm_pool_keys() if PLAYLIST_POOL_WARM_ON_START else ())
+    website_writer.start()
+    yield
+    # buffered rows still need the database client
+    await website_writer.stop()
+    await playlist_pool.stop()
+    await llm_scheduler.stop()
+    await close_async_supabase_client()
+    await spotify_async_client.aclose()
+    close_supabase_client()
+    stop_logging()
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(router)
+# voice commands switch modes in-process instead of posting back to /received-mode/
+app.include_router(voice_router)
 # Configure CORS to allow requests from your Chrome extension
 app.add_middleware(
     CORSMiddleware,
@@ -23,6 +74,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# in-flight counts and response times per endpoint, see /metrics
+app.add_middleware(MetricsMiddleware, routes=lambda: app.routes)
 
 # Model for received link data
 class LinkData(BaseModel):
@@ -30,9 +83,17 @@ class LinkData(BaseModel):
     title: Optional[str] = None
     timestamp: Optional[str] = None
     mode: str
+    # gemini calls this check causes count against the user's budget
+    user_id: Optional[str] = None
 
 # Model for received text content
 class TextContent(BaseModel):
+    # metadata goes before text_content so it survives a body cut off at TEXT_CONTENT_MAX_BYTES
+    url: Optional[str] = None
+    title: Optional[str] = None
+    mode: Optional[str] = None
+    submode: Optional[str] = None
+    user_id: Optional[str] = None
     text_content: str
 
 class DBEntry(BaseModel):
@@ -60,29 +121,106 @@ class SongResponse(BaseModel):
 class WebsiteCheckRequest(BaseModel):
     url: str
 
-class ModeData(BaseModel):
-    user_id: str
-    mode: str
-    submode: Optional[str] = None
+class LinkBatch(BaseModel):
+    links: List[LinkData]
+
+MAX_BATCH_LINKS = int(os.getenv('MAX_BATCH_LINKS', '100'))
+# gemini evaluations a single batch may have running at once (the evaluation service also caps globally)
+BATCH_EVAL_CONCURRENCY = int(os.getenv('BATCH_EVAL_CONCURRENCY', '4'))
+
+# bodies past this many bytes are cut off while reading rather than parsed in full
+TEXT_CONTENT_MAX_BYTES = int(os.getenv('TEXT_CONTENT_MAX_BYTES', str(256 * 1024)))
+
+# comment lines sent on an idle mode event stream so proxies don't close it
+USER_MODE_SSE_HEARTBEAT_SECONDS = float(os.getenv('USER_MODE_SSE_HEARTBEAT_SECONDS', '15'))
 
 # Store links in memory (in real app, use a database)
 received_links = []
 
 songs=[]
 
+# per-url verdicts for every mode, checked before going to supabase or gemini
+verdict_cache = VerdictCache()
+
+# page text verdicts by content hash, with simhash lookups for near-duplicate pages
+content_cache = ContentVerdictCache()
+
+# answers obvious websites on the cpu and escalates the rest to gemini
+local_classifier = LocalClassifier()
+
+async def fill_duplicate_websites(rows):
+    # a row for the url was stored between our lookup and the flush: keep its verdicts, only fill the unknown ones
+    client = get_async_supabase_client()
+    for row in rows:
+        await asyncio.gather(*(fill_website_permission_async(client, row["url"], mode, row[f"{mode}_allowed"])
+                               for mode in MODES if row.get(f"{mode}_allowed") is not None))
+        verdict_cache.invalidate(row["url"])
+
+# buffers new and updated `websites` rows and writes them in bulk off the request path
+website_writer = WebsiteWriter(on_duplicate=fill_duplicate_websites)
+
+# coalesces concurrent gemini evaluations of the same url
+evaluation_service = EvaluationService(verdict_cache=verdict_cache, local_classifier=local_classifier,
+                                       website_writer=website_writer)
+
+# exact url / path prefix / domain / pattern rules answered from memory before anything else
+rule_index = RuleIndex()
+
+# urls whose stale cache entry is being re-read from the db, at most one read per url at a time
+verdict_refreshes: Dict[str, asyncio.Task] = {}
+
+def content_cache_metrics():
+    stats = content_cache.stats()
+    return {"hits": stats["exact_hits"] + stats["near_duplicate_hits"], "misses": stats["misses"], "size": stats["size"]}
+
+def playlist_pool_metrics():
+    stats = playlist_pool.stats()
+    return {"hits": stats["served_from_pool"], "misses": stats["pool_misses"]}
+
+def local_classifier_metrics():
+    stats = local_classifier.stats()
+    return {"hits": stats["answered_locally"], "misses": stats["calls"] - stats["answered_locally"]}
+
+# hit rates on /metrics come from the counters each cache already keeps
+registry.register_cache("verdict", verdict_cache.stats)
+registry.register_cache("content", content_cache_metrics)
+registry.register_cache("user_mode", user_mode_cache.stats)
+registry.register_cache("track", track_cache.stats)
+registry.register_cache("playlist_pool", playlist_pool_metrics)
+registry.register_cache("local_classifier", local_classifier_metrics)
+
+def load_website_rules(client):
+    # built on the side and swapped in whole, so requests during a reload keep the old rules
+    global rule_index
+    index = RuleIndex()
+    try:
+        logger.info("Loaded %d website rules from file", index.load_file())
+        if os.getenv('WEBSITE_RULES_LOAD_DB', 'true').lower() == 'true':
+            logger.info("Loaded %d website rules from the database", index.load_from_db(client))
+    except Exception:
+        logger.exception("Error loading website rules")
+        return
+    rule_index = index
+
+def train_local_classifier(client):
+    try:
+        report = local_classifier.train_from_db(client)
+        logger.info("Trained local classifier", extra={"report": report})
+    except Exception:
+        logger.exception("Error training local classifier")
+
 @app.get("/")
 def read_root():
     return {"status": "online", "message": "FastAPI backend for Chrome extension"}
 
 @app.post("/received-link")
-def receive_link(link_data: LinkData):
+async def receive_link(link_data: LinkData):
     # Add timestamp if not provided
     if not link_data.timestamp:
         link_data.timestamp = datetime.datetime.now().isoformat()
     
-    # Log to console
-    print(f"Received link: {link_data.url}, Title: {link_data.title}, Current mode: {link_data.mode}")
-    is_website_allowed = process_link(link_data)
+    logger.debug("Received link", extra={"url": link_data.url, "mode": link_data.mode})
+    is_website_allowed = await process_link(link_data)
 
     return {"allowed": is_website_allowed}
     '''
@@ -91,81 +229,273 @@ def receive_link(link_data: LinkData):
     { not exist in db -> schema TBD }
     '''
 
-def process_link(link_data: LinkData):
+async def process_link(link_data: LinkData):
     try:
-        client = create_client(supabase_url=SUPABASE_URL, supabase_key=SUPABASE_KEY)
-        if check_if_exists(client, link_data.url):
-            return retrieve_permission(client, link_data.url, link_data.mode)  # Use the correct mode
-        
-        return evaluate_website_for_mode(link_data.url, link_data.title, link_data.mode)
+        url = canonicalize_url(link_data.url)
+        allowed = rule_index.lookup(url).get(link_data.mode)
+        if allowed is not None:
+            return allowed
+
+        # an expired row is still a better answer than waiting on the db, it is re-read in the background
+        cached = verdict_cache.get(url, allow_stale=True)
+        if cached is not None and cached.stale:
+            refresh_verdict(url, link_data.url)
+        if cached is None:
+            try:
+                cached = await read_verdict(url, link_data.url)
+            except (asyncio.TimeoutError, DependencyError) as e:
+                logger.warning("Database unavailable for link check: %r", e, extra={"url": url})
+                return fallback_verdict(link_data.mode, "db")
+
+        if link_data.mode not in cached.verdicts:
+            return False
 
-    except Exception as e:
-        print(f'Error: {e}')
-        return False
+        allowed = cached.verdicts[link_data.mode]  # Use the correct mode
+        if allowed is not None:
+            return allowed
+
+        # unknown for this mode, one gemini call classifies every mode and the full row is stored in the db.
+        # the tab only waits so long for it, a late answer still lands in the cache for the next check
+        try:
+            verdicts, _ = await asyncio.wait_for(evaluation_service.evaluate(url, link_data.title, user_id=link_data.user_id),
+                                                 timeout=VERDICT_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            verdicts = None
+        except BudgetExceeded:
+            logger.info("Gemini budget used up", extra={"user_id": link_data.user_id})
+            return fallback_verdict(link_data.mode, "budget")
+        if verdicts is None:
+            return fallback_verdict(link_data.mode, "gemini")
+        return verdicts[link_data.mode]
+
+    except Exception:
+        logger.exception("Error processing link", extra={"url": link_data.url})
+        return fallback_verdict(link_data.mode, "error")
+
+async def read_verdict(url, raw_url):
+    record = await db_dependency.call(get_website_async, get_async_supabase_client(), url, raw_url)
+    if record is not None:
+        return verdict_cache.put(url, record)
+    return verdict_cache.put_missing(url)
+
+def refresh_verdict(url, raw_url):
+    if url in verdict_refreshes:
+        return
+
+    async def refresh():
+        try:
+            await read_verdict(url, raw_url)
+        except Exception as e:
+            # keep answering from the stale row until the db is back or the row ages out
+            logger.warning("Could not refresh stale verdict: %r", e, extra={"url": url})
+
+    task = asyncio.ensure_future(refresh())
+    verdict_refreshes[url] = task
+    task.add_done_callback(lambda _: verdict_refreshes.pop(url, None))
+
+@app.post("/received-links/batch")
+async def receive_links_batch(batch: LinkBatch, stream: bool = False):
+    """
+    Classify many tabs at once. Known urls are answered from memory or one in_() query, unknown
+    urls are evaluated once each with bounded parallelism. Results come back in input order, or
+    as NDJSON lines ({"index", "url", "allowed"}) in completion order when stream=true.
+    """
+    links = batch.links
+    if len(links) > MAX_BATCH_LINKS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_LINKS} links per batch")
+    logger.debug("Received batch of %d links", len(links))
+
+    urls = [canonicalize_url(link.url) for link in links]
+    results: List[Optional[bool]] = [None] * len(links)
+
+    # rule index and verdict cache first, anything left goes to the db in a single query
+    cached = {}
+    for i, (link, url) in enumerate(zip(links, urls)):
+        results[i] = rule_index.lookup(url).get(link.mode)
+        if results[i] is None and url not in cached:
+            cached[url] = verdict_cache.get(url, allow_stale=True)
+            if cached[url] is not None and cached[url].stale:
+                refresh_verdict(url, link.url)
+
+    missing = [url for url, entry in cached.items() if entry is None]
+    if missing:
+        # rows stored before canonicalization are found by their raw url, only ask for it when it differs
+        missing_set = set(missing)
+        raw_urls = [link.url for link, url in zip(links, urls) if url in missing_set and link.url != url]
+        try:
+            records = await db_dependency.call(get_websites_async, get_async_supabase_client(), missing + raw_urls)
+            for link, url in zip(links, urls):
+                if cached.get(url, True) is not None:
+                    continue
+                record = records.get(url) or records.get(link.url)
+                cached[url] = verdict_cache.put(url, record) if record is not None else verdict_cache.put_missing(url)
+        except Exception:
+            logger.exception("Error looking up batch in database")
+
+    # dedupe what still needs gemini, one evaluation per url no matter how many tabs share it
+    pending = {}
+    for i, (link, url) in enumerate(zip(links, urls)):
+        if results[i] is not None:
+            continue
+        entry = cached.get(url)
+        if entry is None:
+            results[i] = fallback_verdict(link.mode, "db")
+        elif link.mode not in entry.verdicts:
+            results[i] = False
+        elif entry.verdicts[link.mode] is not None:
+            results[i] = entry.verdicts[link.mode]
+        else:
+            pending.setdefault(url, []).append(i)
+
+    semaphore = asyncio.Semaphore(BATCH_EVAL_CONCURRENCY)
+
+    async def evaluate(url):
+        async with semaphore:
+            first = links[pending[url][0]]
+            try:
+                verdicts, _ = await evaluation_service.evaluate(url, first.title, user_id=first.user_id)
+                return url, verdicts
+            except Exception:
+                logger.exception("Error evaluating link in batch", extra={"url": url})
+                return url, None
+
+    def resolve(url, verdicts):
+        for i in pending[url]:
+            results[i] = verdicts[links[i].mode] if verdicts is not None else fallback_verdict(links[i].mode, "gemini")
+        return pending[url]
+
+    tasks = [asyncio.ensure_future(evaluate(url)) for url in pending]
+
+    if not stream:
+        for url, verdicts in await asyncio.gather(*tasks):
+            resolve(url, verdicts)
+        return {"results": [{"url": link.url, "allowed": allowed} for link, allowed in zip(links, results)]}
 
-@app.post("/received-text-content")
-def receive_text_content(text_content: TextContent):
-    print(f"Received text content: {text_content.text_content}")
-    is_website_allowed = process_text_content(text_content)
+    async def ndjson():
+        try:
+            # early answers go out straight away instead of waiting behind slow llm calls
+            for i, allowed in enumerate(results):
+                if allowed is not None:
+                    yield json.dumps({"index": i, "url": links[i].url, "allowed": allowed}) + "\n"
+            for next_done in asyncio.as_completed(tasks):
+                url, verdicts = await next_done
+                for i in resolve(url, verdicts):
+                    yield json.dumps({"index": i, "url": links[i].url, "allowed": results[i]}) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@app.post(
+    "/received-text-content",
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": TextContent.model_json_schema()}}}},
+)
+async def receive_text_content(request: Request):
+    text_content = await read_text_content(request)
+    logger.debug("Received text content", extra={"url": text_content.url, "characters": len(text_content.text_content)})
+    is_website_allowed = await process_text_content(text_content)
 
     return {"allowed": is_website_allowed}
 
-def process_text_content(text_content: TextContent):
-    try:
-        print("Processing text content...")
-        client = create_client(supabase_url=SUPABASE_URL, supabase_key=SUPABASE_KEY)      
-        api_key = os.getenv('GEMINI_API_KEY')
-        genai.configure(api_key=api_key)  
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        query = f'''
-            A browser user is currently trying to study. They just visited a website with this content: {text_content.text_content}. 
-            Do you think this website is appropriate for a study environment? Ignore whether or not it is allowed 
-            for mature audiences, simply tell me if this website is related to studying material or not with a True/False answer.
-        '''
-        print("Sending query to Gemini model...")
-        response = model.generate_content(query)
-        print(f"Gemini response: {response.text}")  # Log the response for debugging
-        response_text = response.text.strip().lower()
-        print(f"Processed response text: {response_text}")
-        return response_text == "true"
-    except Exception as e:
-        print(f'Error in processing text content: {e}')
-        return False
+async def read_text_content(request: Request) -> TextContent:
+    # read the body as a stream and stop at the byte cap instead of letting pydantic materialize all of it
+    body = bytearray()
+    truncated = False
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > TEXT_CONTENT_MAX_BYTES:
+            truncated = True
+            break
 
+    try:
+        if not truncated:
+            return TextContent(**json.loads(body))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid text content body: {str(e)}")
+
+    body = bytes(body[:TEXT_CONTENT_MAX_BYTES])
+    text = extract_truncated_json_string(body, "text_content")
+    if text is None:
+        raise HTTPException(status_code=413, detail="Text content too large")
+    logger.info("Text content body over %d bytes, keeping the first part", TEXT_CONTENT_MAX_BYTES)
+    metadata = {field: extract_truncated_json_string(body, field, partial=False)
+                for field in ("url", "title", "mode", "submode", "user_id")}
+    return TextContent(text_content=text, **metadata)
+
+def normalize_mode_name(value: Optional[str]) -> Optional[str]:
+    # "School" and "school " are the same submode, blank is no submode
+    if not value:
+        return None
+    return value.strip().lower() or None
+
+async def resolve_text_content_mode(text_content: TextContent):
+    # explicit mode wins, then the user's saved mode, then study (what this endpoint always assumed)
+    if text_content.mode:
+        return normalize_mode_name(text_content.mode), normalize_mode_name(text_content.submode)
+    if text_content.user_id:
+        cached = await load_user_mode(get_async_supabase_client(), text_content.user_id)
+        # a user_mode row can exist with no mode selected yet
+        if cached and cached.get("mode"):
+            return normalize_mode_name(cached["mode"]), normalize_mode_name(cached.get("submode"))
+    return "study", normalize_mode_name(text_content.submode)
+
+async def process_text_content(text_content: TextContent):
+    try:
+        mode, submode = await resolve_text_content_mode(text_content)
+    except Exception:
+        logger.exception("Error loading user mode for text content", extra={"user_id": text_content.user_id})
+        # without the saved mode there is no telling which policy applies, fail closed
+        return fallback_verdict("unknown", "db")
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mode: {mode}. Valid modes are: {MODES}")
+    key = verdict_key(mode, submode)
 
-@app.post("/generate-songs")
-def process_song_link():
     try:
-        GENAI_API_KEY=os.getenv("GEMINI_API_KEY_2")
-        if not(GENAI_API_KEY):
-            raise HTTPException(status_code=400, detail="No API key found")
-        genai.configure(api_key=GENAI_API_KEY)
-        client=genai.GenerativeModel('gemini-2.0-flash')
-
-        query=f"""
-           Recommend 5 songs related to "study mode" with a focus on concentration for interview study.
-           Only include songs with non-lyrics
-           Generate me a new response, don't repeat the previous songs.: 
-           Title - Artist - time length- Spotify Link
- 
-        """
-        #Note: Find a way to make it run when the person clicks
-
-        response=client.generate_content(query)
-
-        #Psuedo code for reload
-        # IF reload == True
-        #Generate new songs and remove the previous songs in the list 
-        parts=response.text.strip().lower()
-
-        #Note: Find a way to make it run when the person clicks
-        
-        evaluation=parts=="true"
+        text_hash, text_simhash = await run_in_threadpool(fingerprint, text_content.text_content)
+        cached = content_cache.get(text_hash, text_simhash)
+        if cached is not None and key in cached:
+            return cached[key]
+
+        # long pages are sampled down to the token budget, the model doesn't need every word to judge them
+        text = fit_to_budget(text_content.text_content)
+
+        # no local classifier here: it is trained and thresholded on url + title only, never on page text
+        # one call answers every mode and submode, so a later mode switch on this page is a cache hit
+        verdicts = await evaluation_service.evaluate_text(text_hash, text, text_content.user_id)
+        if verdicts is None:
+            return fallback_verdict(mode, "gemini")
+        content_cache.put(text_hash, text_simhash, verdicts)
+        if text_content.url:
+            await store_content_verdicts(text_content, verdicts)
+        return verdicts[key]
+    except BudgetExceeded:
+        logger.info("Gemini budget used up", extra={"user_id": text_content.user_id})
+        return fallback_verdict(mode, "budget")
+    except Exception:
+        logger.exception("Error processing text content", extra={"url": text_content.url})
+        return fallback_verdict(mode, "error")
+
+async def store_content_verdicts(text_content: TextContent, verdicts):
+    # the page's content is better evidence than its url and title, so it overwrites the stored row
+    url = canonicalize_url(text_content.url)
+    record = WebsiteRecord(url=url, title=text_content.title, **{f"{mode}_allowed": verdicts[mode] for mode in MODES})
+    verdict_cache.put(url, record)
+    rule_index.discard_exact(url)
+
+    stored_url = url
+    if text_content.url != url and not website_writer.is_pending(url):
+        # rows stored before canonicalization keep their raw url, overwrite that one instead of adding a second row
+        try:
+            existing = await db_dependency.call(get_website_async, get_async_supabase_client(), url, text_content.url)
+        except Exception as e:
+            # not knowing which row holds the page, leave the db alone, the cache answers for it meanwhile
+            logger.warning("Could not look up the stored row for content verdicts: %r", e, extra={"url": url})
+            return
+        if existing is not None:
+            stored_url = existing.url
+    website_writer.upsert({**record.model_dump(), "url": stored_url, "timestamp": datetime.datetime.now().isoformat()})
 
-        return bool(evaluation)
-    except Exception as e:
-        print(f'Error in processing text content: {e}')
-        return False
 
 @app.get("/received-songs")
 def get_received_songs() -> SongResponse:
@@ -173,195 +503,255 @@ def get_received_songs() -> SongResponse:
 
   
 @app.post('/add-website-to-db/')
-def add_db_entry(db_entry: DBEntry):
+async def add_db_entry(db_entry: DBEntry):
     try:
-        client = create_client(supabase_url=SUPABASE_URL, supabase_key=SUPABASE_KEY)
-        
-        # Check if website exists
-        exists = check_if_exists(client, db_entry.url)
+        client = get_async_supabase_client()
+        raw_url = db_entry.url
+        db_entry.url = canonicalize_url(raw_url)
         
-        if exists:
-            # Create update dictionary with only the fields that are provided
-            update_data = {"timestamp": db_entry.timestamp}
-            
-            # Only add fields that are explicitly provided
-            if db_entry.study_allowed is not None:
-                update_data["study_allowed"] = db_entry.study_allowed
-                
-            if db_entry.work_allowed is not None:
-                update_data["work_allowed"] = db_entry.work_allowed
-                
-            if db_entry.leisure_allowed is not None:
-                update_data["leisure_allowed"] = db_entry.leisure_allowed
-            
-            # Update the existing entry with only the provided fields
-            response = client.from_('websites').update(update_data).eq('url', db_entry.url).execute()
-            
-            if response.data:
-                return {
-                    "success": True,
-                    "message": "Entry updated in DB"
-                }
-            else:
-                return {
-                    "success": False,
-                    "errorMessage": "Failed to update entry"
-                }
+        # Check if website exists, a row still waiting in the write buffer is only in the cache
+        cached = verdict_cache.get(db_entry.url) if website_writer.is_pending(db_entry.url) else None
+        if cached is not None and cached.exists:
+            existing = WebsiteRecord(url=db_entry.url, **{f"{mode}_allowed": cached.verdicts.get(mode) for mode in MODES})
         else:
-            # For new entries, evaluate missing permissions using Gemini
-            study_allowed = db_entry.study_allowed
-            work_allowed = db_entry.work_allowed
-            leisure_allowed = db_entry.leisure_allowed
-            
-            # Evaluate any missing permissions
+            existing = await get_website_async(client, db_entry.url, raw_url)
+        
+        if existing is not None:
+            # rows stored before canonicalization keep their original url
+            db_entry.url = existing.url
+            return update_db_entry(db_entry, existing)
+
+        # For new entries, evaluate missing permissions using Gemini
+        study_allowed = db_entry.study_allowed
+        work_allowed = db_entry.work_allowed
+        leisure_allowed = db_entry.leisure_allowed
+
+        # Evaluate any missing permissions with a single gemini call, the row is inserted below so don't persist it there
+        if None in (study_allowed, work_allowed, leisure_allowed):
+            verdicts, source = await evaluation_service.evaluate(db_entry.url, db_entry.title, persist=False)
+            if source == SOURCE_LOCAL:
+                # a stored guess would be trained on and loaded as a rule, leave those modes for gemini to fill in
+                verdicts = {"study": None, "work": None, "leisure": None}
+            elif verdicts is None:
+                # gemini failed, fall back to blocking the unknown modes
+                verdicts = {"study": False, "work": False, "leisure": False}
+
             if study_allowed is None:
-                study_allowed = evaluate_website_for_mode(db_entry.url, db_entry.title, "study")
-                
+                study_allowed = verdicts["study"]
+
             if work_allowed is None:
-                work_allowed = evaluate_website_for_mode(db_entry.url, db_entry.title, "work")
-                
+                work_allowed = verdicts["work"]
+
             if leisure_allowed is None:
-                leisure_allowed = evaluate_website_for_mode(db_entry.url, db_entry.title, "leisure")
-            
-            # Insert new entry with evaluated permissions
-            result = add_website_to_db(
-                client, 
-                db_entry.url, 
-                db_entry.title, 
-                db_entry.timestamp, 
-                study_allowed,
-                work_allowed,
-                leisure_allowed
-            )
-            
-            if not result.get("success", False):
-                return {
-                    "success": False,
-                    "errorMessage": result.get("error", "Unknown database error")
-                }
-                
-            return { "success": True }
+                leisure_allowed = verdicts["leisure"]
+
+        # Insert new entry with evaluated permissions, written with the next batch
+        record = WebsiteRecord(url=db_entry.url, title=db_entry.title, study_allowed=study_allowed,
+                               work_allowed=work_allowed, leisure_allowed=leisure_allowed)
+        website_writer.insert({**record.model_dump(), "timestamp": db_entry.timestamp})
+        # lookups are answered from the cache until the row is flushed
+        verdict_cache.put(db_entry.url, record)
+        rule_index.discard_exact(db_entry.url)
+
+        return { "success": True }
         
     except Exception as e:
-        print(f"Exception in add_db_entry endpoint: {str(e)}")
+        logger.exception("Error adding website to db", extra={"url": db_entry.url})
         return {
             "success": False,
             "errorMessage": str(e),
         }
+
+def update_db_entry(db_entry: DBEntry, existing: WebsiteRecord):
+    # Create update dictionary with only the fields that are provided
+    update_data = {"url": db_entry.url, "timestamp": db_entry.timestamp}
+    
+    # Only add fields that are explicitly provided
+    if db_entry.study_allowed is not None:
+        update_data["study_allowed"] = db_entry.study_allowed
+        
+    if db_entry.work_allowed is not None:
+        update_data["work_allowed"] = db_entry.work_allowed
+        
+    if db_entry.leisure_allowed is not None:
+        update_data["leisure_allowed"] = db_entry.leisure_allowed
+    
+    # Update the existing entry with only the provided fields, written with the next batch
+    website_writer.upsert(update_data)
+    verdict_cache.put(canonicalize_url(db_entry.url), existing.model_copy(update={key: value for key, value in update_data.items() if key != "timestamp"}))
+    rule_index.discard_exact(db_entry.url)
+
+    return {
+        "success": True,
+        "message": "Entry updated in DB"
+    }
     
 @app.post("/received-mode/")
 async def receive_browsing_mode(mode_data: ModeData):
     try:
-        print(f'Received mode: {mode_data.mode}, Submode: {mode_data.submode}, User ID: {mode_data.user_id}')
-        
-        client = create_client(supabase_url=SUPABASE_URL, supabase_key=SUPABASE_KEY)
-        
-        # Check if user mode already exists
-        try:
-            print(f"Checking if user mode exists for ID: {mode_data.user_id}")
-            response = client.from_('user_mode').select('*').eq('id', mode_data.user_id).execute()
-            print(f"Response data: {response.data}")
-            
-            if response.data and len(response.data) > 0:
-                print("User mode exists, updating...")
-                # Update existing user mode
-                result = update_user_mode(client, mode_data.user_id, mode_data.mode, mode_data.submode)
-            else:
-                print("User mode does not exist, adding...")
-                # Add new user mode
-                result = add_user_mode(client, mode_data.user_id, mode_data.mode, mode_data.submode)
-            
-            if result is True:
-                return {"success": True, "message": "User mode updated successfully"}
-            else:
-                return {"success": False, "error": str(result)}
-        except Exception as e:
-            print(f"Error checking user mode: {str(e)}")
-            return {"success": False, "error": f"Error checking user mode: {str(e)}"}
+        logger.debug("Received mode", extra={"user_id": mode_data.user_id, "mode": mode_data.mode, "submode": mode_data.submode})
+        return await set_user_mode(get_async_supabase_client(), mode_data)
             
     except Exception as e:
-        print(f"Error updating user mode: {str(e)}")
+        logger.exception("Error updating user mode", extra={"user_id": mode_data.user_id})
         return {"success": False, "error": str(e)}
 
 
 @app.get("/user-mode/{user_id}")
-def get_user_mode(user_id: str):
+async def get_user_mode(user_id: str):
     """Get current mode for a specific user"""
     try:
-        client = create_client(supabase_url=SUPABASE_URL, supabase_key=SUPABASE_KEY)
+        cached = user_mode_cache.get(user_id)
+        if cached is not None:
+            return {"success": True, **cached}
+
+        client = get_async_supabase_client()
         
         # Check if user exists
-        if not check_if_user_exists(client, user_id):
+        if not await user_exists(client, user_id):
             return {"success": False, "error": f"User {user_id} does not exist"}
             
         # Get the user's mode from the database
-        response = client.from_('user_mode').select('mode_select,study_submode_select').eq('id', user_id).limit(1).execute()
+        cached = await load_user_mode(client, user_id)
         
-        if response.data and len(response.data) > 0:
-            return {
-                "success": True,
-                "mode": response.data[0]["mode_select"],
-                "submode": response.data[0].get("study_submode_select")
-            }
+        if cached:
+            return {"success": True, **cached}
         else:
             return {"success": False, "error": "User mode not found"}
             
     except Exception as e:
-        print(f"Error getting user mode: {str(e)}")
+        logger.exception("Error getting user mode", extra={"user_id": user_id})
         return {"success": False, "error": str(e)}
 
 
-def evaluate_website_for_mode(url, title, mode):
+@app.post("/user-mode/{user_id}/refresh")
+async def refresh_mode(user_id: str):
+    """Re-read a mode saved outside the backend and push it to the user's event streams"""
     try:
-        print(f"Evaluating website for {mode} mode: {url}")
-        api_key = os.getenv('GEMINI_API_KEY')
-        
-        if not api_key:
-            print("Missing Gemini API key")
-            return False
-            
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        query = f'''
-            A browser user is currently in {mode} mode. They just visited a website with this url: {url} and this title:
-            {title or url}. Do you think this website is appropriate for a {mode} environment? Ignore whether or not it is allowed 
-            for mature audiences, simply tell me if this website is related to {mode} material or not with a True/False answer.
-        '''
-        
-        response = model.generate_content(query)
-        response_text = response.text.strip().lower()
-        print(f"Gemini evaluation for {mode} mode: {response_text}")
-        
-        return response_text == "true"
+        mode = await refresh_user_mode(get_async_supabase_client(), user_id)
+        if mode is None:
+            return {"success": False, "error": "User mode not found"}
+        return {"success": True, **mode}
     except Exception as e:
-        print(f"Error evaluating website for {mode}: {str(e)}")
-        return False
+        # the next read has to go to the db
+        user_mode_cache.invalidate(user_id)
+        logger.exception("Error refreshing user mode", extra={"user_id": user_id})
+        return {"success": False, "error": str(e)}
+
+
+def mode_event(mode: dict) -> str:
+    return f"event: mode\ndata: {json.dumps(mode)}\n\n"
+
+@app.get("/user-mode/{user_id}/events")
+async def stream_user_mode(user_id: str):
+    """Server-sent events: the current mode right away, then one `mode` event per change."""
+    async def events():
+        # subscribe before reading the current mode so a change in between isn't lost
+        queue = user_mode_cache.subscribe(user_id)
+        try:
+            try:
+                current = await load_user_mode(get_async_supabase_client(), user_id)
+            except Exception:
+                logger.exception("Error loading mode for event stream", extra={"user_id": user_id})
+                current = None
+            if current:
+                yield mode_event(current)
+            while True:
+                try:
+                    mode = await asyncio.wait_for(queue.get(), timeout=USER_MODE_SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield mode_event(mode)
+        finally:
+            user_mode_cache.unsubscribe(user_id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 @app.post("/check-website-exists")
-def check_website_exists(request: WebsiteCheckRequest):
+async def check_website_exists(request: WebsiteCheckRequest):
     try:
-        client = create_client(supabase_url=SUPABASE_URL, supabase_key=SUPABASE_KEY)
-        exists = check_if_exists(client, request.url)
-        
-        if exists:
+        url = canonicalize_url(request.url)
+        cached = verdict_cache.get(url)
+        if cached is None:
             # Get the stored permission values
-            response = client.from_('websites').select('study_allowed,work_allowed,leisure_allowed').eq('url', request.url).limit(1).execute()
-            if response.data and len(response.data) > 0:
-                return {
-                    "exists": True,
-                    "study_allowed": response.data[0]["study_allowed"],
-                    "work_allowed": response.data[0]["work_allowed"],
-                    "leisure_allowed": response.data[0]["leisure_allowed"]
-                }
-        
+            record = await get_website_async(get_async_supabase_client(), url, request.url)
+            if record is not None:
+                cached = verdict_cache.put(url, record)
+            else:
+                cached = verdict_cache.put_missing(url)
+
+        if cached.exists:
+            return {
+                "exists": True,
+                "study_allowed": cached.verdicts["study"],
+                "work_allowed": cached.verdicts["work"],
+                "leisure_allowed": cached.verdicts["leisure"]
+            }
+
         return {"exists": False}
         
     except Exception as e:
-        print(f"Error checking website existence: {str(e)}")
+        logger.exception("Error checking website existence", extra={"url": request.url})
         return {"exists": False, "error": str(e)}
 
+@app.get("/health")
+def health_check():
+    """Check that the shared supabase client can still reach the database"""
+    return {"supabase": check_supabase_health(get_supabase_client())}
+
+@app.post("/website-rules/reload")
+def reload_website_rules():
+    """Rebuild the rule index from the rules file and the websites table"""
+    load_website_rules(get_supabase_client())
+    return {"success": True, "rules": rule_index.size()}
+
+@app.post("/local-classifier/train")
+def retrain_local_classifier():
+    """Retrain the local pre-classifier on the current websites table"""
+    return local_classifier.train_from_db(get_supabase_client())
+
+@app.get("/local-classifier/stats")
+def get_local_classifier_stats():
+    """Hit rate, accuracy against gemini and latency of the local pre-classifier"""
+    return local_classifier.stats()
+
+@app.get("/verdict-cache/stats")
+def get_verdict_cache_stats():
+    """Return hit/miss counters for the in-process verdict cache"""
+    return verdict_cache.stats()
+
+@app.get("/llm-scheduler/stats")
+def get_llm_scheduler_stats():
+    """Return per-key queue depth, dispatches by priority and 429s, and per-user budget usage"""
+    return llm_scheduler.stats()
+
+@app.get("/website-writer/stats")
+def get_website_writer_stats():
+    """Return buffered, coalesced and written row counts for the websites write-behind buffer"""
+    return website_writer.stats()
+
+@app.get("/resilience/stats")
+def get_resilience_stats():
+    """Return timeout and circuit breaker state for every guarded dependency"""
+    return dependency_stats()
+
+@app.get("/user-mode-cache/stats")
+def get_user_mode_cache_stats():
+    """Return hit/miss counters and open event streams for the user mode cache"""
+    return user_mode_cache.stats()
+
+@app.get("/content-cache/stats")
+def get_content_cache_stats():
+    """Return exact and near-duplicate hit counters for the page text cache"""
+    return content_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus text format: request and dependency timings, in-flight requests and cache hit rates"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/links")
 def get_links():
     """Return all stored links"""
@@ -0,0 +1,231 @@
+"""
+In-process metrics, exposed in the Prometheus text format on /metrics.
+
+Only what the service needs: counters, gauges and histograms with labels, plus cache collectors that
+read the existing stats() counters when scraped. Every update is a dict lookup and an add under a lock,
+so the hot path doesn't notice it.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.routing import Match
+
+# seconds, from a cached lookup up to a slow gemini call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_labels(self.labelnames, key)} {_number(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [count per bucket (last one is +Inf), sum]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        # cache name -> callable returning {"hits", "misses", optionally "size"}
+        self._caches: Dict[str, Callable[[], dict]] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def register_cache(self, name: str, stats: Callable[[], dict]) -> None:
+        self._caches[name] = stats
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        lines.extend(self._render_caches())
+        return '\n'.join(lines) + '\n'
+
+    def _render_caches(self) -> Iterable[str]:
+        snapshots = {}
+        for name, stats in self._caches.items():
+            try:
+                snapshots[name] = stats()
+            except Exception:
+                continue  # a broken collector shouldn't take the whole scrape down
+        families = (
+            ('gatorguard_cache_hits_total', 'counter', 'Lookups answered by the cache', 'hits'),
+            ('gatorguard_cache_misses_total', 'counter', 'Lookups the cache could not answer', 'misses'),
+            ('gatorguard_cache_entries', 'gauge', 'Entries currently held by the cache', 'size'),
+        )
+        for metric_name, metric_type, documentation, field in families:
+            yield f'# HELP {metric_name} {documentation}'
+            yield f'# TYPE {metric_name} {metric_type}'
+            for name, snapshot in snapshots.items():
+                if snapshot.get(field) is not None:
+                    yield f'{metric_name}{_labels(("cache",), (name,))} {_number(snapshot[field])}'
+
+
+registry = MetricsRegistry()
+
+REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    'gatorguard_requests_in_flight', 'Requests currently being handled', ('method', 'endpoint')))
+REQUEST_DURATION = registry.register(Histogram(
+    'gatorguard_request_duration_seconds', 'Time to produce a response, streamed bodies excluded',
+    ('method', 'endpoint', 'status')))
+STAGE_DURATION = registry.register(Histogram(
+    'gatorguard_stage_duration_seconds', 'Time spent waiting on a dependency (db, gemini, spotify)',
+    ('stage', 'operation')))
+STAGE_ERRORS = registry.register(Counter(
+    'gatorguard_stage_errors_total', 'Dependency calls that raised', ('stage', 'operation')))
+
+
+@contextmanager
+def stage_timer(stage: str, operation: str):
+    """with stage_timer('db', 'get_website'): ... records the duration, and an error if the block raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage, operation=operation)
+        raise
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - start, stage=stage, operation=operation)
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting in-flight requests and response times per route template."""
+
+    def __init__(self, app, routes: Optional[Callable[[], Iterable]] = None):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method = scope['method']
+        endpoint = self._endpoint(scope)
+        started = False
+
+        async def send_wrapper(message):
+            nonlocal started
+            if message['type'] == 'http.response.start':
+                started = True
+                REQUEST_DURATION.observe(time.perf_counter() - start, method=method, endpoint=endpoint,
+                                         status=str(message['status']))
+            await send(message)
+
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc(method=method, endpoint=endpoint)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec(method=method, endpoint=endpoint)
+            if not started:
+                REQUEST_DURATION.observe(time.perf_counter() - start, method=method, endpoint=endpoint, status='500')
+
+    def _endpoint(self, scope) -> str:
+        # the route template keeps user ids and urls out of the label values
+        for route in (self.routes() if self.routes else ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, 'path', 'unknown')
+        return 'unmatched'
@@ -0,0 +1,186 @@
+"""
+Pools of already-resolved songs per (mode, submode, lyric_status) so /generate-songs can answer
+without waiting on Gemini and Spotify.
+
+A background task on the event loop tops a pool up to PLAYLIST_POOL_TARGET_SIZE whenever it drops below
+PLAYLIST_POOL_LOW_WATERMARK. Served songs leave the pool and are remembered for a while, so a
+refill never puts a song that was just played back into rotation.
+"""
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+PLAYLIST_SIZE = int(os.getenv('PLAYLIST_SIZE', '5'))
+PLAYLIST_POOL_TARGET_SIZE = int(os.getenv('PLAYLIST_POOL_TARGET_SIZE', '20'))
+PLAYLIST_POOL_LOW_WATERMARK = int(os.getenv('PLAYLIST_POOL_LOW_WATERMARK', '10'))
+# how many served songs per pool are kept out of rotation
+PLAYLIST_POOL_RECENT_SIZE = int(os.getenv('PLAYLIST_POOL_RECENT_SIZE', '50'))
+# gemini likes to repeat itself, give up on a refill after this many generations in a row
+PLAYLIST_POOL_MAX_GENERATIONS = int(os.getenv('PLAYLIST_POOL_MAX_GENERATIONS', '4'))
+# every pool costs memory and background gemini calls, keys past this many are served without one
+PLAYLIST_POOL_MAX_POOLS = int(os.getenv('PLAYLIST_POOL_MAX_POOLS', '32'))
+
+PoolKey = Tuple[str, Optional[str], Optional[bool]]
+
+
+def song_id(song: dict) -> str:
+    return song.get('url') or f"{song.get('title')}|{song.get('artist')}"
+
+
+class _Pool:
+    __slots__ = ('songs', 'recent', 'recent_ids')
+
+    def __init__(self, recent_size: int):
+        self.songs: Deque[dict] = deque()
+        self.recent: Deque[str] = deque(maxlen=recent_size)
+        self.recent_ids: Set[str] = set()
+
+
+class PlaylistPool:
+    """
+    generate(key, exclude) is a coroutine returning freshly resolved songs for a pool key, exclude
+    being the titles already in the pool.
+    """
+
+    def __init__(self, generate: Callable[[PoolKey, List[str]], Awaitable[List[dict]]],
+                 playlist_size: int = PLAYLIST_SIZE, target_size: int = PLAYLIST_POOL_TARGET_SIZE,
+                 low_watermark: int = PLAYLIST_POOL_LOW_WATERMARK, recent_size: int = PLAYLIST_POOL_RECENT_SIZE,
+                 max_generations: int = PLAYLIST_POOL_MAX_GENERATIONS, max_pools: int = PLAYLIST_POOL_MAX_POOLS):
+        self.generate = generate
+        self.playlist_size = playlist_size
+        self.target_size = target_size
+        self.low_watermark = low_watermark
+        self.recent_size = recent_size
+        self.max_generations = max_generations
+        self.max_pools = max_pools
+        self._pools: Dict[PoolKey, _Pool] = {}
+        self._queue: Optional['asyncio.Queue[PoolKey]'] = None
+        self._pending: Set[PoolKey] = set()
+        self._worker: Optional[asyncio.Task] = None
+        self.served_from_pool = 0
+        self.pool_misses = 0
+        self.refills = 0
+        self.refill_failures = 0
+        self.refused_pools = 0
+
+    def start(self, warm_keys: Iterable[PoolKey] = ()) -> None:
+        # must be called from the running event loop (the app lifespan)
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._pending.clear()
+            self._worker = asyncio.ensure_future(self._run())
+        for key in warm_keys:
+            self.request_refill(key)
+
+    async def stop(self) -> None:
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+
+    def take(self, key: PoolKey, count: Optional[int] = None) -> List[dict]:
+        """
+        count pooled songs, or [] when the pool can't fill the whole playlist or there is no room for a new
+        pool, the caller then generates it live. Always tops the pool up if it is running low.
+        """
+        count = count or self.playlist_size
+        pool = self._pool(key)
+        if pool is None:
+            self.pool_misses += 1
+            return []
+        songs = []
+        if len(pool.songs) >= count:
+            # a short pool keeps its songs for the next request rather than serving a short playlist
+            songs = [pool.songs.popleft() for _ in range(count)]
+        for song in songs:
+            self._remember(pool, song)
+        if songs:
+            self.served_from_pool += 1
+        else:
+            self.pool_misses += 1
+        if len(pool.songs) < self.low_watermark:
+            self.request_refill(key)
+        return songs
+
+    def mark_served(self, key: PoolKey, songs: List[dict]) -> None:
+        # songs served straight from gemini on a cold pool should not come back in the next refill either
+        pool = self._pool(key)
+        if pool is None:
+            return
+        for song in songs:
+            self._remember(pool, song)
+
+    def request_refill(self, key: PoolKey) -> None:
+        if self._queue is None or key in self._pending:
+            return  # not started, or a refill is already queued
+        if key not in self._pools and len(self._pools) >= self.max_pools:
+            self.refused_pools += 1
+            return
+        self._pending.add(key)
+        self._queue.put_nowait(key)
+
+    def stats(self) -> dict:
+        return {
+            "pools": {'/'.join(str(part) for part in key): len(pool.songs) for key, pool in self._pools.items()},
+            "pending_refills": len(self._pending),
+            "served_from_pool": self.served_from_pool,
+            "pool_misses": self.pool_misses,
+            "refills": self.refills,
+            "refill_failures": self.refill_failures,
+            "refused_pools": self.refused_pools,
+        }
+
+    def _pool(self, key: PoolKey) -> Optional[_Pool]:
+        pool = self._pools.get(key)
+        if pool is None:
+            if len(self._pools) >= self.max_pools:
+                self.refused_pools += 1
+                return None
+            pool = self._pools[key] = _Pool(self.recent_size)
+        return pool
+
+    def _remember(self, pool: _Pool, song: dict) -> None:
+        identifier = song_id(song)
+        if identifier in pool.recent_ids:
+            return
+        if len(pool.recent) == pool.recent.maxlen:
+            pool.recent_ids.discard(pool.recent[0])
+        pool.recent.append(identifier)
+        pool.recent_ids.add(identifier)
+
+    async def _run(self) -> None:
+        # one refill at a time, pool refills should never crowd out requests for gemini
+        while True:
+            key = await self._queue.get()
+            try:
+                await self._refill(key)
+            except Exception:
+                self.refill_failures += 1
+                logger.exception("Error refilling playlist pool", extra={"pool": key})
+            finally:
+                self._pending.discard(key)
+
+    async def _refill(self, key: PoolKey) -> None:
+        for _ in range(self.max_generations):
+            pool = self._pool(key)
+            if pool is None or len(pool.songs) >= self.target_size:
+                return
+            exclude = [song['title'] for song in pool.songs]
+
+            songs = await self.generate(key, exclude)
+
+            seen = pool.recent_ids | {song_id(song) for song in pool.songs}
+            for song in songs:
+                identifier = song_id(song)
+                if identifier not in seen:
+                    seen.add(identifier)
+                    pool.songs.append(song)
+            self.refills += 1
+            logger.info("Playlist pool refilled to %d songs", len(pool.songs), extra={"pool": key})
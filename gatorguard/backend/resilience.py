@@ -0,0 +1,150 @@
+"""
+Timeouts, circuit breakers and the fallback policy for verdicts.
+
+Every call to a dependency has a deadline. A dependency that keeps failing is skipped for a while
+instead of making every request wait on it again; after the cool-down a single trial call decides
+whether it is back. When a verdict can't be had in time, the mode's policy answers instead:
+fail open (allow the site) or fail closed (block it).
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from metrics import Counter, Gauge, registry
+from verdict_cache import MODES
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DB_TIMEOUT_SECONDS = float(os.getenv('DB_TIMEOUT_SECONDS', '2'))
+# consecutive failures (errors or timeouts) that open a breaker, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', '30'))
+# how long a tab check waits on gemini before the policy answers, the evaluation itself carries on and is stored
+VERDICT_WAIT_SECONDS = float(os.getenv('VERDICT_WAIT_SECONDS', '3'))
+# modes that allow a site whose verdict can't be had, every other mode blocks it
+VERDICT_FAIL_OPEN_MODES = {mode.strip().lower() for mode in os.getenv('VERDICT_FAIL_OPEN_MODES', 'leisure').split(',')
+                           if mode.strip()}
+
+CIRCUIT_OPEN = registry.register(Gauge(
+    'gatorguard_circuit_open', 'Whether calls to a dependency are currently skipped', ('dependency',)))
+VERDICT_FALLBACKS = registry.register(Counter(
+    'gatorguard_verdict_fallbacks_total', 'Verdicts answered by the fail-open/fail-closed policy', ('mode', 'reason')))
+
+# name -> Dependency, for /resilience/stats
+_dependencies: Dict[str, 'Dependency'] = {}
+
+
+class DependencyError(Exception):
+    """The dependency answered, but not with something we can use."""
+
+
+class CircuitOpenError(DependencyError):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self.trips = 0
+        self._lock = threading.Lock()
+        CIRCUIT_OPEN.set(0, dependency=name)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # let one call through, its outcome closes or re-opens the breaker
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit closed", extra={"dependency": self.name})
+                CIRCUIT_OPEN.set(0, dependency=self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                logger.warning("Circuit opened after %d failures", self.failures, extra={"dependency": self.name})
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                CIRCUIT_OPEN.set(1, dependency=self.name)
+
+    def release(self) -> None:
+        # the trial call was cancelled before it could tell us anything, the next call gets to try
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "trips": self.trips,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+            }
+
+
+class Dependency:
+    """A downstream service: a deadline for every call and one breaker shared by all of them."""
+
+    def __init__(self, name: str, timeout: float, breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker(name)
+        _dependencies[name] = self
+
+    async def call(self, func, *args, **kwargs):
+        """await func(*args, **kwargs) within the deadline. Raises CircuitOpenError without calling it while open."""
+        if not self.breaker.allow():
+            raise CircuitOpenError(f'{self.name} circuit is open')
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), timeout=self.timeout)
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+
+def fallback_verdict(mode: str, reason: str) -> bool:
+    """What a tab gets when its verdict can't be had: allowed in fail-open modes, blocked otherwise."""
+    VERDICT_FALLBACKS.inc(mode=mode if mode in MODES else 'other', reason=reason)
+    return mode in VERDICT_FAIL_OPEN_MODES
+
+
+db_dependency = Dependency('db', DB_TIMEOUT_SECONDS)
+
+
+def dependency_stats() -> Dict[str, dict]:
+    return {name: {"timeout": dependency.timeout, **dependency.breaker.stats()}
+            for name, dependency in _dependencies.items()}
@@ -5,18 +5,39 @@ from typing import Optional
 from typing import List
 from enum import Enum
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from supabase import create_client
-from utils.spotify_helper import search_spotify_song
+from utils.spotify_helper import search_spotify_track_async
+from track_cache import TrackCache
+from playlist_pool import PlaylistPool
+from song_parser import SONG_LIST_SCHEMA, SongListParser, song_list_stats
 from supabase_client import check_if_exists, retrieve_permission, add_website_to_db, SUPABASE_KEY, SUPABASE_URL, add_user_mode,update_user_mode
 import google.generativeai as genai
-import traceback
-import re
+import asyncio
+import json
+import logging
+from metrics import stage_timer
+from llm_scheduler import Priority, llm_scheduler
+from verdict_cache import MODES
+from evaluation_service import STUDY_SUBMODES
 
 from dotenv import load_dotenv
 import os
 
 router = APIRouter()
 load_dotenv()
+logger = logging.getLogger(__name__)
+
+# spotify searches in flight at once, across every request and pool refill
+SPOTIFY_SEARCH_WORKERS = int(os.getenv("SPOTIFY_SEARCH_WORKERS", "8"))
+# every search of a playlist starts at once, so this is also the most a slow search can add to the response
+SPOTIFY_SEARCH_TIMEOUT = float(os.getenv("SPOTIFY_SEARCH_TIMEOUT", "5"))
+# ask gemini for a json song list instead of free text lines
+SONG_STRUCTURED_OUTPUT = os.getenv("SONG_STRUCTURED_OUTPUT", "true").lower() == "true"
+
+spotify_search_slots = asyncio.Semaphore(SPOTIFY_SEARCH_WORKERS)
+track_cache = TrackCache()
 
 class UserMode(BaseModel):
     #user_id:str
@@ -33,114 +54,216 @@ class SongResponse(BaseModel):
     all_songs:List[SongLink]
 
 
+async def search_and_cache(title,artist):
+    async with spotify_search_slots:
+        with stage_timer('spotify','search'):
+            song=await search_spotify_track_async(title,artist)
+    # misses are cached too, failed searches (SpotifySearchError) are not; sqlite stays off the event loop
+    await run_in_threadpool(track_cache.put,title,artist,song)
+    return song
+
+async def resolve_song(title,artist):
+    found,song=await run_in_threadpool(track_cache.get,title,artist)
+    if found:
+        return song
+    return await asyncio.wait_for(search_and_cache(title,artist),timeout=SPOTIFY_SEARCH_TIMEOUT)
+
+async def resolve_song_or_none(title,artist):
+    try:
+        song=await resolve_song(title,artist)
+    except asyncio.TimeoutError:
+        logger.warning("Spotify search timed out", extra={"title": title, "artist": artist})
+        return None
+    except Exception:
+        logger.exception("Spotify search failed", extra={"title": title, "artist": artist})
+        return None
+
+    if not song:
+        logger.debug("Song not found on Spotify", extra={"title": title, "artist": artist})
+    return song
+
+async def resolve_songs(candidates):
+    # look up every (title, artist) on spotify concurrently, keeping gemini's order and dropping misses
+    songs=await asyncio.gather(*(resolve_song_or_none(title,artist) for title,artist in candidates))
+    return [song for song in songs if song]
+
 @router.get("/testing")
 def test():
     return {"message": "Hello World"}
 
+def build_song_query(mode_status:UserMode,exclude=()):
+    # one prompt for every mode, the study submode only narrows the focus
+    if(mode_status.mode_select =='study' and mode_status.sub_mode_select):
+        focus=f"related to {mode_status.mode_select} with a focus on concentration for {mode_status.sub_mode_select}"
+    else:
+        focus=f"related to {mode_status.mode_select}"
+
+    query=f"Recommend 5 songs {focus}. Generate me a new response, don't repeat the previous songs."
+    if mode_status.lyric_status:
+        query += "\nSongs must have lyrics."
+    elif(mode_status.lyric_status==False):
+        query += "\nSongs must not have lyrics."
+    if exclude:
+        query += "\nDo not recommend any of these songs: " + "; ".join(exclude)
+
+    if SONG_STRUCTURED_OUTPUT:
+        query += "\nAnswer with a JSON array of objects with the song title and artist."
+    else:
+        query += "\nPut one song per line as: Title - Artist"
+    return query
+
+SONG_GENERATION_CONFIG=genai.GenerationConfig(response_mime_type='application/json', response_schema=SONG_LIST_SCHEMA) if SONG_STRUCTURED_OUTPUT else None
+
+async def request_songs(query,priority,stream=False):
+    # songs have their own key, queued behind tab checks on the scheduler
+    return await llm_scheduler.generate("GEMINI_API_KEY_2",query,priority,generation_config=SONG_GENERATION_CONFIG,stream=stream)
+
+async def generate_songs(mode_status:UserMode,exclude=(),priority=Priority.USER):
+    # one gemini recommendation, resolved on spotify; raises when gemini can't be reached
+    query=build_song_query(mode_status,exclude)
+    with stage_timer('gemini','generate_songs'):
+        response = await request_songs(query,priority)
+
+    parser=SongListParser(SONG_STRUCTURED_OUTPUT)
+    suggestions=parser.feed(response.text)+parser.close()
+    return await resolve_songs([(song.title,song.artist) for song in suggestions])
+
+
+def normalize_mode_status(mode_status:UserMode):
+    # "Study " and "study" are the same playlist
+    mode_select=(mode_status.mode_select or '').strip().lower()
+    sub_mode_select=(mode_status.sub_mode_select or '').strip().lower() or None
+    return mode_status.model_copy(update={"mode_select":mode_select,"sub_mode_select":sub_mode_select})
+
+def pool_key(mode_status:UserMode):
+    """The pool for a normalized request, None for a mode or submode we don't pool (served straight from gemini)."""
+    if mode_status.mode_select not in MODES:
+        return None
+    # the submode only changes the recommendation in study mode
+    sub_mode=mode_status.sub_mode_select if mode_status.mode_select=='study' else None
+    if sub_mode is not None and sub_mode not in STUDY_SUBMODES:
+        return None
+    return (mode_status.mode_select,sub_mode,mode_status.lyric_status)
+
+async def refill_songs(key,exclude):
+    mode_select,sub_mode_select,lyric_status=key
+    return await generate_songs(UserMode(mode_select=mode_select,sub_mode_select=sub_mode_select,lyric_status=lyric_status),exclude,Priority.BACKGROUND)
+
+playlist_pool=PlaylistPool(refill_songs)
+
+def warm_pool_keys():
+    keys=[]
+    for lyric_status in (True,False):
+        keys.extend([('study',None,lyric_status),('study','school',lyric_status),('study','interview',lyric_status),
+                     ('work',None,lyric_status),('leisure',None,lyric_status)])
+    return keys
+
 @router.post("/generate-songs")
-def process_song_link(mode_status:UserMode):
-    print(f"{mode_status.mode_select}: {mode_status.sub_mode_select}: {mode_status.lyric_status}")
+async def process_song_link(mode_status:UserMode):
+    logger.debug("Song request", extra={"mode": mode_status.mode_select, "submode": mode_status.sub_mode_select,
+                                        "lyric_status": mode_status.lyric_status})
 
+    mode_status=normalize_mode_status(mode_status)
     if not(mode_status.mode_select):
         raise HTTPException(status_code=400, detail="Mode selection is required")
     try:
-        GENAI_API_KEY=os.getenv("GEMINI_API_KEY_2")
-        if not(GENAI_API_KEY):
-            raise Exception("No API key found")
-        
-        if(mode_status.mode_select =='study' and mode_status.sub_mode_select):
-            query=f"""
-            Recommend 5 songs related to {mode_status.mode_select} with a focus on concentration for {mode_status.sub_mode_select}.
-            Only include songs with {mode_status.lyric_status}
-
-            Generate me a new response, don't repeat the previous songs.: 
-            Title - Artist - length of song - Spotify Link
-            """
-            if mode_status.lyric_status:
-                query += "\nSongs must have lyrics."
-            else:
-                query += "\nSongs must not have lyrics."
-
-            genai.configure(api_key=GENAI_API_KEY)  
-            gemini = genai.GenerativeModel('gemini-2.0-flash')
-            response = gemini.generate_content(query)
-
-            print(f" this is line 69:{response.text.replace('*','')}")
-
-            song_list=[]
-
-            for line in response.text.replace("*",'').strip().splitlines():
-                part=[part.strip() for part in line.split('-')]
-                if len(part) < 2:
-                    continue
-
-                title=part[0]
-                title=re.sub(r'^\d+\.','',title).strip()
-
-                artist=part[1].strip()
-
-                search_song=search_spotify_song(title,artist)
-                if search_song:
-                    print(search_song)
-                    song_list.append(search_song)
-                else:
-                    print(f"Song not found: {title.strip()} by {artist.strip()}")
-                
-            return song_list
-
-        else:
-            song_type="lyrics"
-            if(mode_status.lyric_status == True):
-                song_type="lyrics"
-            elif(mode_status.lyric_status == False):
-                song_type="no lyrics"
-
-            query=f"""
-            Recommend 5 songs related to {mode_status.mode_select}
-            Only include songs with {song_type} 
-    
-            Title - Artist -length of the song- Spotify Link
-    
-            """
-        #Note: Find a way to make it run when the person clicks
-            if mode_status.lyric_status:
-                query += "\nSongs must have lyrics."
-            elif(mode_status.lyric_status==False):
-                query += "\nSongs must not have lyrics."
-
-            print(query)
-            genai.configure(api_key=GENAI_API_KEY)  
-            gemini = genai.GenerativeModel('gemini-2.0-flash')
-            response = gemini.generate_content(query)
-
-            print(response.text.replace('*',''))
-            song_list=[]
-            for line in response.text.strip().replace('*','').splitlines():
-                part=[part.strip() for part in line.split('-')]
-                if len(part) < 2:
-                    continue
-
-                title=part[0]
-                title=re.sub(r'^\d+\.','',title).strip()
-
-                artist=part[1].strip()
-
-                search_song=search_spotify_song(title,artist)
-                if search_song:
-                    print(search_song)
-                    song_list.append(search_song)
-                else:
-                    print(f"Song not found: {title.strip()} by {artist.strip()}")
-                
-            return song_list
-            
-    
+        key=pool_key(mode_status)
+        songs=playlist_pool.take(key) if key else []
+        if songs:
+            return songs
+
+        # cold pool: generate this playlist on the request, the refill is already queued
+        songs=await generate_songs(mode_status)
+        if key:
+            playlist_pool.mark_served(key,songs)
+        return songs
+
     except Exception as e:
-        print(f'Error in processing song link: {e}')
-        traceback.print_exc()
+        logger.exception("Error generating songs")
         return {"error": str(e)}
 
 
+async def stream_generated_songs(mode_status:UserMode,key):
+    # gemini streams the list, every complete song is searched right away and each song is sent as soon as it resolves
+    results=asyncio.Queue()
+    served=[]
+
+    async def lookup(index,title,artist):
+        await results.put((index,await resolve_song_or_none(title,artist)))
+
+    async def produce():
+        lookups=[]
+
+        def schedule(suggestions):
+            for song in suggestions:
+                lookups.append(asyncio.ensure_future(lookup(len(lookups),song.title,song.artist)))
+
+        try:
+            # only the wait for the stream to open, the songs are timed as they resolve
+            with stage_timer('gemini','stream_songs'):
+                response=await request_songs(build_song_query(mode_status),Priority.USER,stream=True)
+            parser=SongListParser(SONG_STRUCTURED_OUTPUT)
+            async for chunk in response:
+                schedule(parser.feed(chunk.text))
+            schedule(parser.close())
+            await asyncio.gather(*lookups)
+        finally:
+            for task in lookups:
+                task.cancel()
+            await results.put(None)
+
+    producer=asyncio.ensure_future(produce())
+    try:
+        while True:
+            item=await results.get()
+            if item is None:
+                break
+            index,song=item
+            if song:
+                served.append(song)
+                yield json.dumps({"index":index,**song})+"\n"
+        await asyncio.wait({producer})
+        if producer.exception() is not None:
+            logger.error("Error streaming songs", exc_info=producer.exception())
+            yield json.dumps({"error":str(producer.exception())})+"\n"
+    finally:
+        producer.cancel()
+        if key:
+            playlist_pool.mark_served(key,served)
+
+@router.post("/generate-songs/stream")
+async def stream_song_link(mode_status:UserMode):
+    """NDJSON, one line per resolved song ({"index", "title", "artist", "song_length", "url"}) in the order they resolve."""
+    mode_status=normalize_mode_status(mode_status)
+    if not(mode_status.mode_select):
+        raise HTTPException(status_code=400, detail="Mode selection is required")
+
+    key=pool_key(mode_status)
+    songs=playlist_pool.take(key) if key else []
+
+    async def pooled():
+        for index,song in enumerate(songs):
+            yield json.dumps({"index":index,**song})+"\n"
+
+    body=pooled() if songs else stream_generated_songs(mode_status,key)
+    return StreamingResponse(body,media_type="application/x-ndjson")
+
+
+@router.get("/playlist-pool/stats")
+def get_playlist_pool_stats():
+    return playlist_pool.stats()
+
+
+@router.get("/song-parser/stats")
+def get_song_parser_stats():
+    return song_list_stats.stats()
+
+
+@router.get("/track-cache/stats")
+def get_track_cache_stats():
+    return track_cache.stats()
+
+
 @router.get("/received-songs")
 def get_received_songs() -> SongResponse:
     pass
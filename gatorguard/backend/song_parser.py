@@ -0,0 +1,166 @@
+"""
+Parsing and validation of Gemini song recommendations.
+
+Gemini is asked for a JSON array of {"title", "artist"} objects (SONG_LIST_SCHEMA). The parser is
+incremental so the streaming endpoint can pull complete songs out of a partial array, and it also
+understands the older "Title - Artist - ..." line format as a fallback. Every item is validated
+before it can cost a Spotify search, and what gets dropped is counted.
+"""
+import json
+import re
+import threading
+from typing import Any, Dict, List, Optional, Set
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+SONG_LIST_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {
+            'title': {'type': 'string'},
+            'artist': {'type': 'string'},
+        },
+        'required': ['title', 'artist'],
+    },
+}
+
+LIST_NUMBER_RE = re.compile(r'^\s*(\d+[.)]|[-*•])\s*')
+# only " - " separates fields, so hyphenated titles like "Re-Awakening" or "Lo-Fi" stay whole
+LINE_SEPARATOR_RE = re.compile(r'\s+[-–—]\s+')
+
+
+class SongSuggestion(BaseModel):
+    """A song as Gemini suggested it, before it is looked up on Spotify."""
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    title: str = Field(min_length=1, max_length=200)
+    artist: str = Field(min_length=1, max_length=200)
+
+
+class SongListStats:
+    """How many suggested songs were accepted, and why the rest were dropped."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.accepted = 0
+        self.dropped: Dict[str, int] = {'malformed': 0, 'duplicate': 0, 'unparseable_response': 0}
+
+    def record(self, accepted: int = 0, **dropped: int) -> None:
+        with self._lock:
+            self.accepted += accepted
+            for reason, count in dropped.items():
+                self.dropped[reason] = self.dropped.get(reason, 0) + count
+
+    def record_response(self) -> None:
+        with self._lock:
+            self.responses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"responses": self.responses, "accepted": self.accepted, "dropped": dict(self.dropped)}
+
+
+song_list_stats = SongListStats()
+
+
+def validate_song(item: Any) -> Optional[SongSuggestion]:
+    if not isinstance(item, dict):
+        return None
+    try:
+        song = SongSuggestion.model_validate(item)
+    except ValidationError:
+        return None
+    title = LIST_NUMBER_RE.sub('', song.title).strip('*"\' ')
+    artist = song.artist.strip('*"\' ')
+    if not title or not artist:
+        return None
+    return SongSuggestion(title=title, artist=artist)
+
+
+def parse_song_line(line: str) -> Optional[dict]:
+    # "1. Title - Artist - 3:45 - link" -> {"title", "artist"}, None for anything else
+    parts = LINE_SEPARATOR_RE.split(LIST_NUMBER_RE.sub('', line.replace('*', '').strip()))
+    if len(parts) < 2:
+        return None
+    return {'title': parts[0], 'artist': parts[1]}
+
+
+class SongListParser:
+    """
+    Feed it the response text (all at once or chunk by chunk), get back validated, de-duplicated
+    songs as soon as they are complete. structured=False parses the line format instead of JSON.
+    """
+
+    def __init__(self, structured: bool = True, stats: SongListStats = song_list_stats):
+        self.structured = structured
+        self.stats = stats
+        self._buffer = ''
+        self._position = 0
+        self._finished = False
+        self._seen: Set[str] = set()
+        self._decoder = json.JSONDecoder()
+        self.stats.record_response()
+
+    def feed(self, text: str) -> List[SongSuggestion]:
+        self._buffer += text
+        items = self._json_items() if self.structured else self._line_items(final=False)
+        return self._accept(items)
+
+    def close(self) -> List[SongSuggestion]:
+        if self.structured:
+            items = self._json_items()
+            if not self._finished:
+                # gemini stopped (or was cut off) before closing the array
+                self.stats.record(unparseable_response=1)
+        else:
+            items = self._line_items(final=True)
+        return self._accept(items)
+
+    def _json_items(self) -> List[Any]:
+        items = []
+        buffer = self._buffer
+        while not self._finished:
+            while self._position < len(buffer) and buffer[self._position] in ' \t\r\n,[':
+                self._position += 1
+            if self._position >= len(buffer):
+                break
+            if buffer[self._position] == ']':
+                self._finished = True
+                break
+            try:
+                item, self._position = self._decoder.raw_decode(buffer, self._position)
+            except ValueError:
+                if buffer[self._position] != '{':
+                    # not json at all, nothing after this point can be trusted
+                    self._finished = True
+                    self.stats.record(unparseable_response=1)
+                break  # otherwise the object is still arriving
+            items.append(item)
+        return items
+
+    def _line_items(self, final: bool) -> List[Any]:
+        *lines, self._buffer = self._buffer.split('\n')
+        if final:
+            lines.append(self._buffer)
+            self._buffer = ''
+        return [item for item in map(parse_song_line, lines) if item is not None]
+
+    def _accept(self, items: List[Any]) -> List[SongSuggestion]:
+        songs = []
+        malformed = duplicate = 0
+        for item in items:
+            song = validate_song(item)
+            if song is None:
+                malformed += 1
+                continue
+            key = f'{song.title.lower()}\x1f{song.artist.lower()}'
+            if key in self._seen:
+                duplicate += 1
+                continue
+            self._seen.add(key)
+            songs.append(song)
+        if items:
+            self.stats.record(accepted=len(songs), malformed=malformed, duplicate=duplicate)
+        return songs
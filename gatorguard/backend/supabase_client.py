@@ -1,11 +1,152 @@
-from supabase import Client
+from supabase import Client, ClientOptions, create_client
+from postgrest import AsyncPostgrestClient, SyncPostgrestClient
+from postgrest.exceptions import APIError
+from postgrest.utils import AsyncClient, SyncClient
+from pydantic import BaseModel
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import quote
+import asyncio
+import httpx
+import threading
+import time
 import os
+import logging
 from dotenv import load_dotenv
+from metrics import stage_timer
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 
+# connection pool for the shared postgrest session
+SUPABASE_POOL_SIZE = int(os.getenv('SUPABASE_POOL_SIZE', '20'))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv('SUPABASE_KEEPALIVE_EXPIRY', '60'))
+SUPABASE_TIMEOUT = float(os.getenv('SUPABASE_TIMEOUT', '10'))
+# in_() filters go in the query string, keep each one well under the ~8 KB servers answer 414 past
+SUPABASE_IN_FILTER_MAX_BYTES = int(os.getenv('SUPABASE_IN_FILTER_MAX_BYTES', '4000'))
+
+_client: Optional[Client] = None
+_async_client: Optional[AsyncPostgrestClient] = None
+_client_lock = threading.Lock()
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=SUPABASE_POOL_SIZE,
+        max_keepalive_connections=SUPABASE_POOL_SIZE,
+        keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+    )
+
+
+class PooledPostgrestClient(SyncPostgrestClient):
+    # same session postgrest builds itself, plus explicit keep-alive pool limits
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None) -> SyncClient:
+        return SyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+            follow_redirects=True,
+            http2=True,
+            limits=_pool_limits(),
+        )
+
+
+class PooledAsyncPostgrestClient(AsyncPostgrestClient):
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None) -> AsyncClient:
+        return AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+            follow_redirects=True,
+            http2=True,
+            limits=_pool_limits(),
+        )
+
+
+def init_supabase_client() -> Client:
+    global _client
+    with _client_lock:
+        if _client is None:
+            client = create_client(
+                supabase_url=SUPABASE_URL,
+                supabase_key=SUPABASE_KEY,
+                options=ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT),
+            )
+            # supabase-py builds its postgrest client lazily, hand it our pooled one instead
+            client._postgrest = PooledPostgrestClient(
+                client.rest_url,
+                headers=client.options.headers,
+                schema=client.options.schema,
+                timeout=SUPABASE_TIMEOUT,
+            )
+            _client = client
+        return _client
+
+def get_supabase_client() -> Client:
+    # application-scoped client, created on startup (or on first use outside the app lifespan)
+    if _client is None:
+        return init_supabase_client()
+    return _client
+
+def close_supabase_client() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None and _client._postgrest is not None:
+            _client._postgrest.session.close()
+        _client = None
+
+def init_async_supabase_client() -> AsyncPostgrestClient:
+    # request handlers only ever talk to postgrest, so the async side is a bare pooled postgrest client
+    # with the same url and auth headers as the sync one (which background jobs keep using)
+    global _async_client
+    client = get_supabase_client()
+    with _client_lock:
+        if _async_client is None:
+            _async_client = PooledAsyncPostgrestClient(
+                client.rest_url,
+                headers=client.options.headers,
+                schema=client.options.schema,
+                timeout=SUPABASE_TIMEOUT,
+            )
+        return _async_client
+
+def get_async_supabase_client() -> AsyncPostgrestClient:
+    if _async_client is None:
+        return init_async_supabase_client()
+    return _async_client
+
+async def close_async_supabase_client() -> None:
+    global _async_client
+    client, _async_client = _async_client, None
+    if client is not None:
+        await client.aclose()
+
+def check_supabase_health(supabase: Client) -> dict:
+    # cheapest possible query, also warms a pooled connection
+    start = time.perf_counter()
+    try:
+        supabase.from_('websites').select('url').limit(1).execute()
+        return {"healthy": True, "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+    except Exception as e:
+        return {"healthy": False, "error": str(e)}
+
+WEBSITE_COLUMNS = 'url,title,study_allowed,work_allowed,leisure_allowed'
+
+class WebsiteRecord(BaseModel):
+    url: str
+    title: Optional[str] = None
+    study_allowed: Optional[bool] = None
+    work_allowed: Optional[bool] = None
+    leisure_allowed: Optional[bool] = None
+
+    def allowed_for(self, mode: str) -> Optional[bool]:
+        return getattr(self, f'{mode}_allowed', None)
+
 def check_if_exists(supabase: Client, website_url: str) -> bool:
     response = supabase.from_('websites').select('url').eq('url', website_url).limit(1).execute()
     return bool(response.data)
@@ -19,18 +160,98 @@ def retrieve_permission(supabase: Client, website_url: str, browser_mode: str) -
     # it will only reach here if the query failed -> assume the entry does not exist. if so, allow it
     return True
 
+def _website_query(supabase, website_url: str, aliases):
+    urls = list(dict.fromkeys((website_url, *aliases)))
+    query = supabase.from_('websites').select(WEBSITE_COLUMNS)
+    if len(urls) == 1:
+        return urls, query.eq('url', website_url).limit(1)
+    return urls, query.in_('url', urls).limit(len(urls))
+
+def _first_website(urls: List[str], rows: List[dict]) -> Optional[WebsiteRecord]:
+    if not rows:
+        return None
+    rows = {row['url']: row for row in rows}
+    return WebsiteRecord(**next(rows[url] for url in urls if url in rows))
+
+def get_website(supabase: Client, website_url: str, *aliases: str) -> Optional[WebsiteRecord]:
+    # single round trip replacing check_if_exists + retrieve_permission, None when the url has no row
+    # aliases (e.g. the raw url a canonical one came from) are matched in the same query, website_url wins
+    urls, query = _website_query(supabase, website_url, aliases)
+    return _first_website(urls, query.execute().data)
+
+async def get_website_async(supabase: AsyncPostgrestClient, website_url: str, *aliases: str) -> Optional[WebsiteRecord]:
+    urls, query = _website_query(supabase, website_url, aliases)
+    with stage_timer('db', 'get_website'):
+        response = await query.execute()
+    return _first_website(urls, response.data)
+
+def url_chunks(urls: List[str], max_bytes: int = SUPABASE_IN_FILTER_MAX_BYTES) -> Iterator[List[str]]:
+    """Split urls into in_() lists whose percent-encoded size stays within max_bytes (a longer url goes alone)."""
+    chunk, size = [], 0
+    for url in urls:
+        # quoted and comma separated in the filter
+        cost = len(quote(url, safe='')) + 9
+        if chunk and size + cost > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(url)
+        size += cost
+    if chunk:
+        yield chunk
+
+async def get_websites_async(supabase: AsyncPostgrestClient, website_urls: List[str]) -> Dict[str, WebsiteRecord]:
+    # one in_() query per chunk of urls, keyed by the url stored in the row
+    async def fetch(chunk):
+        return (await supabase.from_('websites').select(WEBSITE_COLUMNS).in_('url', chunk).execute()).data
+
+    chunks = list(url_chunks(list(dict.fromkeys(website_urls))))
+    if not chunks:
+        return {}
+    with stage_timer('db', 'get_websites'):
+        responses = await asyncio.gather(*(fetch(chunk) for chunk in chunks))
+    return {row['url']: WebsiteRecord(**row) for rows in responses for row in rows}
+
+async def upsert_websites_async(supabase: AsyncPostgrestClient, rows: List[dict],
+                                ignore_duplicates: bool = False) -> List[dict]:
+    """
+    Many rows in one statement, they must all have the same columns. Existing rows get those columns
+    overwritten, or are left alone with ignore_duplicates; the rows actually written are returned.
+    """
+    with stage_timer('db', 'upsert_websites'):
+        response = await supabase.from_('websites').upsert(rows, on_conflict='url',
+                                                             ignore_duplicates=ignore_duplicates).execute()
+    return response.data
+
+async def fill_website_permission_async(supabase: AsyncPostgrestClient, website_url: str, browser_mode: str,
+                                        allowed: bool) -> bool:
+    # only sets the flag while it is still null so an explicit verdict is never overwritten
+    column = f'{browser_mode}_allowed'
+    query = supabase.from_('websites').update({column: allowed}).eq('url', website_url).is_(column, 'null')
+    with stage_timer('db', 'fill_website_permission'):
+        response = await query.execute()
+    return bool(response.data)
+
+async def get_user_mode_settings_async(supabase: AsyncPostgrestClient, user_id: str) -> Optional[dict]:
+    query = supabase.from_('user_mode').select('mode_select,study_submode_select').eq('id', user_id).limit(1)
+    with stage_timer('db', 'get_user_mode_settings'):
+        response = await query.execute()
+    if response.data:
+        return response.data[0]
+    return None
+
 def check_if_user_exists(supabase:Client,user_id:str)-> bool:
     response = supabase.from_('user_profiles').select('id').eq('id', user_id).limit(1).execute()
     return bool(response.data)
 
+async def check_if_user_exists_async(supabase: AsyncPostgrestClient, user_id: str) -> bool:
+    with stage_timer('db', 'check_if_user_exists'):
+        response = await supabase.from_('user_profiles').select('id').eq('id', user_id).limit(1).execute()
+    return bool(response.data)
+
 def add_website_to_db(supabase: Client, website_url: str, website_title: str, timestamp: str = None, 
                       study_allowed: bool = False, work_allowed: bool = False, leisure_allowed: bool = True):
     try:
-        # Check if website already exists
-        if check_if_exists(supabase, website_url):
-            print(f"Website already exists in database: {website_url}")
-            return {"success": True, "duplicate": True}
-        
+        # No existence pre-check, the unique constraint on url reports duplicates for us
         # Prepare data for insertion
         website_data = {
             'url': website_url,
@@ -41,56 +262,88 @@ def add_website_to_db(supabase: Client, website_url: str, website_title: str, ti
             'leisure_allowed': leisure_allowed,
         }
         
-        # Log insertion attempt
-        print(f"Attempting to insert website: {website_url}")
-        
+        logger.debug("Attempting to insert website", extra={"url": website_url})
+
         # Execute insert operation
         response = supabase.from_('websites').insert(website_data).execute()
         
         # Check for errors in the response
         if hasattr(response, 'error') and response.error:
             error_msg = str(response.error)
-            print(f"Supabase error during insertion: {error_msg}")
-            
             # Check if error is about unique constraint (website already exists)
             if "violates unique constraint" in error_msg or "duplicate key" in error_msg:
-                print("Duplicate entry detected from error message")
+                logger.debug("Website already exists in database", extra={"url": website_url})
                 return {"success": True, "duplicate": True}
             
+            logger.error("Supabase error during website insertion: %s", error_msg, extra={"url": website_url})
             return {"success": False, "error": error_msg}
-        
-        print(f"Successfully inserted website: {website_url}")
+
+        logger.debug("Inserted website", extra={"url": website_url})
         return {"success": True, "duplicate": False}
-        
+
+    except APIError as e:
+        return _insert_error_result(e, website_url)
     except Exception as e:
-        print(f"Exception during website insertion: {str(e)}")
+        logger.exception("Exception during website insertion", extra={"url": website_url})
         return {"success": False, "error": str(e)}
-      
-def add_user_mode(supabase:Client, user_id:str, mode_select:str, sub_mode_select:str=None):
-    MODE_SELECT = ['study', 'work', 'leisure']
-    SUB_MODE_SELECT = ["school", "interview"]  # Match your frontend values
 
-    if not (check_if_user_exists(supabase, user_id)):
-        raise ValueError(f"User {user_id} does not exist in the database.")
+def _insert_error_result(e: APIError, website_url: str) -> dict:
+    # 23505 is postgres' unique_violation
+    if e.code == '23505' or "duplicate key" in str(e.message):
+        logger.debug("Website already exists in database", extra={"url": website_url})
+        return {"success": True, "duplicate": True}
+    logger.error("Supabase error during website insertion: %s", e.message, extra={"url": website_url})
+    return {"success": False, "error": str(e.message)}
 
+async def add_website_to_db_async(supabase: AsyncPostgrestClient, website_url: str, website_title: str,
+                                  timestamp: str = None, study_allowed: bool = False, work_allowed: bool = False,
+                                  leisure_allowed: bool = True):
+    website_data = {
+        'url': website_url,
+        'title': website_title,
+        'timestamp': timestamp,
+        'study_allowed': study_allowed,
+        'work_allowed': work_allowed,
+        'leisure_allowed': leisure_allowed,
+    }
+    try:
+        with stage_timer('db', 'add_website'):
+            await supabase.from_('websites').insert(website_data).execute()
+        logger.debug("Inserted website", extra={"url": website_url})
+        return {"success": True, "duplicate": False}
+    except APIError as e:
+        return _insert_error_result(e, website_url)
+    except Exception as e:
+        logger.exception("Exception during website insertion", extra={"url": website_url})
+        return {"success": False, "error": str(e)}
+      
+MODE_SELECT = ['study', 'work', 'leisure']
+SUB_MODE_SELECT = ["school", "interview"]  # Match your frontend values
+
+def _validate_user_mode(mode_select: str, sub_mode_select: str = None) -> None:
     if mode_select.lower() not in MODE_SELECT:
         raise ValueError(f"Invalid mode: {mode_select}. Valid modes are: {MODE_SELECT}")
     
     if mode_select.lower() == 'study' and sub_mode_select:
         if sub_mode_select.lower() not in SUB_MODE_SELECT:
             raise ValueError(f"Invalid sub mode: {sub_mode_select}. Valid sub modes are: {SUB_MODE_SELECT}")
+
+def _user_mode_data(mode_select: str, sub_mode_select: str = None) -> dict:
+    mode_select = mode_select.lower()
+    data = {'mode_select': mode_select}
+    # non-study modes explicitly clear the submode
+    data['study_submode_select'] = sub_mode_select.lower() if mode_select == 'study' and sub_mode_select else None
+    return data
+
+def add_user_mode(supabase:Client, user_id:str, mode_select:str, sub_mode_select:str=None):
+    if not (check_if_user_exists(supabase, user_id)):
+        raise ValueError(f"User {user_id} does not exist in the database.")
+    _validate_user_mode(mode_select, sub_mode_select)
     
     # Ensure the data is properly formatted for insert
-    insert_data = {
-        'id': user_id,
-        'mode_select': mode_select
-    }
+    insert_data = {'id': user_id, **_user_mode_data(mode_select, sub_mode_select)}
     
-    # Only add submode if it's study mode
-    if mode_select.lower() == 'study':
-        insert_data['study_submode_select'] = sub_mode_select
-    
-    print(f"Inserting user mode with data: {insert_data}")
+    logger.debug("Inserting user mode", extra={"data": insert_data})
     
     try:
         # Use custom error handling
@@ -98,43 +351,25 @@ def add_user_mode(supabase:Client, user_id:str, mode_select:str, sub_mode_select
         
         if hasattr(response, 'error') and response.error:
             error_msg = str(response.error)
-            print(f"Supabase error during insertion: {error_msg}")
+            logger.error("Supabase error adding user mode: %s", error_msg, extra={"user_id": user_id})
             return {"success": False, "error": error_msg}
             
         else:
-            print(f"User mode added successfully: {response['data']}")
+            logger.debug("User mode added", extra={"user_id": user_id})
             return True
     except Exception as e:
-        print(f"Exception adding user mode: {str(e)}")
+        logger.exception("Exception adding user mode", extra={"user_id": user_id})
         return str(e)
 
 def update_user_mode(supabase:Client, user_id:str, mode_select:str, sub_mode_select:str=None):
-    MODE_SELECT = ['study', 'work', 'leisure']
-    SUB_MODE_SELECT = ["school", "interview"]  # Match your frontend values
-
     if not (check_if_user_exists(supabase, user_id)):
         raise ValueError(f"User {user_id} does not exist in the database.")
-
-    if mode_select.lower() not in MODE_SELECT:
-        raise ValueError(f"Invalid mode: {mode_select}. Valid modes are: {MODE_SELECT}")
-    
-    if mode_select.lower() == 'study' and sub_mode_select:
-        if sub_mode_select.lower() not in SUB_MODE_SELECT:
-            raise ValueError(f"Invalid sub mode: {sub_mode_select}. Valid sub modes are: {SUB_MODE_SELECT}")
+    _validate_user_mode(mode_select, sub_mode_select)
 
     # Prepare update data properly
-    update_data = {
-        'mode_select': mode_select
-    }
+    update_data = _user_mode_data(mode_select, sub_mode_select)
     
-    # Handle study_submode_select explicitly
-    if mode_select.lower() == 'study':
-        update_data['study_submode_select'] = sub_mode_select
-    else:
-        # For non-study modes, explicitly set submode to null
-        update_data['study_submode_select'] = None
-    
-    print(f"Updating user mode with data: {update_data}")
+    logger.debug("Updating user mode", extra={"user_id": user_id, "data": update_data})
     
     try:
         # Execute the update without assuming a specific return structure
@@ -142,13 +377,25 @@ def update_user_mode(supabase:Client, user_id:str, mode_select:str, sub_mode_sel
         
         # Check for error in response
         if hasattr(response, 'error') and response.error:
-            print(f"Error updating user mode: {response.error}")
+            logger.error("Error updating user mode: %s", response.error, extra={"user_id": user_id})
             return response.error
         else:
-            print(f"User mode updated successfully: {response.data if hasattr(response, 'data') else 'No data returned'}")
+            logger.debug("User mode updated", extra={"user_id": user_id})
             return True
     except Exception as e:
-        print(f"Exception updating user mode: {str(e)}")
+        logger.exception("Exception updating user mode", extra={"user_id": user_id})
         return str(e)
 
-
+async def upsert_user_mode_async(supabase: AsyncPostgrestClient, user_id: str, mode_select: str,
+                                 sub_mode_select: str = None) -> dict:
+    """
+    Set the user's mode in a single round trip. Raises ValueError for an invalid mode before touching
+    the db, callers are expected to have checked that the user exists.
+    """
+    _validate_user_mode(mode_select, sub_mode_select)
+    data = {'id': user_id, **_user_mode_data(mode_select, sub_mode_select)}
+    # insert or overwrite in one statement, no select-then-write race between concurrent switches
+    query = supabase.from_('user_mode').upsert(data, on_conflict='id')
+    with stage_timer('db', 'upsert_user_mode'):
+        response = await query.execute()
+    return response.data[0] if response.data else {'id': user_id, **_user_mode_data(mode_select, sub_mode_select)}
@@ -0,0 +1,58 @@
+import random
+
+from content_cache import (ContentVerdictCache, extract_truncated_json_string, fingerprint, fit_to_budget,
+                           normalize_text)
+
+WORDS = ['study', 'lecture', 'exam', 'notes', 'chapter', 'theorem', 'proof', 'lemma', 'graph', 'vector',
+         'matrix', 'function', 'series', 'limit', 'integral', 'derivative', 'space', 'field', 'group', 'ring']
+
+
+def page(seed, words=400):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def test_whitespace_and_case_do_not_change_the_fingerprint():
+    assert fingerprint('Hello   World\n') == fingerprint('hello world')
+    assert normalize_text(' A\tB ') == 'a b'
+
+
+def test_near_duplicate_pages_share_a_verdict():
+    text = page(1)
+    edited = text.replace('exam', 'quiz', 1)
+    cache = ContentVerdictCache(max_distance=6)
+    cache.put(*fingerprint(text), {'study': True})
+
+    assert cache.get(*fingerprint(edited)) == {'study': True}
+    assert cache.stats()['near_duplicate_hits'] == 1
+
+
+def test_different_pages_miss():
+    cache = ContentVerdictCache()
+    cache.put(*fingerprint(page(1)), {'study': True})
+    assert cache.get(*fingerprint('completely unrelated text about cooking pasta at home tonight')) is None
+
+
+def test_oldest_page_is_evicted():
+    cache = ContentVerdictCache(max_size=1, max_distance=0)
+    first, second = fingerprint(page(1)), fingerprint(page(2))
+    cache.put(*first, 'first')
+    cache.put(*second, 'second')
+    assert cache.get(*first) is None
+    assert cache.get(*second) == 'second'
+
+
+def test_fit_to_budget_keeps_short_text_and_samples_long_text():
+    assert fit_to_budget('a few words', token_budget=100) == 'a few words'
+    long_text = ' '.join(f'w{i}' for i in range(10000))
+    fitted = fit_to_budget(long_text, token_budget=400)
+    assert fitted.startswith('w0 ')
+    assert len(fitted.replace(' [...] ', ' ').split()) <= 300
+
+
+def test_extract_truncated_json_string():
+    body = b'{"url": "https://example.com", "title": "T", "text_content": "abc\\u00e9 and then the cut'
+    assert extract_truncated_json_string(body, 'url', partial=False) == 'https://example.com'
+    assert extract_truncated_json_string(body, 'text_content') == 'abcé and then the cut'
+    assert extract_truncated_json_string(body, 'text_content', partial=False) is None
+    assert extract_truncated_json_string(body, 'mode') is None
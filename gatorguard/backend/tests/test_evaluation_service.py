@@ -0,0 +1,191 @@
+import asyncio
+
+import pytest
+
+import evaluation_service
+from evaluation_service import SOURCE_GEMINI, SOURCE_LOCAL, EvaluationService
+from llm_scheduler import BudgetExceeded, LLMScheduler
+
+VERDICTS = {'study': True, 'work': False, 'leisure': False}
+
+
+class FakeWriter:
+    def __init__(self):
+        self.rows = []
+
+    def insert(self, row):
+        self.rows.append(row)
+
+
+class FakeLocalClassifier:
+    def __init__(self, answer):
+        self.answer = answer
+
+    def classify(self, url, title):
+        return self.answer, {}
+
+    def should_audit(self):
+        return False
+
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch):
+    scheduler = LLMScheduler(user_budget=1)
+    monkeypatch.setattr(evaluation_service, 'llm_scheduler', scheduler)
+    return scheduler
+
+
+def gemini_service(release=None, **kwargs):
+    service = EvaluationService(**kwargs)
+    service.calls = 0
+
+    async def call_gemini(url, title, priority=None):
+        service.calls += 1
+        if release is not None:
+            await release.wait()
+        return VERDICTS
+
+    service._call_gemini = call_gemini
+    return service
+
+
+def test_a_user_over_budget_does_not_fail_a_call_someone_else_started():
+    async def run():
+        release = asyncio.Event()
+        service = gemini_service(release)
+        first = asyncio.ensure_future(service.evaluate('https://a.com', None, persist=False, user_id='alice'))
+        await asyncio.sleep(0)
+        evaluation_service.llm_scheduler.spend('bob')
+        joiner = asyncio.ensure_future(service.evaluate('https://a.com', None, persist=False, user_id='bob'))
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(first, joiner)
+
+        # bob starting a call of his own is refused in his request, not inside a shared call
+        with pytest.raises(BudgetExceeded):
+            await service.evaluate('https://b.com', None, user_id='bob')
+        return results, service.calls
+
+    results, calls = asyncio.run(run())
+    assert results == [(VERDICTS, SOURCE_GEMINI)] * 2
+    assert calls == 1
+
+
+def test_the_shared_call_is_stored_if_any_caller_asks_for_it():
+    async def run():
+        release = asyncio.Event()
+        writer = FakeWriter()
+        service = gemini_service(release, website_writer=writer)
+        first = asyncio.ensure_future(service.evaluate('https://a.com', 'A', persist=False))
+        await asyncio.sleep(0)
+        joiner = asyncio.ensure_future(service.evaluate('https://a.com', 'A'))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, joiner)
+
+        await service.evaluate('https://b.com', 'B', persist=False)
+        return writer.rows
+
+    rows = asyncio.run(run())
+    assert [row['url'] for row in rows] == ['https://a.com']
+
+
+def test_local_answers_are_returned_with_their_source_and_never_stored():
+    async def run():
+        writer = FakeWriter()
+        service = gemini_service(local_classifier=FakeLocalClassifier(VERDICTS), website_writer=writer)
+        return await service.evaluate('https://a.com', 'A'), service.calls, writer.rows
+
+    assert asyncio.run(run()) == ((VERDICTS, SOURCE_LOCAL), 0, [])
+
+
+def test_failed_audits_do_not_open_the_breaker_requests_use():
+    async def run():
+        service = EvaluationService(local_classifier=FakeLocalClassifier(VERDICTS))
+
+        async def failing_gemini(url, title, priority=None):
+            raise evaluation_service.DependencyError('no verdicts')
+
+        service._call_gemini = failing_gemini
+        for _ in range(service.gemini_audits.breaker.failure_threshold):
+            await service._audit('https://a.com', 'A', VERDICTS)
+        return service.gemini.breaker.state, service.gemini_audits.breaker.state
+
+    assert asyncio.run(run()) == ('closed', 'open')
+
+
+def test_concurrent_calls_for_one_url_share_one_gemini_call():
+    async def run():
+        release = asyncio.Event()
+        service = gemini_service(release)
+        callers = [asyncio.ensure_future(service.evaluate('https://a.com', None, persist=False)) for _ in range(5)]
+        await asyncio.sleep(0)
+        in_flight = service.in_flight()
+        release.set()
+        return await asyncio.gather(*callers), service.calls, in_flight
+
+    results, calls, in_flight = asyncio.run(run())
+    assert results == [(VERDICTS, SOURCE_GEMINI)] * 5
+    assert (calls, in_flight) == (1, 1)
+
+
+def test_a_cancelled_caller_does_not_cancel_the_others():
+    async def run():
+        release = asyncio.Event()
+        service = gemini_service(release)
+        leaving = asyncio.ensure_future(service.evaluate('https://a.com', None, persist=False))
+        staying = asyncio.ensure_future(service.evaluate('https://a.com', None, persist=False))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return leaving.cancelled(), await staying
+
+    assert asyncio.run(run()) == (True, (VERDICTS, SOURCE_GEMINI))
+
+
+def test_a_timed_out_call_returns_nothing_and_leaves_no_call_in_flight():
+    async def run():
+        service = gemini_service(asyncio.Event(), timeout=0.01)
+        result = await service.evaluate('https://a.com', None, persist=False)
+        await asyncio.sleep(0)
+        return result, service.in_flight()
+
+    assert asyncio.run(run()) == ((None, None), 0)
+
+
+def test_identical_page_text_shares_one_gemini_call():
+    async def run():
+        release = asyncio.Event()
+        service = EvaluationService()
+        calls = []
+
+        async def call_gemini_text(text):
+            calls.append(text)
+            await release.wait()
+            return VERDICTS
+
+        service._call_gemini_text = call_gemini_text
+        callers = [asyncio.ensure_future(service.evaluate_text('hash', 'some text')) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers)
+        await asyncio.sleep(0)
+        return results, len(calls), service.in_flight()
+
+    assert asyncio.run(run()) == ([VERDICTS] * 3, 1, 0)
+
+
+def test_a_timed_out_text_call_returns_nothing():
+    async def run():
+        service = EvaluationService(timeout=0.01)
+
+        async def slow(text):
+            await asyncio.sleep(1)
+
+        service._call_gemini_text = slow
+        result = await service.evaluate_text('hash', 'some text')
+        await asyncio.sleep(0)
+        return result, service.in_flight()
+
+    assert asyncio.run(run()) == (None, 0)
@@ -0,0 +1,58 @@
+import asyncio
+
+import google.generativeai as genai
+import pytest
+
+from llm_scheduler import LLMScheduler, TokenBucket, UnsupportedSDK, bind_api_key
+
+
+def test_token_bucket_starts_full_and_paces_after_the_burst():
+    bucket = TokenBucket(rate_per_second=10, capacity=2)
+    for _ in range(2):
+        assert bucket.wait_time() == 0
+        bucket.take()
+    assert 0 < bucket.wait_time() <= 0.1
+
+
+def test_token_bucket_without_a_rate_never_waits():
+    bucket = TokenBucket(rate_per_second=0, capacity=1)
+    bucket.take()
+    bucket.take()
+    assert bucket.wait_time() == 0
+
+
+def test_drained_bucket_waits_for_a_full_token():
+    bucket = TokenBucket(rate_per_second=1, capacity=5)
+    bucket.drain()
+    assert bucket.wait_time() == pytest.approx(1, abs=0.05)
+
+
+def test_spend_enforces_the_hourly_budget_per_user():
+    scheduler = LLMScheduler(user_budget=2)
+    assert scheduler.spend('alice') and scheduler.spend('alice')
+    assert not scheduler.spend('alice')
+    assert scheduler.spend('bob')
+    assert scheduler.stats()['over_budget'] == 1
+
+
+def test_anonymous_calls_and_unlimited_budgets_are_not_counted():
+    assert all(LLMScheduler(user_budget=1).spend(None) for _ in range(3))
+    assert all(LLMScheduler(user_budget=0).spend('alice') for _ in range(3))
+
+
+def test_bind_api_key_gives_the_model_its_own_client():
+    # models are bound on the event loop, the async client needs one
+    async def bind():
+        return (bind_api_key(genai.GenerativeModel('gemini-2.0-flash'), 'key-a'),
+                bind_api_key(genai.GenerativeModel('gemini-2.0-flash'), 'key-b'))
+
+    model, other = asyncio.run(bind())
+    assert model._async_client is not None
+    assert model._async_client is not other._async_client
+
+
+def test_bind_api_key_refuses_a_model_it_does_not_understand():
+    model = genai.GenerativeModel('gemini-2.0-flash')
+    model._async_client = object()
+    with pytest.raises(UnsupportedSDK):
+        bind_api_key(model, 'key')
@@ -0,0 +1,41 @@
+from local_classifier import LocalClassifier
+
+
+def labelled_samples():
+    samples = []
+    for i in range(60):
+        samples.append((f'https://course{i}.edu/lecture/{i}', f'Lecture {i} notes homework exam',
+                        None, {'study': True, 'work': False, 'leisure': False}))
+        samples.append((f'https://game{i}.example.com/play/{i}', f'Play game {i} online fun',
+                        None, {'study': False, 'work': False, 'leisure': True}))
+    return samples
+
+
+def test_confident_urls_are_answered_locally():
+    classifier = LocalClassifier(threshold=0.8, min_samples=10, enabled=True)
+    classifier.train(labelled_samples(), epochs=10)
+
+    verdicts, probabilities = classifier.classify('https://course99.edu/lecture/99', 'Lecture 99 notes homework exam')
+    assert verdicts is not None and verdicts['study'] is True
+    assert set(probabilities) == {'study', 'work', 'leisure'}
+
+
+def test_untrained_classifier_escalates():
+    classifier = LocalClassifier(enabled=True)
+    assert classifier.classify('https://example.com', 'Example') == (None, {})
+
+
+def test_audits_measure_local_accuracy():
+    classifier = LocalClassifier(enabled=True, audit_rate=1.0)
+    assert classifier.should_audit()
+
+    classifier.record_audit({'study': True, 'work': False}, {'study': True, 'work': True, 'leisure': False})
+    classifier.record_audit({'study': True}, {'study': False, 'work': True, 'leisure': False})
+    stats = classifier.stats()
+
+    assert stats['audited'] == {'study': 2, 'work': 1, 'leisure': 0}
+    assert stats['local_accuracy'] == {'study': 0.5, 'work': 0.0, 'leisure': None}
+
+
+def test_audits_can_be_turned_off():
+    assert not LocalClassifier(enabled=True, audit_rate=0).should_audit()
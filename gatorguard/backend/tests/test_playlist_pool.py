@@ -0,0 +1,68 @@
+import asyncio
+
+from playlist_pool import PlaylistPool
+from song_output import UserMode, normalize_mode_status, pool_key
+
+
+def key_for(mode_select, sub_mode_select=None, lyric_status=False):
+    mode_status = UserMode(mode_select=mode_select, sub_mode_select=sub_mode_select, lyric_status=lyric_status)
+    return pool_key(normalize_mode_status(mode_status))
+
+
+def test_pool_keys_are_normalized():
+    assert key_for(' Study ', 'SCHOOL ') == ('study', 'school', False)
+    assert key_for('WORK', 'school', True) == ('work', None, True)
+
+
+def test_unknown_modes_and_submodes_get_no_pool():
+    assert key_for('party') is None
+    assert key_for('study', 'cramming') is None
+    assert key_for('  ') is None
+
+
+async def no_songs(key, exclude):
+    return []
+
+
+def test_pool_count_is_capped():
+    pool = PlaylistPool(no_songs, max_pools=2)
+    assert pool.take(('work', None, False)) == []
+    assert pool.take(('leisure', None, False)) == []
+    assert pool.take(('study', None, False)) == []
+    pool.mark_served(('study', None, False), [{'title': 'a', 'artist': 'b'}])
+
+    stats = pool.stats()
+    assert len(stats['pools']) == 2
+    assert stats['refused_pools'] == 2
+    assert stats['pool_misses'] == 3
+
+
+def test_refills_for_new_keys_are_refused_past_the_cap():
+    async def run():
+        pool = PlaylistPool(no_songs, max_pools=1, max_generations=1)
+        pool.start([('work', None, False), ('leisure', None, False)])
+        await asyncio.sleep(0)
+        await pool.stop()
+        return pool.stats()
+
+    stats = asyncio.run(run())
+    assert stats['refused_pools'] == 1
+    assert list(stats['pools']) == ['work/None/False']
+
+
+def test_a_short_pool_serves_nothing_instead_of_a_short_playlist():
+    async def run():
+        async def three_songs(key, exclude):
+            return [{'title': f'song {n}', 'artist': 'a', 'url': f'u{n}'} for n in range(3)]
+
+        pool = PlaylistPool(three_songs, playlist_size=5, target_size=3, max_generations=1)
+        pool.start([('work', None, False)])
+        await asyncio.sleep(0.01)
+        short = pool.take(('work', None, False))
+        enough = pool.take(('work', None, False), count=3)
+        await pool.stop()
+        return short, enough
+
+    short, enough = asyncio.run(run())
+    assert short == []
+    assert [song['url'] for song in enough] == ['u0', 'u1', 'u2']
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpenError, Dependency, fallback_verdict
+from supabase_client import WebsiteRecord
+from verdict_cache import VerdictCache
+
+
+def test_breaker_opens_after_the_threshold_and_rejects():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker('test', failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_one_trial_call_through():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    # a failed trial opens it again, a successful one closes it
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_trial_gives_the_next_call_a_turn():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_dependency_times_out_and_trips_the_breaker():
+    dependency = Dependency('test-slow', timeout=0.01, breaker=CircuitBreaker('test-slow', failure_threshold=1))
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(dependency.call(slow))
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(dependency.call(slow))
+
+
+def test_fallback_fails_open_only_in_leisure():
+    assert fallback_verdict('leisure', 'db') is True
+    assert fallback_verdict('study', 'db') is False
+    assert fallback_verdict('unknown', 'db') is False
+
+
+def test_expired_rows_are_served_stale_only_when_asked():
+    cache = VerdictCache(ttl=0, stale=60)
+    cache.put('a', WebsiteRecord(url='a', study_allowed=True))
+
+    assert cache.get('a') is None
+    entry = cache.get('a', allow_stale=True)
+    assert entry.stale and entry.verdicts['study'] is True
+    assert cache.stats()['stale_hits'] == 1
+
+
+def test_missing_urls_are_never_served_stale():
+    cache = VerdictCache(negative_ttl=0, stale=60)
+    cache.put_missing('a')
+    assert cache.get('a', allow_stale=True) is None
@@ -0,0 +1,49 @@
+from song_parser import SongListParser, SongListStats, parse_song_line, validate_song
+
+
+def parser(structured=True):
+    return SongListParser(structured, stats=SongListStats())
+
+
+def test_json_songs_come_out_as_they_complete():
+    songs = parser()
+    assert songs.feed('[{"title": "Weightless", "artist": "Marconi') == []
+    first = songs.feed(' Union"}, {"title": "Clair de Lune", ')
+    assert [(song.title, song.artist) for song in first] == [('Weightless', 'Marconi Union')]
+    rest = songs.feed('"artist": "Debussy"}]') + songs.close()
+    assert [song.title for song in rest] == ['Clair de Lune']
+
+
+def test_malformed_and_duplicate_items_are_dropped_and_counted():
+    stats = SongListStats()
+    songs = SongListParser(stats=stats)
+    result = songs.feed('[{"title": "A", "artist": "X"}, {"title": "a", "artist": "x"}, {"title": ""}, 3]')
+    result += songs.close()
+
+    assert [song.title for song in result] == ['A']
+    assert stats.stats()['dropped'] == {'malformed': 2, 'duplicate': 1, 'unparseable_response': 0}
+
+
+def test_cut_off_or_non_json_responses_are_counted():
+    stats = SongListStats()
+    songs = SongListParser(stats=stats)
+    songs.feed('[{"title": "A", "artist": "X"}, {"title": "B"')
+    songs.close()
+    SongListParser(stats=stats).feed('Here are some songs:')
+    assert stats.stats()['dropped']['unparseable_response'] == 2
+
+
+def test_line_format_keeps_hyphenated_titles_whole():
+    assert parse_song_line('1. Re-Awakening - Lo-Fi Girl - 3:45') == {'title': 'Re-Awakening', 'artist': 'Lo-Fi Girl'}
+    assert parse_song_line('Just a sentence') is None
+
+    songs = parser(structured=False)
+    result = songs.feed('1. Song One - Artist\n2. Song Two') + songs.feed(' - Other\n') + songs.close()
+    assert [(song.title, song.artist) for song in result] == [('Song One', 'Artist'), ('Song Two', 'Other')]
+
+
+def test_validate_song_strips_list_markers_and_quotes():
+    song = validate_song({'title': '  3) "Halo"', 'artist': '*Beyonce*'})
+    assert (song.title, song.artist) == ('Halo', 'Beyonce')
+    assert validate_song({'title': 'x' * 201, 'artist': 'y'}) is None
+    assert validate_song(['not', 'a', 'dict']) is None
@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+import pytest
+
+from utils import spotify_helper
+from utils.spotify_helper import SpotifySearchError, SpotifyTokenManager, search_spotify_track_async
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    def __init__(self, expires_in=3600):
+        self.expires_in = expires_in
+        self.requests = 0
+
+    def post(self, *args, **kwargs):
+        self.requests += 1
+        return FakeResponse(200, {'access_token': f'token-{self.requests}', 'expires_in': self.expires_in})
+
+
+def test_token_is_reused_until_it_nears_expiry():
+    session = FakeSession()
+    manager = SpotifyTokenManager(session, refresh_margin=60)
+    assert manager.get_token() == manager.get_token() == 'token-1'
+    assert manager.peek() == 'token-1'
+    assert session.requests == 1
+
+
+def test_token_inside_the_refresh_margin_is_replaced():
+    session = FakeSession(expires_in=30)
+    manager = SpotifyTokenManager(session, refresh_margin=60)
+    assert manager.get_token() == 'token-1'
+    assert manager.peek() is None
+    assert manager.get_token() == 'token-2'
+
+
+def test_invalidate_only_drops_the_token_that_failed():
+    manager = SpotifyTokenManager(FakeSession())
+    manager.get_token()
+    manager.invalidate('some-older-token')
+    assert manager.peek() == 'token-1'
+    manager.invalidate('token-1')
+    assert manager.get_token() == 'token-2'
+
+
+def test_failed_token_request_is_not_cached():
+    class DownSession(FakeSession):
+        def post(self, *args, **kwargs):
+            self.requests += 1
+            return FakeResponse(500, {'error': 'server_error'})
+
+    session = DownSession()
+    manager = SpotifyTokenManager(session)
+    assert manager.get_token() is None
+    assert manager.get_token() is None
+    assert session.requests == 2
+
+
+TRACK = {'name': 'Weightless', 'duration_ms': 480600, 'artists': [{'name': 'Marconi Union'}],
+         'external_urls': {'spotify': 'https://open.spotify.com/track/x'}}
+
+
+@pytest.fixture
+def spotify(monkeypatch):
+    seen = []
+
+    def handler(request):
+        seen.append(request.headers['Authorization'])
+        if request.headers['Authorization'] == 'Bearer token-1':
+            return httpx.Response(401, json={'error': 'expired'})
+        return httpx.Response(200, json={'tracks': {'items': [TRACK]}})
+
+    monkeypatch.setattr(spotify_helper, 'token_manager', SpotifyTokenManager(FakeSession()))
+    monkeypatch.setattr(spotify_helper, 'spotify_async_client', httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return seen
+
+
+def test_search_refreshes_a_revoked_token_once_and_retries(spotify):
+    song = asyncio.run(search_spotify_track_async('Weightless', 'Marconi Union'))
+    assert song == {'title': 'Weightless', 'artist': 'Marconi Union', 'song_length': 8.01,
+                    'url': 'https://open.spotify.com/track/x'}
+    assert spotify == ['Bearer token-1', 'Bearer token-2']
+
+
+def test_search_without_a_token_raises(monkeypatch):
+    manager = SpotifyTokenManager(FakeSession())
+    monkeypatch.setattr(manager, '_request_token', lambda: (None, 0))
+    monkeypatch.setattr(spotify_helper, 'token_manager', manager)
+    with pytest.raises(SpotifySearchError):
+        asyncio.run(search_spotify_track_async('Weightless', 'Marconi Union'))
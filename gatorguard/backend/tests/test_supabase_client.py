@@ -0,0 +1,28 @@
+from urllib.parse import quote
+
+from supabase_client import url_chunks
+
+
+def test_url_chunks_keep_every_url_in_order():
+    urls = [f'https://example.com/{"x" * i}' for i in range(0, 2000, 10)]
+    chunks = list(url_chunks(urls, max_bytes=4000))
+
+    assert [url for chunk in chunks for url in chunk] == urls
+    assert len(chunks) > 1
+
+
+def test_url_chunks_stay_within_budget():
+    urls = [f'https://example.com/search?q={"a b" * i}' for i in range(200)]
+    for chunk in url_chunks(urls, max_bytes=2000):
+        if len(chunk) > 1:
+            assert sum(len(quote(url, safe='')) + 9 for url in chunk) <= 2000
+
+
+def test_url_chunks_put_an_oversized_url_on_its_own():
+    long_url = 'https://example.com/' + 'x' * 5000
+    assert list(url_chunks(['https://a.com', long_url, 'https://b.com'], max_bytes=1000)) == \
+        [['https://a.com'], [long_url], ['https://b.com']]
+
+
+def test_url_chunks_of_nothing():
+    assert list(url_chunks([])) == []
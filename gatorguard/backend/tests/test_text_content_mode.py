@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+import main
+from evaluation_service import verdict_key
+from main import TextContent, process_text_content, resolve_text_content_mode
+
+
+def resolve(text_content):
+    return asyncio.run(resolve_text_content_mode(text_content))
+
+
+@pytest.fixture
+def saved_mode(monkeypatch):
+    modes = {}
+
+    async def load_user_mode(client, user_id):
+        mode = modes[user_id]
+        if isinstance(mode, Exception):
+            raise mode
+        return mode
+
+    monkeypatch.setattr(main, 'load_user_mode', load_user_mode)
+    monkeypatch.setattr(main, 'get_async_supabase_client', lambda: None)
+    return modes
+
+
+def test_explicit_mode_and_submode_are_normalized():
+    mode, submode = resolve(TextContent(text_content='x', mode=' Study', submode='School'))
+    assert (mode, submode) == ('study', 'school')
+    assert verdict_key(mode, submode) == 'study_school'
+
+
+def test_saved_mode_is_used_when_none_is_sent(saved_mode):
+    saved_mode['u1'] = {'mode': 'Work', 'submode': None}
+    assert resolve(TextContent(text_content='x', user_id='u1')) == ('work', None)
+
+
+def test_saved_row_without_a_mode_falls_back_to_study(saved_mode):
+    saved_mode['u1'] = {'mode': None, 'submode': None}
+    assert resolve(TextContent(text_content='x', user_id='u1', submode='Interview')) == ('study', 'interview')
+
+
+def test_failed_mode_lookup_returns_a_fallback_verdict(saved_mode):
+    saved_mode['u1'] = ConnectionError('db down')
+    # fails closed instead of raising a 500
+    assert asyncio.run(process_text_content(TextContent(text_content='x', user_id='u1'))) is False
+
+
+def test_unknown_explicit_mode_is_rejected():
+    with pytest.raises(main.HTTPException) as error:
+        asyncio.run(process_text_content(TextContent(text_content='x', mode='gaming')))
+    assert error.value.status_code == 400
+
+
+class FakeWriter:
+    def __init__(self):
+        self.rows = []
+
+    def is_pending(self, url):
+        return False
+
+    def upsert(self, row):
+        self.rows.append(row)
+
+
+@pytest.fixture
+def stored_rows(monkeypatch):
+    rows = {}
+    writer = FakeWriter()
+
+    async def get_website_async(client, url, *aliases):
+        return next((rows[candidate] for candidate in (url, *aliases) if candidate in rows), None)
+
+    monkeypatch.setattr(main, 'get_website_async', get_website_async)
+    monkeypatch.setattr(main, 'get_async_supabase_client', lambda: None)
+    monkeypatch.setattr(main, 'website_writer', writer)
+    return rows, writer
+
+
+CONTENT_VERDICTS = {'study': True, 'work': False, 'leisure': False, 'study_school': True, 'study_interview': False}
+
+
+def test_content_verdicts_overwrite_a_row_stored_under_the_raw_url(stored_rows):
+    rows, writer = stored_rows
+    raw_url = 'https://www.example.com/page/'
+    rows[raw_url] = main.WebsiteRecord(url=raw_url)
+
+    asyncio.run(main.store_content_verdicts(TextContent(text_content='x', url=raw_url), CONTENT_VERDICTS))
+    assert [row['url'] for row in writer.rows] == [raw_url]
+
+
+def test_content_verdicts_for_a_new_page_use_the_canonical_url(stored_rows):
+    _, writer = stored_rows
+    asyncio.run(main.store_content_verdicts(TextContent(text_content='x', url='https://www.example.com/new/'),
+                                            CONTENT_VERDICTS))
+    assert [row['url'] for row in writer.rows] == ['https://example.com/new']
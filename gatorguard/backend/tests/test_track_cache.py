@@ -0,0 +1,55 @@
+import itertools
+
+import pytest
+
+import track_cache
+from track_cache import TrackCache, normalize_track_key
+
+SONG = {'title': 'Weightless', 'artist': 'Marconi Union', 'song_length': 8.01, 'url': 'https://open.spotify.com/x'}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = itertools.count(1000)
+    monkeypatch.setattr(track_cache.time, 'time', lambda: next(now))
+
+
+def test_punctuation_case_and_spacing_share_a_key():
+    assert normalize_track_key('Weightless!', 'Marconi  Union') == normalize_track_key('weightless', 'marconi union')
+
+
+def test_found_songs_and_misses_are_cached(tmp_path):
+    cache = TrackCache(str(tmp_path / 'tracks.sqlite3'))
+    assert cache.get('Weightless', 'Marconi Union') == (False, None)
+
+    cache.put('Weightless', 'Marconi Union', SONG)
+    cache.put('Nothing', 'Nobody', None)
+    assert cache.get('weightless', 'marconi union') == (True, SONG)
+    assert cache.get('Nothing', 'Nobody') == (True, None)
+    assert cache.stats()['cached_misses'] == 1
+
+
+def test_expired_entries_miss(tmp_path):
+    cache = TrackCache(str(tmp_path / 'tracks.sqlite3'), ttl=0, negative_ttl=0)
+    cache.put('Weightless', 'Marconi Union', SONG)
+    assert cache.get('Weightless', 'Marconi Union') == (False, None)
+
+
+def test_least_recently_used_rows_are_evicted_every_few_puts(tmp_path, clock):
+    cache = TrackCache(str(tmp_path / 'tracks.sqlite3'), max_size=2, evict_every=3)
+    cache.put('a', 'x', SONG)
+    cache.put('b', 'x', SONG)
+    cache.get('a', 'x')
+    cache.put('c', 'x', SONG)
+
+    assert cache.stats()['size'] == 2
+    assert cache.get('b', 'x') == (False, None)
+    assert cache.get('a', 'x') == (True, SONG)
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'tracks.sqlite3')
+    cache = TrackCache(path)
+    cache.put('Weightless', 'Marconi Union', SONG)
+    cache.close()
+    assert TrackCache(path).get('Weightless', 'Marconi Union') == (True, SONG)
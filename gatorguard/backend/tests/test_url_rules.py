@@ -0,0 +1,80 @@
+from url_rules import RuleIndex, canonicalize_url
+
+
+def test_canonicalize_url_drops_tracking_params_fragment_and_default_port():
+    url = 'HTTPS://www.Example.com:443/Docs/?utm_source=x&b=2&a=1#top'
+    assert canonicalize_url(url) == 'https://example.com/Docs?a=1&b=2'
+
+
+def test_canonicalize_url_keeps_non_urls_as_is():
+    assert canonicalize_url(' not a url ') == 'not a url'
+
+
+def test_lookup_prefers_exact_then_prefix_then_domain():
+    index = RuleIndex()
+    index.add('example.com', {'study': False, 'work': False, 'leisure': True})
+    index.add('example.com/docs', {'study': True})
+    index.add('https://example.com/docs/private', {'work': True})
+
+    assert index.lookup('https://sub.example.com/') == {'study': False, 'work': False, 'leisure': True}
+    assert index.lookup('https://example.com/docs/a') == {'study': True, 'work': False, 'leisure': True}
+    assert index.lookup('https://example.com/docs/private') == {'study': True, 'work': True, 'leisure': True}
+
+
+def test_host_pattern_matches_host_only():
+    index = RuleIndex()
+    index.add('*.edu', {'study': True})
+
+    assert index.lookup('https://cs.ufl.edu/courses')['study'] is True
+    # the wildcard must not be satisfied by the path
+    assert index.lookup('https://evil.com/x.edu')['study'] is None
+    assert index.lookup('https://ads.com/path/foo.edu')['study'] is None
+
+
+def test_path_pattern_wildcard_stays_in_one_segment():
+    index = RuleIndex()
+    index.add('*.example.com/docs/*', {'work': True})
+
+    assert index.lookup('https://api.example.com/docs/intro')['work'] is True
+    assert index.lookup('https://api.example.com/docs/intro/more')['work'] is None
+    assert index.lookup('https://api.example.com/blog/docs/intro')['work'] is None
+    assert index.lookup('https://example.org/docs/intro')['work'] is None
+
+
+def test_discard_exact_removes_only_the_exact_rule():
+    index = RuleIndex()
+    index.add('https://example.com/a', {'study': True})
+    index.add('example.com', {'study': False})
+    index.discard_exact('https://www.example.com/a/')
+
+    assert index.lookup('https://example.com/a')['study'] is False
+
+
+class FakeQuery:
+    def __init__(self, rows):
+        self.rows = rows
+        self.not_ = self
+
+    def __getattr__(self, name):
+        return lambda *args: self
+
+    def range(self, start, end):
+        self.page = self.rows[start:end + 1]
+        return self
+
+    def execute(self):
+        return type('Response', (), {'data': self.page})()
+
+
+def test_load_from_db_leaves_full_url_rows_to_the_verdict_cache():
+    rows = [
+        {'url': 'https://example.com/page', 'study_allowed': True},
+        {'url': 'example.com', 'study_allowed': False},
+        {'url': 'example.com/docs', 'study_allowed': True},
+    ]
+    client = type('Client', (), {'from_': lambda self, table: FakeQuery(rows)})()
+    index = RuleIndex()
+
+    assert index.load_from_db(client, page_size=2) == 2
+    assert index.lookup('https://example.com/page')['study'] is False
+    assert index.lookup('https://example.com/docs/a')['study'] is True
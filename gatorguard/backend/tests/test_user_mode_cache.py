@@ -0,0 +1,82 @@
+import asyncio
+
+from user_mode_cache import UserModeCache
+
+
+def test_put_and_get():
+    cache = UserModeCache()
+    cache.put('u1', 'study', 'school')
+    assert cache.get('u1') == {'mode': 'study', 'submode': 'school'}
+    assert cache.get('u2') is None
+
+
+def test_set_always_notifies_subscribers():
+    async def run():
+        cache = UserModeCache()
+        queue = cache.subscribe('u1')
+        cache.set('u1', 'work')
+        cache.set('u1', 'work')
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    assert asyncio.run(run()) == [{'mode': 'work', 'submode': None}] * 2
+
+
+def test_put_only_notifies_when_the_mode_changed_behind_our_back():
+    async def run():
+        cache = UserModeCache()
+        queue = cache.subscribe('u1')
+        cache.put('u1', 'work')      # first read, nothing to compare against
+        cache.put('u1', 'work')      # unchanged
+        cache.put('u1', 'leisure')   # another writer switched it
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    assert asyncio.run(run()) == [{'mode': 'leisure', 'submode': None}]
+
+
+def test_a_slow_subscriber_keeps_only_the_latest_modes():
+    async def run():
+        cache = UserModeCache(queue_size=2)
+        queue = cache.subscribe('u1')
+        for mode in ('study', 'work', 'leisure'):
+            cache.set('u1', mode)
+        return [queue.get_nowait()['mode'] for _ in range(queue.qsize())]
+
+    assert asyncio.run(run()) == ['work', 'leisure']
+
+
+def test_unsubscribe_stops_notifications():
+    async def run():
+        cache = UserModeCache()
+        queue = cache.subscribe('u1')
+        cache.unsubscribe('u1', queue)
+        cache.set('u1', 'work')
+        return queue.qsize(), cache.stats()['subscribers']
+
+    assert asyncio.run(run()) == (0, 0)
+
+
+def test_expired_entries_miss_and_invalidate_drops_them():
+    cache = UserModeCache(ttl=0)
+    cache.put('u1', 'work')
+    assert cache.get('u1') is None
+
+    cache = UserModeCache()
+    cache.put('u1', 'work')
+    cache.invalidate('u1')
+    assert cache.get('u1') is None
+
+
+def test_known_users_are_remembered_and_bounded():
+    cache = UserModeCache(max_size=1)
+    cache.remember_user('u1')
+    assert cache.is_known_user('u1')
+    cache.remember_user('u2')
+    assert not cache.is_known_user('u1')
+
+
+def test_contains_is_not_counted_as_a_hit_or_miss():
+    cache = UserModeCache()
+    cache.put('u1', 'work')
+    assert cache.contains('u1')
+    assert not cache.contains('u2')
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (0, 0)
@@ -0,0 +1,58 @@
+from supabase_client import WebsiteRecord
+from verdict_cache import VerdictCache
+
+
+def record(url='https://example.com', **flags):
+    return WebsiteRecord(url=url, **{f'{mode}_allowed': allowed for mode, allowed in flags.items()})
+
+
+def test_put_then_get_returns_every_mode():
+    cache = VerdictCache()
+    cache.put('https://example.com', record(study=True, work=False))
+    entry = cache.get('https://example.com')
+
+    assert entry.exists
+    assert entry.verdicts == {'study': True, 'work': False, 'leisure': None}
+    assert cache.stats()['hits'] == 1
+
+
+def test_missing_urls_are_cached_as_not_existing():
+    cache = VerdictCache()
+    cache.put_missing('https://new.example')
+    assert not cache.get('https://new.example').exists
+
+
+def test_entries_are_copies():
+    cache = VerdictCache()
+    cache.put('https://example.com', record(study=True))
+    cache.get('https://example.com').verdicts['study'] = False
+    assert cache.get('https://example.com').verdicts['study'] is True
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = VerdictCache(max_size=2)
+    cache.put('a', record('a'))
+    cache.put('b', record('b'))
+    cache.get('a')
+    cache.put('c', record('c'))
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def test_expired_entries_are_misses():
+    cache = VerdictCache(ttl=0, negative_ttl=0, stale=0)
+    cache.put('a', record('a'))
+    cache.put_missing('b')
+    assert cache.get('a') is None and cache.get('b') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_invalidate_and_clear():
+    cache = VerdictCache()
+    cache.put('a', record('a'))
+    cache.put('b', record('b'))
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    cache.clear()
+    assert cache.get('b') is None
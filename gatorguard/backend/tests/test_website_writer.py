@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+import website_writer
+from resilience import CircuitBreaker, Dependency
+from website_writer import WebsiteWriter, _PendingRow
+
+
+class FakeDB:
+    """Stands in for upsert_websites_async: records batches, fails while `failing` is set."""
+
+    def __init__(self):
+        self.batches = []
+        self.failing = False
+        self.existing = set()
+
+    async def upsert(self, client, rows, ignore_duplicates=False):
+        if self.failing:
+            raise ConnectionError('db down')
+        self.batches.append((ignore_duplicates, [dict(row) for row in rows]))
+        written = [row for row in rows if not (ignore_duplicates and row['url'] in self.existing)]
+        self.existing.update(row['url'] for row in rows)
+        return written
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(website_writer, 'upsert_websites_async', db.upsert)
+    monkeypatch.setattr(website_writer, 'get_async_supabase_client', lambda: None)
+    breaker = CircuitBreaker('db-test', failure_threshold=1000)
+    monkeypatch.setattr(website_writer, 'db_dependency', Dependency('db-test', 1, breaker))
+    return db
+
+
+def test_upsert_after_insert_overwrites_and_becomes_an_upsert():
+    pending = _PendingRow({'url': 'a', 'study_allowed': True, 'work_allowed': True}, insert_only=True)
+    WebsiteWriter._merge(pending, {'url': 'a', 'work_allowed': False}, insert_only=False)
+    assert pending.columns == {'url': 'a', 'study_allowed': True, 'work_allowed': False}
+    assert not pending.insert_only
+
+
+def test_insert_after_upsert_only_fills_missing_columns():
+    pending = _PendingRow({'url': 'a', 'work_allowed': False}, insert_only=False)
+    WebsiteWriter._merge(pending, {'url': 'a', 'study_allowed': True, 'work_allowed': True}, insert_only=True)
+    assert pending.columns == {'url': 'a', 'study_allowed': True, 'work_allowed': False}
+    assert not pending.insert_only
+
+
+def test_writes_to_one_url_are_coalesced():
+    writer = WebsiteWriter()
+    writer.upsert({'url': 'a', 'study_allowed': True})
+    writer.upsert({'url': 'a', 'study_allowed': False})
+    writer.upsert({'url': 'b', 'study_allowed': True})
+    assert writer.pending() == 2
+    assert writer.stats()['coalesced'] == 1
+
+
+def test_restore_puts_failed_rows_back_in_front_with_newer_writes_on_top():
+    writer = WebsiteWriter()
+    failed = [_PendingRow({'url': 'a', 'study_allowed': True}, False),
+              _PendingRow({'url': 'b', 'study_allowed': True}, False)]
+    writer.upsert({'url': 'c', 'study_allowed': True})
+    writer.upsert({'url': 'b', 'study_allowed': False})
+
+    writer._restore(failed)
+
+    assert list(writer._pending) == ['a', 'b', 'c']
+    # b was written again while the flush was failing, the newer value wins
+    assert writer._pending['b'].columns == {'url': 'b', 'study_allowed': False}
+
+
+def test_flush_groups_rows_by_kind_and_columns(db):
+    writer = WebsiteWriter(batch_size=2)
+    writer.insert({'url': 'a', 'study_allowed': True})
+    writer.insert({'url': 'b', 'study_allowed': False})
+    writer.insert({'url': 'c', 'study_allowed': True})
+    writer.upsert({'url': 'd', 'work_allowed': True})
+
+    assert asyncio.run(writer.flush())
+
+    assert [(insert_only, [row['url'] for row in rows]) for insert_only, rows in db.batches] == \
+        [(True, ['a', 'b']), (True, ['c']), (False, ['d'])]
+    assert writer.pending() == 0
+
+
+def test_failed_flush_keeps_rows_for_the_next_one(db):
+    writer = WebsiteWriter()
+    writer.upsert({'url': 'a', 'study_allowed': True})
+    db.failing = True
+    assert not asyncio.run(writer.flush())
+    assert writer.pending() == 1
+
+    db.failing = False
+    assert asyncio.run(writer.flush())
+    assert db.batches == [(False, [{'url': 'a', 'study_allowed': True}])]
+
+
+def test_inserts_that_hit_an_existing_row_go_to_on_duplicate(db):
+    duplicates = []
+
+    async def on_duplicate(rows):
+        duplicates.extend(rows)
+
+    db.existing.add('a')
+    writer = WebsiteWriter(on_duplicate=on_duplicate)
+    writer.insert({'url': 'a', 'study_allowed': True})
+    writer.insert({'url': 'b', 'study_allowed': True})
+    asyncio.run(writer.flush())
+
+    assert duplicates == [{'url': 'a', 'study_allowed': True}]
+    assert writer.stats()['duplicates'] == 1
+
+
+def test_stop_flushes_what_is_buffered(db):
+    async def run():
+        writer = WebsiteWriter(flush_interval=60)
+        writer.start()
+        writer.upsert({'url': 'a', 'study_allowed': True})
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.pending() == 0
+    assert len(db.batches) == 1
+
+
+def test_oldest_rows_are_dropped_past_max_pending():
+    writer = WebsiteWriter(max_pending=2)
+    for url in 'abc':
+        writer.upsert({'url': url})
+    assert list(writer._pending) == ['b', 'c']
+    assert writer.stats()['dropped'] == 1
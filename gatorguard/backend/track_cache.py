@@ -0,0 +1,124 @@
+"""
+Persistent cache of Spotify track lookups for /generate-songs.
+
+Gemini keeps recommending the same handful of songs, so each (title, artist) pair is resolved
+against Spotify once and the result is kept in a local SQLite file, including misses so a song
+Spotify doesn't have is not searched for again on every request. Misses get a shorter ttl.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACK_CACHE_PATH = os.getenv('TRACK_CACHE_PATH', os.path.join(os.path.dirname(__file__), 'track_cache.sqlite3'))
+TRACK_CACHE_MAX_SIZE = int(os.getenv('TRACK_CACHE_MAX_SIZE', '10000'))
+TRACK_CACHE_TTL_SECONDS = float(os.getenv('TRACK_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))
+# spotify's catalogue grows, so a song that wasn't found is searched for again sooner
+TRACK_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv('TRACK_CACHE_NEGATIVE_TTL_SECONDS', str(24 * 3600)))
+# expired and least recently used rows are trimmed once every this many puts, not on each one, so the
+# table can run this far past TRACK_CACHE_MAX_SIZE in between
+TRACK_CACHE_EVICT_EVERY = int(os.getenv('TRACK_CACHE_EVICT_EVERY', '100'))
+
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_track_key(title: str, artist: str) -> str:
+    """'Weightless – Marconi Union' and 'weightless  - marconi union!' share one key."""
+    def normalize(value: str) -> str:
+        value = unicodedata.normalize('NFKC', value or '').lower()
+        value = PUNCTUATION_RE.sub(' ', value)
+        return WHITESPACE_RE.sub(' ', value).strip()
+    return f'{normalize(title)}\x1f{normalize(artist)}'
+
+
+class TrackCache:
+    """SQLite-backed (title, artist) -> search result cache with ttl and least-recently-used eviction."""
+
+    def __init__(self, path: str = TRACK_CACHE_PATH, max_size: int = TRACK_CACHE_MAX_SIZE,
+                 ttl: float = TRACK_CACHE_TTL_SECONDS, negative_ttl: float = TRACK_CACHE_NEGATIVE_TTL_SECONDS,
+                 evict_every: int = TRACK_CACHE_EVICT_EVERY):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.evict_every = max(1, evict_every)
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+        # one connection shared by the search threads, every use goes through the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS tracks ('
+            ' key TEXT PRIMARY KEY, song TEXT, expires_at REAL NOT NULL, last_used REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS tracks_last_used ON tracks (last_used)')
+        self.hits = 0
+        self.misses = 0
+        with self._lock:
+            self._evict(time.time())
+
+    def get(self, title: str, artist: str) -> Tuple[bool, Optional[dict]]:
+        """(found, song). found with song None means spotify had no such track last time we asked."""
+        key = normalize_track_key(title, artist)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT song, expires_at FROM tracks WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] <= now:
+                self.misses += 1
+                return False, None
+            self._conn.execute('UPDATE tracks SET last_used = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def put(self, title: str, artist: str, song: Optional[dict]) -> None:
+        key = normalize_track_key(title, artist)
+        now = time.time()
+        expires_at = now + (self.ttl if song is not None else self.negative_ttl)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO tracks (key, song, expires_at, last_used) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(song) if song is not None else None, expires_at, now),
+            )
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= self.evict_every:
+                self._evict(now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM tracks')
+
+    def stats(self) -> dict:
+        with self._lock:
+            size, found = self._conn.execute('SELECT COUNT(*), COUNT(song) FROM tracks').fetchone()
+        return {
+            "size": size,
+            "max_size": self.max_size,
+            "cached_misses": size - found,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / (self.hits + self.misses), 4) if self.hits + self.misses else None,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self, now: float) -> None:
+        self._puts_since_evict = 0
+        self._conn.execute('DELETE FROM tracks WHERE expires_at <= ?', (now,))
+        (size,) = self._conn.execute('SELECT COUNT(*) FROM tracks').fetchone()
+        if size > self.max_size:
+            self._conn.execute(
+                'DELETE FROM tracks WHERE key IN (SELECT key FROM tracks ORDER BY last_used LIMIT ?)',
+                (size - self.max_size,),
+            )
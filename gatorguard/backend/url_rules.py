@@ -0,0 +1,225 @@
+"""
+URL canonicalization and an in-memory rule index for instant per-mode verdicts.
+
+Rules come from an optional JSON rules file (WEBSITE_RULES_FILE) and the `websites` table.
+The kind of rule is inferred from its key:
+
+    https://docs.python.org/3/tutorial/  exact url (has a scheme)
+    docs.python.org/3                    path prefix (host + path, no scheme)
+    netflix.com                          domain, also matches every subdomain
+    *.edu                                host pattern, matched against the host only
+    *.example.com/docs/*                 host and path pattern, * and ? don't match across a /
+
+A rules file looks like:
+
+    {"rules": [{"url": "netflix.com", "study": false, "work": false, "leisure": true}]}
+
+Lookups try exact -> deepest path prefix -> host and parent domains -> patterns, and a mode
+that a tier leaves unset falls through to the next tier.
+
+Only the rules file holds exact urls. Rows in the `websites` table that are full urls are
+per-page verdicts and are left to the verdict cache, which expires and revalidates them.
+"""
+import fnmatch
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from dotenv import load_dotenv
+
+from verdict_cache import MODES
+
+load_dotenv()
+
+WEBSITE_RULES_FILE = os.getenv('WEBSITE_RULES_FILE', os.path.join(os.path.dirname(__file__), 'website_rules.json'))
+
+TRACKING_PARAM_PREFIXES = ('utm_',)
+TRACKING_PARAMS = {
+    'gclid', 'dclid', 'fbclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid',
+    '_ga', '_gl', 'ref', 'ref_src', 'si', 'spm', 'feature',
+}
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+# second-level labels under which registrations happen one level deeper (example.co.uk)
+SECOND_LEVEL_SUFFIXES = {'co', 'com', 'ac', 'edu', 'gov', 'org', 'net'}
+
+Flags = Dict[str, Optional[bool]]
+
+
+def _normalize_host(host: str) -> str:
+    host = host.lower().strip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    return host
+
+
+def canonicalize_url(url: str) -> str:
+    """Normalize scheme/host, drop default ports, tracking params and fragments, sort the query."""
+    parts = urlsplit(url.strip())
+    if not parts.scheme or not parts.netloc:
+        return url.strip()
+
+    scheme = parts.scheme.lower()
+    host = _normalize_host(parts.hostname or '')
+    port = str(parts.port) if parts.port else ''
+    netloc = host if not port or DEFAULT_PORTS.get(scheme) == port else f'{host}:{port}'
+
+    path = parts.path or '/'
+    if len(path) > 1:
+        path = path.rstrip('/')
+
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PARAM_PREFIXES)
+    ]
+    return urlunsplit((scheme, netloc, path, urlencode(sorted(query)), ''))
+
+
+def registered_domain(host: str) -> str:
+    # close enough to the public suffix list for the sites people actually browse
+    labels = host.split('.')
+    if len(labels) >= 3 and labels[-2] in SECOND_LEVEL_SUFFIXES and len(labels[-1]) == 2:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def _path_segments(path: str) -> List[str]:
+    return [segment for segment in path.split('/') if segment]
+
+
+def _path_pattern(pattern: str) -> 're.Pattern[str]':
+    # unlike fnmatch, a wildcard stays inside one path segment, so '/*.edu' can't match '/ads/foo.edu'
+    translated = ''.join('[^/]*' if char == '*' else '[^/]' if char == '?' else re.escape(char) for char in pattern)
+    return re.compile(translated + r'\Z')
+
+
+def _merge(result: Flags, flags: Flags) -> bool:
+    # fill modes that are still unknown, True once every mode has a verdict
+    for mode in MODES:
+        if result[mode] is None and flags.get(mode) is not None:
+            result[mode] = flags[mode]
+    return all(result[mode] is not None for mode in MODES)
+
+
+class _PrefixNode:
+    __slots__ = ('children', 'flags')
+
+    def __init__(self):
+        self.children: Dict[str, '_PrefixNode'] = {}
+        self.flags: Optional[Flags] = None
+
+
+class RuleIndex:
+    """Hierarchical exact url / path prefix / domain / wildcard rules, all held in memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._exact: Dict[str, Flags] = {}
+        self._prefixes: Dict[str, _PrefixNode] = {}
+        self._domains: Dict[str, Flags] = {}
+        # (host pattern, path pattern or None for host-only patterns, flags)
+        self._patterns: List[Tuple[str, Optional['re.Pattern[str]'], Flags]] = []
+
+    def add(self, key: str, flags: Flags) -> None:
+        flags = {mode: flags.get(mode) for mode in MODES}
+        key = key.strip()
+        with self._lock:
+            if '*' in key:
+                host, slash, path = key.lower().strip('/').partition('/')
+                self._patterns.append((host, _path_pattern(slash + path) if path else None, flags))
+            elif '://' in key:
+                self._exact[canonicalize_url(key)] = flags
+            elif '/' in key.strip('/'):
+                host, _, path = key.strip('/').partition('/')
+                node = self._prefixes.setdefault(_normalize_host(host), _PrefixNode())
+                for segment in _path_segments(path):
+                    node = node.children.setdefault(segment, _PrefixNode())
+                node.flags = flags
+            else:
+                self._domains[_normalize_host(key.strip('/'))] = flags
+
+    def discard_exact(self, url: str) -> None:
+        # called when a website row changes so the db/cache path answers for it again
+        with self._lock:
+            self._exact.pop(canonicalize_url(url), None)
+
+    def lookup(self, url: str) -> Flags:
+        """Per-mode verdicts from the most specific matching rules, None where no rule applies."""
+        result: Flags = {mode: None for mode in MODES}
+        canonical = canonicalize_url(url)
+        parts = urlsplit(canonical)
+        host = parts.hostname or ''
+        segments = _path_segments(parts.path)
+
+        with self._lock:
+            flags = self._exact.get(canonical)
+            if flags is not None and _merge(result, flags):
+                return result
+
+            # deepest matching prefix wins, so collect on the way down and merge bottom-up
+            node = self._prefixes.get(host)
+            matched = []
+            if node is not None:
+                for segment in segments:
+                    node = node.children.get(segment)
+                    if node is None:
+                        break
+                    if node.flags is not None:
+                        matched.append(node.flags)
+            for flags in reversed(matched):
+                if _merge(result, flags):
+                    return result
+
+            # the host itself, then each parent domain up to the registered domain
+            labels = host.split('.')
+            stop = len(registered_domain(host).split('.'))
+            for start in range(0, max(len(labels) - stop, 0) + 1):
+                flags = self._domains.get('.'.join(labels[start:]))
+                if flags is not None and _merge(result, flags):
+                    return result
+
+            for host_pattern, path_pattern, flags in self._patterns:
+                # the host never contains a '/', so a host pattern can't be satisfied by the path
+                if not fnmatch.fnmatchcase(host, host_pattern):
+                    continue
+                if path_pattern is not None and not path_pattern.match(parts.path):
+                    continue
+                if _merge(result, flags):
+                    return result
+        return result
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._exact) + len(self._domains) + len(self._patterns) + len(self._prefixes)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._exact.clear()
+            self._prefixes.clear()
+            self._domains.clear()
+            self._patterns.clear()
+
+    def load_file(self, path: str = WEBSITE_RULES_FILE) -> int:
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            rules = json.load(f).get('rules', [])
+        for rule in rules:
+            self.add(rule['url'], {mode: rule.get(mode) for mode in MODES})
+        return len(rules)
+
+    def load_from_db(self, supabase, page_size: int = 1000) -> int:
+        """Domain, path prefix and pattern rows from the websites table, rows for full urls are skipped."""
+        offset = loaded = 0
+        while True:
+            response = supabase.from_('websites').select('url,study_allowed,work_allowed,leisure_allowed') \
+                .not_.like('url', '%://%').order('url').range(offset, offset + page_size - 1).execute()
+            for row in response.data:
+                if '://' not in row['url']:
+                    self.add(row['url'], {mode: row.get(f'{mode}_allowed') for mode in MODES})
+                    loaded += 1
+            offset += len(response.data)
+            if len(response.data) < page_size:
+                return loaded
@@ -0,0 +1,173 @@
+"""
+Per-user mode cache for /user-mode and /received-mode/, with push notifications for mode changes.
+
+/received-mode/ writes through, so the cache is always at least as fresh as anything this backend
+wrote. The Next.js /api/user/mode route writes `user_mode` directly and then calls
+/user-mode/{user_id}/refresh, which re-reads the row and pushes it. A write that skips both is only
+seen once the entry expires, and nothing is pushed for it until some read refills the entry: the ttl
+bounds how stale such a write path leaves the cache, it doesn't fix it. Clients subscribe to
+/user-mode/{user_id}/events instead of polling.
+
+Users that are known to exist in `user_profiles` are remembered too, so a mode switch doesn't have
+to check for the user again every time.
+"""
+import asyncio
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+USER_MODE_CACHE_MAX_SIZE = int(os.getenv('USER_MODE_CACHE_MAX_SIZE', '10000'))
+USER_MODE_CACHE_TTL_SECONDS = float(os.getenv('USER_MODE_CACHE_TTL_SECONDS', '300'))
+# a subscriber that falls this far behind only needs the latest mode, older ones are dropped
+USER_MODE_SUBSCRIBER_QUEUE_SIZE = int(os.getenv('USER_MODE_SUBSCRIBER_QUEUE_SIZE', '8'))
+# profiles are practically never deleted, so a user that existed once is trusted for a good while
+USER_EXISTS_CACHE_TTL_SECONDS = float(os.getenv('USER_EXISTS_CACHE_TTL_SECONDS', '3600'))
+
+
+class CachedUserMode:
+    __slots__ = ('mode', 'submode', 'expires_at')
+
+    def __init__(self, mode: str, submode: Optional[str], expires_at: float):
+        self.mode = mode
+        self.submode = submode
+        self.expires_at = expires_at
+
+    def as_dict(self) -> dict:
+        return {"mode": self.mode, "submode": self.submode}
+
+
+class UserModeCache:
+    """Bounded LRU of user_id -> (mode, submode), plus the queues of clients listening for changes."""
+
+    def __init__(self, max_size: int = USER_MODE_CACHE_MAX_SIZE, ttl: float = USER_MODE_CACHE_TTL_SECONDS,
+                 queue_size: int = USER_MODE_SUBSCRIBER_QUEUE_SIZE, exists_ttl: float = USER_EXISTS_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.queue_size = queue_size
+        self.exists_ttl = exists_ttl
+        self._entries: 'OrderedDict[str, CachedUserMode]' = OrderedDict()
+        self._known_users: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = threading.Lock()
+        # subscribers and write locks live on the event loop, only touch them from there
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._write_locks: 'weakref.WeakValueDictionary[str, asyncio.Lock]' = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.published = 0
+
+    def get(self, user_id: str) -> Optional[dict]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry.expires_at <= now:
+                # an expired entry stays until it is refilled, so put can tell whether the mode changed
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry.as_dict()
+
+    def contains(self, user_id: str) -> bool:
+        # a peek for existence checks, neither counted as a hit or miss nor refreshing the entry's recency
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry is not None and entry.expires_at > time.monotonic()
+
+    def put(self, user_id: str, mode: str, submode: Optional[str] = None) -> dict:
+        """Cache a mode read from `user_mode`."""
+        previous, entry = self._store(user_id, mode, submode)
+        if previous is not None and (previous.mode, previous.submode) != (mode, submode):
+            # the db moved on without us (another writer), let listeners know
+            self.publish(user_id, entry.as_dict())
+        return entry.as_dict()
+
+    def set(self, user_id: str, mode: str, submode: Optional[str] = None) -> dict:
+        """Write-through after a successful /received-mode/ write, always pushed to subscribers."""
+        _, entry = self._store(user_id, mode, submode)
+        self.publish(user_id, entry.as_dict())
+        return entry.as_dict()
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._known_users.clear()
+
+    def is_known_user(self, user_id: str) -> bool:
+        with self._lock:
+            expires_at = self._known_users.get(user_id)
+            if expires_at is None or expires_at <= time.monotonic():
+                return False
+            self._known_users.move_to_end(user_id)
+            return True
+
+    def remember_user(self, user_id: str) -> None:
+        with self._lock:
+            self._known_users[user_id] = time.monotonic() + self.exists_ttl
+            self._known_users.move_to_end(user_id)
+            while len(self._known_users) > self.max_size:
+                self._known_users.popitem(last=False)
+
+    def write_lock(self, user_id: str) -> asyncio.Lock:
+        """
+        Held around a user's mode write and the cache update after it, so concurrent switches
+        (voice and ui at once) reach the cache and the subscribers in the order they hit the db.
+        """
+        lock = self._write_locks.get(user_id)
+        if lock is None:
+            lock = self._write_locks[user_id] = asyncio.Lock()
+        return lock
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[user_id]
+
+    def publish(self, user_id: str, mode: dict) -> None:
+        for queue in self._subscribers.get(user_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(mode)
+            self.published += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._entries)
+            known_users = len(self._known_users)
+        return {
+            "size": size,
+            "known_users": known_users,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+            "published": self.published,
+        }
+
+    def _store(self, user_id: str, mode: str, submode: Optional[str]) -> Tuple[Optional[CachedUserMode], CachedUserMode]:
+        entry = CachedUserMode(mode, submode, time.monotonic() + self.ttl)
+        with self._lock:
+            previous = self._entries.get(user_id)
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return previous, entry
@@ -0,0 +1,79 @@
+"""
+Reading and switching a user's mode, shared by /received-mode/, /user-mode and the voice assistant.
+
+Lives outside main so the voice assistant router can switch modes in-process without importing the app.
+"""
+import logging
+from typing import Optional
+
+from pydantic import BaseModel
+
+from supabase_client import check_if_user_exists_async, get_user_mode_settings_async, upsert_user_mode_async
+from user_mode_cache import UserModeCache
+
+logger = logging.getLogger(__name__)
+
+
+class ModeData(BaseModel):
+    user_id: str
+    mode: str
+    submode: Optional[str] = None
+
+
+# each user's mode, written through by /received-mode/ and pushed to /user-mode/{user_id}/events
+user_mode_cache = UserModeCache()
+
+
+async def load_user_mode(client, user_id: str):
+    """{"mode", "submode"} from the cache or `user_mode`, None when the user has no mode saved."""
+    cached = user_mode_cache.get(user_id)
+    if cached is not None:
+        return cached
+    settings = await get_user_mode_settings_async(client, user_id)
+    if not settings:
+        return None
+    return user_mode_cache.put(user_id, settings["mode_select"], settings.get("study_submode_select"))
+
+
+async def user_exists(client, user_id: str) -> bool:
+    # users with a cached mode exist, and so do users seen before
+    if user_mode_cache.contains(user_id) or user_mode_cache.is_known_user(user_id):
+        return True
+    if await check_if_user_exists_async(client, user_id):
+        user_mode_cache.remember_user(user_id)
+        return True
+    return False
+
+
+async def set_user_mode(client, mode_data: ModeData) -> dict:
+    """The /received-mode/ response: {"success": True, "message"} or {"success": False, "error"}."""
+    if not await user_exists(client, mode_data.user_id):
+        return {"success": False, "error": f"User {mode_data.user_id} does not exist in the database."}
+
+    # one upsert per switch, writes for the same user go through the cache in db order
+    async with user_mode_cache.write_lock(mode_data.user_id):
+        try:
+            row = await upsert_user_mode_async(client, mode_data.user_id, mode_data.mode, mode_data.submode)
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+        except Exception as e:
+            # the write may or may not have landed, read it back next time
+            user_mode_cache.invalidate(mode_data.user_id)
+            logger.exception("Error upserting user mode", extra={"user_id": mode_data.user_id})
+            return {"success": False, "error": str(e)}
+        user_mode_cache.set(mode_data.user_id, row["mode_select"], row.get("study_submode_select"))
+
+    return {"success": True, "message": "User mode updated successfully"}
+
+
+async def refresh_user_mode(client, user_id: str) -> Optional[dict]:
+    """
+    Re-read a mode written behind the backend's back (the Next.js /api/user/mode route) and push it
+    to listeners. None when the user has no mode saved.
+    """
+    async with user_mode_cache.write_lock(user_id):
+        settings = await get_user_mode_settings_async(client, user_id)
+        if not settings:
+            user_mode_cache.invalidate(user_id)
+            return None
+        return user_mode_cache.set(user_id, settings["mode_select"], settings.get("study_submode_select"))
@@ -1,51 +1,139 @@
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 import os
-import requests
 import base64
+import threading
+import time
+import logging
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 
-def get_spotify_access_token():# Makes a request to Spotify API to get an access token
-    url="https://accounts.spotify.com/api/token"
-    auth=f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}"
-    b64_auth=base64.b64encode(auth.encode()).decode('utf-8')
-    headers={
-        "Authorization": f"Basic {b64_auth}",
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    data={
-        "grant_type":"client_credentials"
-    }
-    response=requests.post(url,headers=headers,data=data)
-    response_json=response.json()
-    
-    print(f"This is the response json: {response_json}")
-
-    if response.status_code == 200:
-        access_token=response_json.get('access_token')
-        return access_token
-    else:
-        print("Error:",response_json)
-        return None
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+SPOTIFY_SEARCH_URL = "https://api.spotify.com/v1/search"
+SPOTIFY_POOL_SIZE = int(os.getenv("SPOTIFY_POOL_SIZE", "10"))
+SPOTIFY_TIMEOUT = float(os.getenv("SPOTIFY_TIMEOUT", "10"))
+# refresh this many seconds before the token expires so no request goes out with a stale one
+SPOTIFY_TOKEN_REFRESH_MARGIN = float(os.getenv("SPOTIFY_TOKEN_REFRESH_MARGIN", "60"))
 
-def search_spotify_song(song_title, song_artist):
-    access_token=get_spotify_access_token()
-    if not access_token:
+def _build_session():
+    # token requests reuse one keep-alive connection, searches go through the async client below
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=SPOTIFY_POOL_SIZE)
+    session.mount("https://", adapter)
+    return session
+
+spotify_session = _build_session()
+# request handlers search through this one instead, so a search never ties up a worker thread
+spotify_async_client = httpx.AsyncClient(
+    timeout=SPOTIFY_TIMEOUT,
+    limits=httpx.Limits(max_connections=SPOTIFY_POOL_SIZE, max_keepalive_connections=SPOTIFY_POOL_SIZE),
+)
+
+
+class SpotifyTokenManager:
+    """Caches the client-credentials token until shortly before `expires_in`."""
+
+    def __init__(self, session, refresh_margin=SPOTIFY_TOKEN_REFRESH_MARGIN):
+        self.session = session
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_token(self, force_refresh=False):
+        now = time.monotonic()
+        token = self._token
+        if token and not force_refresh:
+            if now < self._expires_at - self.refresh_margin:
+                return token
+            if now < self._expires_at:
+                # still valid: one caller refreshes early, everyone else keeps using the current token
+                if not self._lock.acquire(blocking=False):
+                    return token
+                try:
+                    return self._refresh_if_stale(force_refresh=False)
+                finally:
+                    self._lock.release()
+
+        with self._lock:
+            return self._refresh_if_stale(force_refresh)
+
+    def peek(self):
+        # the cached token if it is still fresh, without ever blocking on a refresh
+        if self._token and time.monotonic() < self._expires_at - self.refresh_margin:
+            return self._token
         return None
-    
-    url=f"https://api.spotify.com/v1/search?q=track:{song_title} artist:{song_artist}&type=track"
-    print(url)
-    auth_headers={
-        "Authorization":f"Bearer {access_token}"
+
+    def invalidate(self, token=None):
+        # only drop the token that actually failed, another thread may have refreshed it already
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+
+    def _refresh_if_stale(self, force_refresh):
+        if self._token and not force_refresh and time.monotonic() < self._expires_at - self.refresh_margin:
+            return self._token  # refreshed by whoever held the lock before us
+        token, expires_in = self._request_token()
+        if token:
+            self._token = token
+            self._expires_at = time.monotonic() + expires_in
+        return token
+
+    def _request_token(self):  # Makes a request to Spotify API to get an access token
+        auth=f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}"
+        b64_auth=base64.b64encode(auth.encode()).decode('utf-8')
+        headers={
+            "Authorization": f"Basic {b64_auth}",
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        data={
+            "grant_type":"client_credentials"
+        }
+        try:
+            response=self.session.post(SPOTIFY_TOKEN_URL,headers=headers,data=data,timeout=SPOTIFY_TIMEOUT)
+            response_json=response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error("Error requesting Spotify access token: %s", e)
+            return None, 0
+
+        if response.status_code == 200:
+            logger.info("Fetched Spotify access token, expires in %ss", response_json.get('expires_in'))
+            return response_json.get('access_token'), float(response_json.get('expires_in', 3600))
+        else:
+            logger.error("Error fetching Spotify access token: %s", response_json)
+            return None, 0
+
+token_manager = SpotifyTokenManager(spotify_session)
+
+
+class SpotifySearchError(Exception):
+    """The search did not complete (no token, http error), as opposed to finding no track."""
+
+
+def _search_params(song_title, song_artist):
+    return {
+        "q": f"track:{song_title} artist:{song_artist}",
+        "type": "track",
+        "limit": 1,
     }
 
-    response=requests.get(url,headers=auth_headers)
-    response_json=response.json()
+def _track_from_response(response):
+    try:
+        response_json=response.json()
+    except ValueError as e:
+        raise SpotifySearchError(str(e)) from e
 
-    if(response_json["tracks"]["items"]):
+    if response.status_code != 200:
+        raise SpotifySearchError(f"Spotify search returned {response.status_code}: {response_json}")
+
+    if(response_json.get("tracks",{}).get("items")):
         track=response_json["tracks"]["items"][0]
         spotify_url=track["external_urls"]['spotify']
         title=track["name"]
@@ -60,5 +148,28 @@ def search_spotify_song(song_title, song_artist):
             'url':spotify_url
         }
     else:
-        print("No results found for the song.")
         return None
+
+async def search_spotify_track_async(song_title, song_artist):
+    """
+    Best match for the song, None if spotify has no such track. Raises SpotifySearchError on failure.
+    Token refreshes are rare and still go through the sync manager, anything that may wait on its lock
+    runs in the threadpool so a refresh in progress never blocks the loop.
+    """
+    access_token=token_manager.peek() or await run_in_threadpool(token_manager.get_token)
+    if not access_token:
+        raise SpotifySearchError("No Spotify access token")
+
+    params=_search_params(song_title, song_artist)
+    try:
+        response=await spotify_async_client.get(SPOTIFY_SEARCH_URL,params=params,headers={"Authorization":f"Bearer {access_token}"})
+        if response.status_code == 401:
+            await run_in_threadpool(token_manager.invalidate,access_token)
+            access_token=await run_in_threadpool(token_manager.get_token)
+            if not access_token:
+                raise SpotifySearchError("No Spotify access token")
+            response=await spotify_async_client.get(SPOTIFY_SEARCH_URL,params=params,headers={"Authorization":f"Bearer {access_token}"})
+    except httpx.HTTPError as e:
+        raise SpotifySearchError(str(e)) from e
+
+    return _track_from_response(response)
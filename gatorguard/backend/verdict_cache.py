@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MODES = ['study', 'work', 'leisure']
+
+VERDICT_CACHE_MAX_SIZE = int(os.getenv('VERDICT_CACHE_MAX_SIZE', '2048'))
+VERDICT_CACHE_TTL_SECONDS = float(os.getenv('VERDICT_CACHE_TTL_SECONDS', '600'))
+# websites that are not in the db yet get a shorter ttl so a row added later is picked up quickly
+VERDICT_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv('VERDICT_CACHE_NEGATIVE_TTL_SECONDS', '60'))
+# how long past its ttl a row may still be answered from while it is re-read in the background
+VERDICT_CACHE_STALE_SECONDS = float(os.getenv('VERDICT_CACHE_STALE_SECONDS', '3600'))
+
+
+class CachedVerdict:
+    """Snapshot of what we know about a url: whether it has a `websites` row and its per-mode flags."""
+    __slots__ = ('exists', 'verdicts', 'expires_at', 'stale')
+
+    def __init__(self, exists: bool, verdicts: Dict[str, Optional[bool]], expires_at: float, stale: bool = False):
+        self.exists = exists
+        self.verdicts = verdicts
+        self.expires_at = expires_at
+        self.stale = stale
+
+    def copy(self, stale: bool = False) -> 'CachedVerdict':
+        return CachedVerdict(self.exists, dict(self.verdicts), self.expires_at, stale)
+
+
+class VerdictCache:
+    """Bounded in-process LRU cache sitting in front of the `websites` table and Gemini."""
+
+    def __init__(self, max_size: int = VERDICT_CACHE_MAX_SIZE, ttl: float = VERDICT_CACHE_TTL_SECONDS,
+                 negative_ttl: float = VERDICT_CACHE_NEGATIVE_TTL_SECONDS, stale: float = VERDICT_CACHE_STALE_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale = stale
+        self._entries: 'OrderedDict[str, CachedVerdict]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, url: str, allow_stale: bool = False) -> Optional[CachedVerdict]:
+        """
+        The cached entry, or None. With allow_stale an expired row within the stale window is
+        returned too, marked .stale, and it is up to the caller to refresh it.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at <= now:
+                # only rows are worth serving stale, a stale "not in the db" still needs the db
+                if not entry.exists or entry.expires_at + self.stale <= now:
+                    del self._entries[url]
+                elif allow_stale:
+                    self._entries.move_to_end(url)
+                    self.stale_hits += 1
+                    return entry.copy(stale=True)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry.copy()
+
+    def put(self, url: str, record) -> CachedVerdict:
+        # record is the WebsiteRecord read from the `websites` table
+        verdicts = {mode: record.allowed_for(mode) for mode in MODES}
+        return self._store(url, CachedVerdict(True, verdicts, time.monotonic() + self.ttl))
+
+    def put_missing(self, url: str) -> CachedVerdict:
+        verdicts = {mode: None for mode in MODES}
+        return self._store(url, CachedVerdict(False, verdicts, time.monotonic() + self.negative_ttl))
+
+    def invalidate(self, url: str) -> None:
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_hits": self.stale_hits,
+            }
+
+    def _store(self, url: str, entry: CachedVerdict) -> CachedVerdict:
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return entry.copy()
@@ -1,76 +1,99 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
-import google.generativeai as genai
 from pydantic import BaseModel
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from main import ModeData
+from supabase_client import get_async_supabase_client
+from user_mode_service import ModeData, set_user_mode
 import httpx
+import logging
 import uvicorn
+from log_config import setup_logging, stop_logging
+from metrics import stage_timer
+from llm_scheduler import Priority, llm_scheduler
 
 load_dotenv()
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000", "http://127.0.0.1:3000", "http://localhost:8000", "http://127.0.0.1:8000"], 
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# where the standalone voice service sends mode switches; mounted in main they never leave the process
+VOICE_MODE_SERVICE_URL = os.getenv('VOICE_MODE_SERVICE_URL', 'http://localhost:8000')
+VOICE_MODE_SERVICE_TIMEOUT = float(os.getenv('VOICE_MODE_SERVICE_TIMEOUT', '10'))
+
+router = APIRouter()
+
+# only set by the standalone app, one pooled client for all of its requests
+mode_service_client = None
 
 class SpokenRequest(BaseModel):
     request: str
     user_id: str
 
-@app.post('/receive-spoken-request')
+async def update_mode(mode_data: ModeData) -> dict:
+    if mode_service_client is None:
+        return await set_user_mode(get_async_supabase_client(), mode_data)
+    response = await mode_service_client.post('/received-mode/', json=mode_data.model_dump())
+    return response.json()
+
+@router.post('/receive-spoken-request')
 async def process_spoken_request(req: SpokenRequest):
-    print("Received spoken request")
     try:
         api_key=os.getenv('GEMINI_SPEECH_API_KEY')
         if not api_key:
             raise HTTPException(status_code=400, detail='Invalid Gemini API Key')
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        query = f'''Here is a request: {req.request}. This request should be in a very similar format to "Switch to [mode] mode." 
-        If it is, your response should be only the word(s) [mode] that was said. 
-        If the request is in a different format, respond with "Invalid request". 
+        query = f'''Here is a request: {req.request}. This request should be in a very similar format to "Switch to [mode] mode."
+        If it is, your response should be only the word(s) [mode] that was said.
+        If the request is in a different format, respond with "Invalid request".
         '''
-        response = model.generate_content(query)
-        print("Model has surveyed the query")
+        with stage_timer('gemini', 'voice_intent'):
+            response = await llm_scheduler.generate('GEMINI_SPEECH_API_KEY', query, Priority.INTERACTIVE, user_id=req.user_id)
         mode = response.text.strip().lower()
-        print(f"Mode: {mode}")
         if mode is None or mode == 'invalid request':
             return {"response": "invalid request"}
-        print("not an invalid request")
         submode = None
         if len(mode.split()) > 1: # study mode with submode
-            print("entered if statement")
             mode = mode.split()
-            mode, submode = mode[0], mode[1:]
-            print("finished first split")
-            submode = ' '.join(submode)
-            print("done here")
-        print(mode)
-        print(submode)
-        print(req.user_id)
-        print(f"mode_data split: mode {mode}, submode {submode}, userid {req.user_id}")
+            mode, submode = mode[0], ' '.join(mode[1:])
+        logger.debug("Voice mode switch", extra={"user_id": req.user_id, "mode": mode, "submode": submode})
         mode_data = ModeData(user_id=req.user_id, mode=mode, submode=submode)
-        print("created a ModeData instance")
-        print("calling db function")
-        async with httpx.AsyncClient() as client:
-            response = await client.post('http://localhost:8000/received-mode/', json=mode_data.model_dump())
-        db_response = response.json()
-        print("received response from db")
+        db_response = await update_mode(mode_data)
         if db_response["success"]:
             message = f"Set user mode to {mode}"
             if submode:
                 message += f': {submode}'
-            return {"message": message, "mode": mode, "submode": {submode if submode else None}}
+            return {"message": message, "mode": mode, "submode": submode}
         return {"error": f"Error accessing database: {db_response['error']}"}
 
     except Exception as e:
+        logger.exception("Error processing spoken request")
         return {"error": str(e)}
-    
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global mode_service_client
+    setup_logging()
+    mode_service_client = httpx.AsyncClient(
+        base_url=VOICE_MODE_SERVICE_URL,
+        timeout=VOICE_MODE_SERVICE_TIMEOUT,
+        limits=httpx.Limits(max_keepalive_connections=10),
+    )
+    yield
+    await mode_service_client.aclose()
+    mode_service_client = None
+    await llm_scheduler.stop()
+    stop_logging()
+
+# standalone deployment, the main app mounts `router` instead
+app = FastAPI(lifespan=lifespan)
+app.include_router(router)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:3000", "http://127.0.0.1:3000", "http://localhost:8000", "http://127.0.0.1:8000"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 if __name__ == '__main__':
-    uvicorn.run('voice_assistant:app', host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
+    uvicorn.run('voice_assistant:app', host="0.0.0.0", port=8001, reload=True)
@@ -0,0 +1,207 @@
+"""
+Write-behind buffer for the `websites` table.
+
+Request handlers hand their rows to the writer and answer straight away. A background task on the event
+loop writes them as bulk upserts once WEBSITE_WRITE_BATCH_SIZE rows are waiting or every
+WEBSITE_WRITE_FLUSH_SECONDS, whichever comes first. Writes to the same url between two flushes are
+merged into one row, rows that fail to flush are kept for the next one, and whatever is still buffered
+is written on shutdown.
+
+A row can't be read back from the database until it is flushed, so callers put what they wrote in the
+verdict cache.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from resilience import db_dependency
+from supabase_client import get_async_supabase_client, upsert_websites_async
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WEBSITE_WRITE_BATCH_SIZE = int(os.getenv('WEBSITE_WRITE_BATCH_SIZE', '100'))
+WEBSITE_WRITE_FLUSH_SECONDS = float(os.getenv('WEBSITE_WRITE_FLUSH_SECONDS', '0.5'))
+# rows held while the database can't be written to, the oldest are dropped past this
+WEBSITE_WRITE_MAX_PENDING = int(os.getenv('WEBSITE_WRITE_MAX_PENDING', '10000'))
+# pause after a failed flush before trying again
+WEBSITE_WRITE_RETRY_SECONDS = float(os.getenv('WEBSITE_WRITE_RETRY_SECONDS', '2'))
+
+
+class _PendingRow:
+    __slots__ = ('columns', 'insert_only')
+
+    def __init__(self, columns: dict, insert_only: bool):
+        self.columns = columns
+        self.insert_only = insert_only
+
+
+class WebsiteWriter:
+    """
+    insert(row) adds a row unless its url already has one, upsert(row) writes the columns it carries
+    over whatever is stored. on_duplicate(rows) is awaited with the inserted rows whose url turned out
+    to exist already. The buffer is only touched from the event loop, which is why it has no lock.
+    """
+
+    def __init__(self, on_duplicate: Optional[Callable[[List[dict]], Awaitable[None]]] = None,
+                 batch_size: int = WEBSITE_WRITE_BATCH_SIZE, flush_interval: float = WEBSITE_WRITE_FLUSH_SECONDS,
+                 max_pending: int = WEBSITE_WRITE_MAX_PENDING, retry_interval: float = WEBSITE_WRITE_RETRY_SECONDS):
+        self.on_duplicate = on_duplicate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retry_interval = retry_interval
+        self._pending: 'OrderedDict[str, _PendingRow]' = OrderedDict()
+        self._wake: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.queued = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.duplicates = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        # must be called from the running event loop (the app lifespan)
+        if self._worker is None or self._worker.done():
+            self._stopping = False
+            self._wake = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """Write everything still buffered (one attempt) and stop the background task."""
+        if self._worker is not None and not self._worker.done():
+            self._stopping = True
+            self._wake.set()
+            await self._worker
+        self._worker = None
+        if self._pending:
+            logger.error("%d website rows could not be written before shutdown", len(self._pending))
+
+    def insert(self, row: dict) -> None:
+        self._add(row, insert_only=True)
+
+    def upsert(self, row: dict) -> None:
+        self._add(row, insert_only=False)
+
+    def _add(self, row: dict, insert_only: bool) -> None:
+        self.queued += 1
+        url = row['url']
+        pending = self._pending.get(url)
+        if pending is None:
+            self._pending[url] = _PendingRow(dict(row), insert_only)
+        else:
+            self.coalesced += 1
+            self._merge(pending, row, insert_only)
+
+        while len(self._pending) > self.max_pending:
+            url, _ = self._pending.popitem(last=False)
+            self.dropped += 1
+            logger.warning("Website write buffer full, dropping a row", extra={"url": url})
+        if len(self._pending) >= self.batch_size and self._wake is not None:
+            self._wake.set()
+
+    @staticmethod
+    def _merge(pending: _PendingRow, columns: dict, insert_only: bool) -> None:
+        if insert_only and not pending.insert_only:
+            # the row is being overwritten anyway, an insert only adds the columns the overwrite leaves out
+            pending.columns = {**columns, **pending.columns}
+        else:
+            pending.columns.update(columns)
+            pending.insert_only = pending.insert_only and insert_only
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def is_pending(self, url: str) -> bool:
+        return url in self._pending
+
+    async def flush(self) -> bool:
+        """Write every buffered row now. False if some of them failed and are buffered again."""
+        if not self._pending:
+            return True
+        rows, self._pending = self._pending, OrderedDict()
+
+        # one statement per kind of write and set of columns, postgrest wants the same keys on every row
+        groups: Dict[Tuple[bool, Tuple[str, ...]], List[_PendingRow]] = {}
+        for pending in rows.values():
+            groups.setdefault((pending.insert_only, tuple(sorted(pending.columns))), []).append(pending)
+
+        ok = True
+        for (insert_only, _), group in groups.items():
+            for start in range(0, len(group), self.batch_size):
+                chunk = group[start:start + self.batch_size]
+                ok = await self._write(chunk, insert_only) and ok
+        return ok
+
+    async def _write(self, chunk: List[_PendingRow], insert_only: bool) -> bool:
+        batch = [pending.columns for pending in chunk]
+        try:
+            written = await db_dependency.call(upsert_websites_async, get_async_supabase_client(), batch,
+                                               ignore_duplicates=insert_only)
+        except Exception as e:
+            self.failures += 1
+            logger.warning("Failed to write %d website rows, keeping them for the next flush: %r", len(chunk), e)
+            self._restore(chunk)
+            return False
+
+        self.flushes += 1
+        self.rows_written += len(written)
+        if insert_only and len(written) < len(batch):
+            written_urls = {row['url'] for row in written}
+            skipped = [row for row in batch if row['url'] not in written_urls]
+            self.duplicates += len(skipped)
+            if self.on_duplicate is not None:
+                try:
+                    await self.on_duplicate(skipped)
+                except Exception:
+                    logger.exception("Error handling duplicate website rows")
+        return True
+
+    def _restore(self, chunk: List[_PendingRow]) -> None:
+        # back at the front of the queue, anything written to the same url since the flush started is newer
+        for pending in reversed(chunk):
+            url = pending.columns['url']
+            newer = self._pending.pop(url, None)
+            if newer is not None:
+                self._merge(pending, newer.columns, newer.insert_only)
+            self._pending[url] = pending
+            self._pending.move_to_end(url, last=False)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            stopping = self._stopping
+            try:
+                ok = await self.flush()
+            except Exception:
+                logger.exception("Error flushing website rows")
+                ok = False
+            if stopping:
+                return
+            if not ok:
+                await asyncio.sleep(self.retry_interval)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "queued": self.queued,
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "duplicates": self.duplicates,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+        }
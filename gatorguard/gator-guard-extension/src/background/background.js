@@ -70,6 +70,100 @@ function syncModeWithDatabase() {
   }
 }
 
+// Mode changes are pushed by the backend over server-sent events instead of being polled
+const BACKEND_URL = "http://localhost:8000";
+const MODE_EVENTS_RETRY_MS = 5000;
+let modeEventsController = null;
+// local mode switches still being saved, a stream's first event may predate them
+let pendingModeWrites = 0;
+
+function applyPushedMode(update) {
+  const oldMode = currentMode;
+  currentMode = update.mode;
+  studySubmodeSelect = update.submode;
+
+  chrome.storage.local.set({
+    currentMode: currentMode,
+    studySubmodeSelect: studySubmodeSelect,
+  });
+
+  chrome.runtime.sendMessage({
+    type: "BACKGROUND_STATE_UPDATED",
+    data: {
+      currentMode: currentMode,
+      studySubmodeSelect: studySubmodeSelect,
+    },
+  });
+
+  if (oldMode !== currentMode) {
+    recheckCurrentTab();
+  }
+}
+
+async function subscribeToModeEvents(userId) {
+  unsubscribeFromModeEvents();
+  const controller = new AbortController();
+  modeEventsController = controller;
+
+  try {
+    // EventSource isn't available in service workers, so read the stream by hand
+    const response = await fetch(`${BACKEND_URL}/user-mode/${userId}/events`, {
+      signal: controller.signal,
+    });
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    let firstEvent = true;
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += value;
+
+      let boundary;
+      while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+        const event = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        const data = event
+          .split("\n")
+          .filter((line) => line.startsWith("data: "))
+          .map((line) => line.slice(6))
+          .join("\n");
+        if (data) {
+          // the first event is the mode the backend had when we connected, don't let it undo a
+          // switch that hasn't been saved yet, the backend pushes the switch once it is
+          const snapshot = firstEvent;
+          firstEvent = false;
+          if (snapshot && pendingModeWrites > 0) {
+            console.log("Ignoring mode snapshot, a local switch is still being saved:", data);
+            continue;
+          }
+          console.log("Mode pushed from backend:", data);
+          applyPushedMode(JSON.parse(data));
+        }
+      }
+    }
+  } catch (error) {
+    if (controller.signal.aborted) return;
+    console.error("Mode event stream failed:", error);
+  }
+
+  // reconnect unless we were unsubscribed in the meantime
+  if (modeEventsController === controller && isAuthenticated) {
+    setTimeout(() => {
+      if (modeEventsController === controller && isAuthenticated) {
+        subscribeToModeEvents(userId);
+      }
+    }, MODE_EVENTS_RETRY_MS);
+  }
+}
+
+function unsubscribeFromModeEvents() {
+  if (modeEventsController) {
+    modeEventsController.abort();
+    modeEventsController = null;
+  }
+}
+
 // Check authentication status periodically
 function checkAuthentication() {
   fetch("http://localhost:3000/api/checkauth", {
@@ -90,9 +184,16 @@ function checkAuthentication() {
         isAuthenticated ? "Logged in" : "Not logged in"
       );
 
-      // If user just became authenticated, sync mode from database
+      // If user just became authenticated, sync mode from database and listen for changes
       if (!wasAuthenticated && isAuthenticated) {
         syncModeWithDatabase();
+        if (data.user && data.user.id) {
+          subscribeToModeEvents(data.user.id);
+        }
+      }
+
+      if (!isAuthenticated) {
+        unsubscribeFromModeEvents();
       }
 
       // If authentication status changed, broadcast to all extension pages
@@ -106,6 +207,7 @@ function checkAuthentication() {
     .catch((error) => {
       console.error("Auth check failed:", error);
       isAuthenticated = false;
+      unsubscribeFromModeEvents();
 
       // Also broadcast on error (assume logged out)
       chrome.runtime.sendMessage({
@@ -323,6 +425,7 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
 
       // Send the mode change to the backend if authenticated
       if (isAuthenticated) {
+        pendingModeWrites++;
         fetch("http://localhost:3000/api/user/mode", {
           method: "POST",
           credentials: "include", // Important for cookies
@@ -341,6 +444,9 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
           })
           .catch((error) => {
             console.error("Failed to update mode:", error);
+          })
+          .finally(() => {
+            pendingModeWrites--;
           });
       }
 
@@ -387,6 +493,7 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
     // Clear any auth tokens or state
     isAuthenticated = false; // CHANGED: was "authenticated" before
     chrome.storage.local.remove("authToken");
+    unsubscribeFromModeEvents();
 
     // Notify all extension pages
     chrome.runtime.sendMessage({